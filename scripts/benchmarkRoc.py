@@ -0,0 +1,276 @@
+"""
+Benchmarks for the ROC analysis in rocAnalysis, on synthetic blast output.
+
+The synthetic JSON blast files have the layout rocAnalysis expects: one line
+of parameters, then one record per read with a query of the form
+readN|sim|level. Reads at higher levels of sequence identity get higher bit
+scores and are less likely to have no hits, and each scoring scheme adds
+its own noise, so the ROC curves are not trivial. The same arguments always
+give the same files.
+
+Run as
+
+    python -m scripts.benchmarkRoc --output benchmark.json
+
+to time countHits, calculateFrequencies, youdenIndex, f1Index and
+areaUnderCurve separately and write the timings, records per second and
+peak resident memory as JSON, so runs of different versions can be
+compared.
+"""
+
+from json import dump, dumps
+from os.path import join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+import argparse
+import numpy as np
+import platform
+import resource
+import sys
+import time
+
+from scripts import rocAnalysis
+
+BASES = 'ACGT'
+
+
+def syntheticLevels(levels):
+    """
+    Make evenly spaced levels of sequence identity from 100 down to 0.
+
+    @param levels: the C{int} number of levels.
+    @return: a C{list} of C{str} levels, highest first.
+    """
+    return ['%g' % round(level, 2)
+            for level in np.linspace(100, 0, levels)]
+
+
+def syntheticRecords(readsPerLevel=594, levels=22, alignmentsPerRecord=5,
+                     scheme=0, seed=0, readLength=100):
+    """
+    Make the records of a synthetic JSON blast file for one scoring scheme.
+
+    @param readsPerLevel: the C{int} number of reads at each level.
+    @param levels: the C{int} number of levels of sequence identity.
+    @param alignmentsPerRecord: the C{int} number of alignments of each read
+        that has hits.
+    @param scheme: the C{int} index of the scoring scheme, which sets how
+        noisy its bit scores are.
+    @param seed: an C{int} random seed.
+    @param readLength: the C{int} length of the reads.
+    @return: A generator of C{dict} records.
+    """
+    random = Random(seed * 1000003 + scheme)
+    noise = 10.0 + 5.0 * scheme
+    read = ''.join(random.choice(BASES) for _ in xrange(readLength))
+    count = 0
+    for level in syntheticLevels(levels):
+        identity = float(level) / 100.0
+        for _ in xrange(readsPerLevel):
+            query = 'read%d|sim|%s' % (count, level)
+            count += 1
+            alignments = []
+            if random.random() < 0.2 + 0.8 * identity:
+                bits = max(1.0, random.gauss(20.0 + 160.0 * identity, noise))
+                for index in xrange(alignmentsPerRecord):
+                    alignments.append({
+                        'length': readLength,
+                        'title': 'gi|%d|gb|SYN%d synthetic subject' % (
+                            index, index),
+                        'hsps': [
+                            {
+                                'bits': round(bits * 0.9 ** index, 2),
+                                'expect': 1e-10,
+                                'frame': [1, 1],
+                                'query': read,
+                                'query_start': 1,
+                                'query_end': readLength,
+                                'sbjct': read,
+                                'sbjct_start': 1,
+                                'sbjct_end': readLength,
+                            }
+                        ]
+                    })
+            yield {'query': query, 'alignments': alignments}
+
+
+def writeSyntheticBlastFile(filename, **kwargs):
+    """
+    Write a synthetic JSON blast file for one scoring scheme.
+
+    @param filename: the C{str} name of the file to write.
+    @param kwargs: arguments for syntheticRecords.
+    @return: the C{int} number of records written.
+    """
+    count = 0
+    with open(filename, 'w') as fp:
+        fp.write(dumps({'application': 'BLASTN', 'synthetic': True}) + '\n')
+        for record in syntheticRecords(**kwargs):
+            fp.write(dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def writeSyntheticSchemes(directory, schemes=4, **kwargs):
+    """
+    Write one synthetic JSON blast file per scoring scheme.
+
+    @param directory: the C{str} directory to write the files to.
+    @param schemes: the C{int} number of scoring schemes.
+    @param kwargs: further arguments for syntheticRecords.
+    @return: a C{list} of the C{str} names of the files written and the
+        C{int} total number of records in them.
+    """
+    filenames = []
+    total = 0
+    for scheme in xrange(schemes):
+        filename = join(directory, 'scheme%d.json' % scheme)
+        total += writeSyntheticBlastFile(filename, scheme=scheme, **kwargs)
+        filenames.append(filename)
+    return filenames, total
+
+
+def _peakRss():
+    """
+    Get the peak resident memory of this process so far, in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, OS X bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _timed(function, records, repeats):
+    """
+    Time a function.
+
+    @param function: a function of no arguments.
+    @param records: the C{int} number of blast records the function covers.
+    @param repeats: the C{int} number of times to call the function. The
+        fastest call is reported.
+    @return: the result of the last call and a C{dict} with the timing.
+    """
+    best = None
+    for _ in xrange(repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, {
+        'seconds': best,
+        'records': records,
+        'recordsPerSecond': records / best if best else None,
+        'peakRssKb': _peakRss(),
+    }
+
+
+def benchmark(readsPerLevel=594, levels=22, alignmentsPerRecord=5,
+              schemes=4, cutoff=50, seed=0, repeats=1, directory=None):
+    """
+    Time the stages of the ROC analysis on synthetic blast files.
+
+    @param readsPerLevel: the C{int} number of reads at each level.
+    @param levels: the C{int} number of levels of sequence identity.
+    @param alignmentsPerRecord: the C{int} number of alignments of each read
+        that has hits.
+    @param schemes: the C{int} number of scoring schemes (blast files).
+    @param cutoff: the bit score cutoff given to countHits.
+    @param seed: an C{int} random seed.
+    @param repeats: the C{int} number of times to run each stage. The
+        fastest run is reported.
+    @param directory: the C{str} directory to write the blast files to. If
+        C{None}, a temporary directory is used and removed afterwards.
+    @return: a C{dict} with the configuration, the environment and, under
+        'stages', the timing of each stage. The timing of a stage has
+        'seconds', 'records' (the number of blast records it covers),
+        'recordsPerSecond' and 'peakRssKb' (the peak resident memory of the
+        process so far).
+    """
+    config = {
+        'readsPerLevel': readsPerLevel,
+        'levels': levels,
+        'alignmentsPerRecord': alignmentsPerRecord,
+        'schemes': schemes,
+        'cutoff': cutoff,
+        'seed': seed,
+        'repeats': repeats,
+    }
+    tempDirectory = directory is None
+    if tempDirectory:
+        directory = mkdtemp()
+
+    try:
+        filenames, total = writeSyntheticSchemes(
+            directory, schemes=schemes, readsPerLevel=readsPerLevel,
+            levels=levels, alignmentsPerRecord=alignmentsPerRecord,
+            seed=seed)
+        stages = {}
+
+        def countAll():
+            hitDict = {}
+            totals = {}
+            for filename in filenames:
+                title, hitDict[title], totals[title] = rocAnalysis.countHits(
+                    filename, cutoff, withTotals=True)
+            return hitDict, totals
+
+        (hitDict, totals), stages['countHits'] = _timed(countAll, total,
+                                                        repeats)
+        frequencies, stages['calculateFrequencies'] = _timed(
+            lambda: rocAnalysis.calculateFrequencies(hitDict, totals), total,
+            repeats)
+        for name in 'youdenIndex', 'f1Index', 'areaUnderCurve':
+            function = getattr(rocAnalysis, name)
+            _, stages[name] = _timed(lambda: function(frequencies), total,
+                                     repeats)
+    finally:
+        if tempDirectory:
+            rmtree(directory)
+
+    return {
+        'config': config,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'stages': stages,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ROC analysis on synthetic blast output.')
+    parser.add_argument('--readsPerLevel', type=int, default=594)
+    parser.add_argument('--levels', type=int, default=22)
+    parser.add_argument('--alignmentsPerRecord', type=int, default=5)
+    parser.add_argument('--schemes', type=int, default=4)
+    parser.add_argument('--cutoff', type=float, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--directory', default=None,
+                        help='Where to write the synthetic blast files '
+                        '(default: a temporary directory).')
+    parser.add_argument('--output', default=None,
+                        help='The JSON file to write the results to '
+                        '(default: standard output).')
+    options = parser.parse_args(args)
+
+    results = benchmark(
+        readsPerLevel=options.readsPerLevel, levels=options.levels,
+        alignmentsPerRecord=options.alignmentsPerRecord,
+        schemes=options.schemes, cutoff=options.cutoff, seed=options.seed,
+        repeats=options.repeats, directory=options.directory)
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            dump(results, fp, indent=2, sort_keys=True)
+    else:
+        dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
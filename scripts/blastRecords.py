@@ -0,0 +1,513 @@
+"""
+Reading of JSON blast output files.
+
+The files have one line of blast parameters followed by one line of JSON
+per read. They can be plain text or compressed with gzip, block gzip
+(BGZF, as written by bgzip), bzip2 or xz. The compression is found from
+the first bytes of the file, not from its name, and the data is
+decompressed as it is read, so nothing is written to disk. Instead of a
+file name, the readers also take '-' for standard input, an open file or
+any other iterator of lines, so blast output can be piped straight in.
+
+BGZF files are made of independently compressed blocks, so bgzfBlocks and
+readBgzfBlocks can be used to decompress parts of a file without reading
+it from the start.
+
+Large uncompressed files can be parsed in parallel with mapChunks, which
+splits them into byte ranges that start and end on line boundaries and
+hands each range to a worker process.
+"""
+
+from Bio.Blast import Record
+from itertools import imap
+from json import loads
+from multiprocessing import Pool
+from os.path import getsize
+from struct import unpack
+import bz2
+import gzip
+import io
+import sys
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# The name that stands for standard input.
+STDIN = '-'
+
+# The size of the reads done on blast files and on the compressed streams.
+BUFFER_SIZE = 1 << 20
+
+# The size of the byte ranges that mapChunks gives to each worker.
+CHUNK_SIZE = 1 << 26
+
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC = 'BZh'
+XZ_MAGIC = '\xfd7zXZ\x00'
+
+# The gzip header flag that says an extra field is present, and the size of
+# the fixed part of a gzip header before it.
+_GZIP_FEXTRA = 4
+_GZIP_HEADER_SIZE = 12
+
+
+def _bgzfBlockSize(header):
+    """
+    Finds the size of a BGZF block from its header.
+
+    @param header: a C{str} with the first bytes of a gzip member.
+    @return: the C{int} size of the whole compressed block, or C{None} if
+        the header is not that of a BGZF block.
+    """
+    if (len(header) < _GZIP_HEADER_SIZE or header[:2] != GZIP_MAGIC or
+            not ord(header[3]) & _GZIP_FEXTRA):
+        return None
+    extraLength = unpack('<H', header[10:12])[0]
+    extra = header[_GZIP_HEADER_SIZE:_GZIP_HEADER_SIZE + extraLength]
+    offset = 0
+    while offset + 4 <= len(extra):
+        subfieldLength = unpack('<H', extra[offset + 2:offset + 4])[0]
+        if extra[offset:offset + 2] == 'BC' and subfieldLength == 2:
+            return unpack('<H', extra[offset + 4:offset + 6])[0] + 1
+        offset += 4 + subfieldLength
+    return None
+
+
+def compression(fp):
+    """
+    Finds how an open file is compressed by looking at its first bytes. The
+    file is left positioned at its start.
+
+    @param fp: a file opened for reading in binary mode.
+    @return: one of 'bgzf', 'gzip', 'bz2' or 'xz', or C{None} if the file is
+        not compressed.
+    """
+    header = fp.read(64)
+    fp.seek(0)
+    if header.startswith(GZIP_MAGIC):
+        return 'bgzf' if _bgzfBlockSize(header) else 'gzip'
+    elif header.startswith(BZ2_MAGIC):
+        return 'bz2'
+    elif header.startswith(XZ_MAGIC):
+        return 'xz'
+    else:
+        return None
+
+
+class _Bz2Reader(io.RawIOBase):
+    """
+    Decompresses all the streams of a bzip2 file, one after the other.
+    Files written by pbzip2, or made by concatenating bzip2 files, have
+    several streams, and C{bz2.BZ2File} in Python 2 stops after the first.
+    """
+    def __init__(self, fp):
+        """
+        @param fp: a bzip2 compressed file opened for reading in binary mode.
+        """
+        self._fp = fp
+        self._decompressor = bz2.BZ2Decompressor()
+        self._data = ''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _decompress(self, data):
+        """
+        Decompress some compressed data, starting a new stream where the
+        one before ends.
+
+        @param data: a C{str} of compressed data.
+        @return: a C{str} of decompressed data.
+        """
+        result = []
+        while data:
+            try:
+                result.append(self._decompressor.decompress(data))
+            except EOFError:
+                # The stream ended exactly where the data before ended.
+                self._decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = bz2.BZ2Decompressor()
+        return ''.join(result)
+
+    def readinto(self, buffer):
+        while self._offset == len(self._data):
+            compressed = self._fp.read(BUFFER_SIZE)
+            if not compressed:
+                return 0
+            self._data = self._decompress(compressed)
+            self._offset = 0
+        size = min(len(buffer), len(self._data) - self._offset)
+        buffer[:size] = self._data[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+        io.RawIOBase.close(self)
+
+
+def openBlastFile(filename):
+    """
+    Opens a blast file for reading, decompressing it on the fly if needed.
+
+    @param filename: the C{str} name of the file.
+    @raise ValueError: If the file is xz compressed and there is no lzma
+        module.
+    @return: a file-like object that can be iterated over to get the lines
+        of the (decompressed) file, and used as a context manager.
+    """
+    fp = open(filename, 'rb', BUFFER_SIZE)
+    kind = compression(fp)
+    if kind is None:
+        return fp
+    elif kind in ('gzip', 'bgzf'):
+        # BGZF files are valid multi-member gzip files.
+        return io.BufferedReader(gzip.GzipFile(fileobj=fp), BUFFER_SIZE)
+    elif kind == 'bz2':
+        return io.BufferedReader(_Bz2Reader(fp), BUFFER_SIZE)
+    else:
+        fp.close()
+        if lzma is None:
+            raise ValueError('Reading xz compressed file %r needs the lzma '
+                             'module.' % filename)
+        return io.BufferedReader(lzma.LZMAFile(filename), BUFFER_SIZE)
+
+
+def blastName(blastFile):
+    """
+    Gets a name for a blast file, for use in messages and titles.
+
+    @param blastFile: the C{str} name of a file, '-' for standard input, an
+        open file or an iterator of lines.
+    @return: a C{str} name.
+    """
+    if isinstance(blastFile, basestring):
+        return '<stdin>' if blastFile == STDIN else blastFile
+    else:
+        return getattr(blastFile, 'name', '<stream>')
+
+
+def isFilename(blastFile):
+    """
+    Tells whether a blast file is given by the name of a file on disk.
+
+    @param blastFile: the C{str} name of a file, '-' for standard input, an
+        open file or an iterator of lines.
+    @return: C{True} if C{blastFile} is the name of a file.
+    """
+    return isinstance(blastFile, basestring) and blastFile != STDIN
+
+
+def isPlainFile(blastFile):
+    """
+    Tells whether a blast file is an uncompressed file on disk, which can be
+    split into chunks by chunkRanges.
+
+    @param blastFile: the C{str} name of a file, '-' for standard input, an
+        open file or an iterator of lines.
+    @return: C{True} if C{blastFile} is the name of an uncompressed file.
+    """
+    if not isFilename(blastFile):
+        return False
+    with open(blastFile, 'rb') as fp:
+        return compression(fp) is None
+
+
+def blastLines(blastFile):
+    """
+    Reads the lines of a blast file.
+
+    @param blastFile: the C{str} name of a file, which may be compressed,
+        '-' for standard input, an open file or an iterator of lines.
+        Files that are opened here are closed when all lines have been
+        read, streams that are passed in are left open.
+    @return: A generator of C{str} lines.
+    """
+    if isFilename(blastFile):
+        with openBlastFile(blastFile) as fp:
+            for line in fp:
+                yield line
+    else:
+        for line in (sys.stdin if blastFile == STDIN else blastFile):
+            yield line
+
+
+def jsonRecords(blastFile, decode=loads):
+    """
+    Reads the records of a JSON blast file, skipping the parameters line.
+
+    @param blastFile: the C{str} name of a file, '-' for standard input, an
+        open file or an iterator of lines (see blastLines).
+    @param decode: a function that converts a line to a record, raising
+        C{ValueError} if it cannot. Give one that only decodes the fields
+        that are needed to avoid decoding every alignment.
+    @raise ValueError: If the file is empty or a line cannot be converted
+        to JSON.
+    @return: A generator of C{dict}s (or what C{decode} returns), one per
+        read.
+    """
+    lines = blastLines(blastFile)
+    if next(lines, None) is None:
+        raise ValueError('JSON file %r was empty.' % blastName(blastFile))
+    for lineNumber, line in enumerate(lines, start=2):
+        if not line.strip():
+            continue
+        try:
+            record = decode(line)
+        except ValueError as e:
+            raise ValueError('Could not convert line %d of %r to JSON '
+                             '(%s).' % (lineNumber, blastName(blastFile), e))
+        yield record
+
+
+def convertDictToBlastRecord(record):
+    """
+    Makes a Bio.Blast record from a JSON blast record, as done by
+    dark.conversion.JSONRecordsReader.
+
+    @param record: a C{dict} decoded from a line of JSON blast output.
+    @return: a C{Bio.Blast.Record.Blast} instance.
+    """
+    alignments = []
+    for alignment in record['alignments']:
+        alignmentInstance = Record.Alignment()
+        alignmentInstance.accession = None
+        alignmentInstance.hit_def = None
+        alignmentInstance.hit_id = None
+        alignmentInstance.length = alignment['length']
+        alignmentInstance.title = alignment['title']
+        for blastHsp in alignment['hsps']:
+            hsp = Record.HSP()
+            hsp.bits = blastHsp['bits']
+            hsp.expect = blastHsp['expect']
+            hsp.frame = blastHsp['frame']
+            hsp.query = blastHsp['query']
+            hsp.query_start = blastHsp['query_start']
+            hsp.query_end = blastHsp['query_end']
+            hsp.sbjct = blastHsp['sbjct']
+            hsp.sbjct_start = blastHsp['sbjct_start']
+            hsp.sbjct_end = blastHsp['sbjct_end']
+            alignmentInstance.hsps.append(hsp)
+        alignments.append(alignmentInstance)
+    blastRecord = Record.Blast()
+    blastRecord.query = record['query']
+    blastRecord.alignments = alignments
+    return blastRecord
+
+
+def records(blastFile):
+    """
+    Reads the Bio.Blast records of a JSON blast file.
+
+    @param blastFile: the C{str} name of a file, '-' for standard input, an
+        open file or an iterator of lines (see blastLines).
+    @raise ValueError: If the file is empty or a line cannot be converted
+        to JSON.
+    @return: A generator of C{Bio.Blast.Record.Blast} instances.
+    """
+    for record in jsonRecords(blastFile):
+        yield convertDictToBlastRecord(record)
+
+
+def bgzfBlocks(filename):
+    """
+    Finds the blocks of a BGZF file, reading only their headers.
+
+    @param filename: the C{str} name of a BGZF file.
+    @raise ValueError: If the file is not BGZF.
+    @return: a C{list} of (offset, size) tuples giving the position and the
+        compressed size of each block in the file.
+    """
+    blocks = []
+    offset = 0
+    with open(filename, 'rb') as fp:
+        while True:
+            header = fp.read(64)
+            if not header:
+                break
+            size = _bgzfBlockSize(header)
+            if size is None:
+                raise ValueError('File %r is not BGZF (bad block at offset '
+                                 '%d).' % (filename, offset))
+            blocks.append((offset, size))
+            offset += size
+            fp.seek(offset)
+    return blocks
+
+
+def readBgzfBlocks(filename, blocks):
+    """
+    Decompresses some of the blocks of a BGZF file.
+
+    @param filename: the C{str} name of a BGZF file.
+    @param blocks: a C{list} of consecutive (offset, size) tuples, as
+        returned by bgzfBlocks.
+    @return: a C{str} with the decompressed data of the blocks.
+    """
+    if not blocks:
+        return ''
+    start = blocks[0][0]
+    end = blocks[-1][0] + blocks[-1][1]
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    # Each block is a complete gzip member.
+    return ''.join(zlib.decompress(data[offset - start:
+                                        offset - start + size],
+                                   16 + zlib.MAX_WBITS)
+                   for offset, size in blocks)
+
+
+def chunkRanges(filename, chunkSize=CHUNK_SIZE):
+    """
+    Splits the records of an uncompressed JSON blast file into byte ranges
+    of about C{chunkSize} bytes that start and end on line boundaries. The
+    parameters line is not in any range.
+
+    @param filename: the C{str} name of the file.
+    @param chunkSize: the C{int} approximate size of each range.
+    @raise ValueError: If the file is empty or compressed.
+    @return: a C{list} of (start, end) byte offsets.
+    """
+    size = getsize(filename)
+    with open(filename, 'rb') as fp:
+        if compression(fp):
+            raise ValueError('Compressed file %r cannot be split into '
+                             'chunks.' % filename)
+        if not fp.readline():
+            raise ValueError('JSON file %r was empty.' % filename)
+        offsets = [fp.tell()]
+        while offsets[-1] < size:
+            fp.seek(offsets[-1] + chunkSize - 1)
+            # Move on to the start of the next line (which is where we are
+            # if the byte just read was a newline).
+            fp.readline()
+            offsets.append(min(fp.tell(), size))
+    return zip(offsets, offsets[1:])
+
+
+def chunkRecords(filename, start, end, decode=loads):
+    """
+    Reads the records of a byte range of an uncompressed JSON blast file.
+
+    @param filename: the C{str} name of the file.
+    @param start: the C{int} offset of the start of a line.
+    @param end: the C{int} offset just after the end of a line.
+    @param decode: a function that converts a line to a record, as for
+        jsonRecords.
+    @raise ValueError: If a line cannot be converted to JSON.
+    @return: A generator of C{dict}s (or what C{decode} returns), one per
+        read.
+    """
+    with open(filename, 'rb', BUFFER_SIZE) as fp:
+        fp.seek(start)
+        offset = start
+        while offset < end:
+            line = fp.readline()
+            if not line:
+                break
+            if line.strip():
+                try:
+                    yield decode(line)
+                except ValueError as e:
+                    raise ValueError('Could not convert the line at offset '
+                                     '%d of %r to JSON (%s).' %
+                                     (offset, filename, e))
+            offset += len(line)
+
+
+def _reduceChunk(args):
+    """
+    Call a reduce function on the records of a chunk, for use with
+    C{Pool.imap}.
+    """
+    filename, start, end, function, functionArgs, decode = args
+    return function(chunkRecords(filename, start, end, decode),
+                    *functionArgs)
+
+
+def _list(records):
+    """
+    Collect the records of a chunk.
+    """
+    return list(records)
+
+
+def mapChunks(filename, function, args=(), processes=None,
+              chunkSize=CHUNK_SIZE, ordered=True, decode=loads):
+    """
+    Parses an uncompressed JSON blast file in parallel, in chunks.
+
+    Each worker reads the records of one chunk and reduces them with
+    C{function}, so only the (small) partial results are sent back, not the
+    records.
+
+    @param filename: the C{str} name of the file.
+    @param function: a top level function (so it can be pickled) that is
+        called with a generator of the C{dict} records of a chunk followed by
+        C{args}, and returns a partial result for the chunk.
+    @param args: a C{tuple} of further arguments for C{function}.
+    @param processes: The C{int} number of worker processes to use. If
+        C{None}, one process per CPU is used. If 1, the chunks are read in
+        this process.
+    @param chunkSize: the C{int} approximate size in bytes of each chunk.
+    @param ordered: if C{True}, the partial results are given in the order
+        of the chunks in the file. Otherwise they are given as soon as they
+        are ready.
+    @param decode: a top level function that converts a line to a record,
+        as for jsonRecords. C{function} is then called with what it
+        returns instead of C{dict}s.
+    @raise ValueError: If the file is empty or compressed, or a line cannot
+        be converted to JSON.
+    @return: A generator of the partial results of the chunks.
+    """
+    chunkArgs = [(filename, start, end, function, args, decode)
+                 for start, end in chunkRanges(filename, chunkSize)]
+
+    if processes == 1:
+        for result in imap(_reduceChunk, chunkArgs):
+            yield result
+    else:
+        pool = Pool(processes)
+        try:
+            if ordered:
+                results = pool.imap(_reduceChunk, chunkArgs)
+            else:
+                results = pool.imap_unordered(_reduceChunk, chunkArgs)
+            for result in results:
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def parallelJsonRecords(filename, processes=None, chunkSize=CHUNK_SIZE,
+                        ordered=True):
+    """
+    Reads the records of an uncompressed JSON blast file, parsing chunks of
+    it in parallel.
+
+    @param filename: the C{str} name of the file.
+    @param processes: The C{int} number of worker processes to use, as for
+        mapChunks.
+    @param chunkSize: the C{int} approximate size in bytes of each chunk.
+    @param ordered: if C{True}, the records are given in file order.
+    @raise ValueError: If the file is empty or compressed, or a line cannot
+        be converted to JSON.
+    @return: A generator of C{dict}s, one per read.
+    """
+    for records in mapChunks(filename, _list, processes=processes,
+                             chunkSize=chunkSize, ordered=ordered):
+        for record in records:
+            yield record
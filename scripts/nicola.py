@@ -10,16 +10,28 @@ according to species or location of the subject.
 
 
 import matplotlib.pylab as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import font_manager
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
 import numpy as np
+import os
 import re
+import string
+import zlib
 from scipy.cluster.vq import kmeans, vq
 from scipy import stats
 from Bio import SeqIO
-from collections import defaultdict
-from itertools import cycle
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from hashlib import md5
+from itertools import cycle, imap
+from json import dumps, loads
+from multiprocessing import Pool, cpu_count
+from zipfile import BadZipfile
 
-from dark import conversion
 from dark.dimension import dimensionalIterator
+from scripts import blastRecords
 from sklearn.cluster import AgglomerativeClustering, AffinityPropagation
 
 # regexes and lists for coloring
@@ -249,6 +261,120 @@ def _getCountry(title):
         return 'white'
 
 
+_LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_UNICODE_LOWER = dict((ord(upper), ord(lower)) for upper, lower in
+                      zip(string.ascii_uppercase, string.ascii_lowercase))
+
+
+def _asciiLower(title):
+    """
+    Lowercases the ASCII letters of a title, as re.I does when matching.
+
+    @param title: A C{str} or C{unicode} title.
+    @return: The lowercased title.
+    """
+    if isinstance(title, unicode):
+        return title.translate(_UNICODE_LOWER)
+    else:
+        return title.translate(_LOWER)
+
+
+class _BirdClassifier(object):
+    """
+    Finds the colour of a title with one regex holding the words of all
+    groups of birds, instead of searching the title once per group.
+
+    The words are in group priority order in the regex, so the word found
+    at a position is the best one starting there. Searching on from the
+    position after each match finds the best group anywhere in the title,
+    which is the first group (in priority order) whose regex matches it,
+    just as when trying the regexes one by one. Titles are lowercased
+    instead of using re.I, which lets the regex engine skip quickly to the
+    possible first letters of the words.
+
+    @param groups: A C{list} of (regex, colour) tuples in priority order.
+        Each regex must be a case-insensitive alternation of plain words.
+    @param default: The colour of titles that match none of the groups.
+    """
+    def __init__(self, groups, default):
+        self.rules = ([(regex.pattern, color) for regex, color in groups],
+                      default)
+        self._colors = [color for _, color in groups]
+        self._default = default
+        self._priority = {}
+        for index, (regex, _) in enumerate(groups):
+            for word in regex.pattern.lower().split('|'):
+                self._priority.setdefault(word, index)
+        words = sorted(self._priority, key=self._priority.get)
+        self._regex = re.compile('|'.join(map(re.escape, words)))
+
+    def classify(self, title):
+        """
+        Finds the colour of a title.
+
+        @param title: The title of a blastHit.
+        @return: The colour of the first group that matches the title.
+        """
+        title = _asciiLower(title)
+        best = len(self._colors)
+        search = self._regex.search
+        match = search(title)
+        while match:
+            index = self._priority[match.group()]
+            if index < best:
+                best = index
+                if best == 0:
+                    break
+            match = search(title, match.start() + 1)
+        return self._colors[best] if best < len(self._colors) else (
+            self._default)
+
+    def classifyAll(self, titles):
+        """
+        Finds the colours of many titles, classifying repeated titles once.
+
+        @param titles: An iterable of titles.
+        @return: A C{list} with the colour of each title.
+        """
+        colors = {}
+        result = []
+        for title in titles:
+            try:
+                color = colors[title]
+            except KeyError:
+                color = colors[title] = self.classify(title)
+            result.append(color)
+        return result
+
+
+_BIRDCLASSIFIERS = {
+    'all': _BirdClassifier(
+        [(ANSERIFORMESREGEX, ANSERIFORMES),
+         (CHARADRIIFORMESREGEX, CHARADRIIFORMES),
+         (PELICANIFORMESREGEX, PELICANIFORMES),
+         (DOMESTICREGEX, DOMESTIC),
+         (COLUMBIFORMESREGEX, COLUMBIFORMES),
+         (PASSERIFORMESREGEX, PASSERIFORMES),
+         (PSITTATICIFORMESREGEX, PSITTATICIFORMES),
+         (RAPTORREGEX, RAPTOR),
+         (INDETERMINATEHOSTREGEX, INDETERMINATEHOST)],
+        NEITHER),
+    'anseriformes and charadriiformes': _BirdClassifier(
+        [(ANATINAEREGEX, ANATINAE),
+         (AYTHYAREGEX, AYTHYA),
+         (MERGINIREGEX, MERGINI),
+         (TADORNINIREGEX, TADORNINI),
+         (SWANREGEX, SWAN),
+         (GOOSEREGEX, GOOSE),
+         (GULLREGEX, GULL),
+         (TERNREGEX, TERN),
+         (WADERREGEX, WADER),
+         (AUKREGEX, AUK),
+         (DOMESTICREGEX, DOMESTIC)],
+        OTHER),
+}
+
+
 def _getBird(title, colorBy='all'):
     """
     Finds out what colour should be assigned to a title, given
@@ -259,75 +385,391 @@ def _getBird(title, colorBy='all'):
         by all taxonomic groups ('all') or color by anseriformes
         and charadriiformes ('anseriformes and charadriiformes').
     """
-    if colorBy == 'anseriformes and charadriiformes':
-        anatinae = ANATINAEREGEX.search(title)
-        aythya = AYTHYAREGEX.search(title)
-        mergini = MERGINIREGEX.search(title)
-        tadornini = TADORNINIREGEX.search(title)
-        swan = SWANREGEX.search(title)
-        goose = GOOSEREGEX.search(title)
-        gull = GULLREGEX.search(title)
-        tern = TERNREGEX.search(title)
-        wader = WADERREGEX.search(title)
-        auk = AUKREGEX.search(title)
-        domestic = DOMESTICREGEX.search(title)
-
-        if anatinae:
-            return ANATINAE
-        elif aythya:
-            return AYTHYA
-        elif mergini:
-            return MERGINI
-        elif tadornini:
-            return TADORNINI
-        elif swan:
-            return SWAN
-        elif goose:
-            return GOOSE
-        elif gull:
-            return GULL
-        elif tern:
-            return TERN
-        elif wader:
-            return WADER
-        elif auk:
-            return AUK
-        elif domestic:
-            return DOMESTIC
-        else:
-            return OTHER
-
-    elif colorBy == 'all':
-        anseriformes = ANSERIFORMESREGEX.search(title)
-        charadriiformes = CHARADRIIFORMESREGEX.search(title)
-        pelicaniformes = PELICANIFORMESREGEX.search(title)
-        domestic = DOMESTICREGEX.search(title)
-        columbiformes = COLUMBIFORMESREGEX.search(title)
-        passeriformes = PASSERIFORMESREGEX.search(title)
-        psittaticiformes = PSITTATICIFORMESREGEX.search(title)
-        raptor = RAPTORREGEX.search(title)
-        indetermined = INDETERMINATEHOSTREGEX.search(title)
-
-        if anseriformes:
-            return ANSERIFORMES
-        elif charadriiformes:
-            return CHARADRIIFORMES
-        elif pelicaniformes:
-            return PELICANIFORMES
-        elif domestic:
-            return DOMESTIC
-        elif columbiformes:
-            return COLUMBIFORMES
-        elif passeriformes:
-            return PASSERIFORMES
-        elif psittaticiformes:
-            return PSITTATICIFORMES
-        elif raptor:
-            return RAPTOR
-        elif indetermined:
-            return INDETERMINATEHOST
+    try:
+        classifier = _BIRDCLASSIFIERS[colorBy]
+    except KeyError:
+        return None
+    return classifier.classify(title)
+
+
+def _getBirds(titles, colorBy='all'):
+    """
+    Finds out what colour should be assigned to each of a list of titles,
+    as done by _getBird.
+
+    @param titles: An iterable of titles of blastHits.
+    @param colorBy: How the coloring should be done, as for _getBird.
+
+    @return: A C{list} with the colour of each title.
+    """
+    try:
+        classifier = _BIRDCLASSIFIERS[colorBy]
+    except KeyError:
+        return [None for _ in titles]
+    return classifier.classifyAll(titles)
+
+
+def _shortTitle(title):
+    """
+    Makes the short title shown under a dot in distancePlot.
+
+    @param title: The title of a blastHit, of the form
+        gb:<accession>|Organism:Influenza A virus (<strain>)|<strain
+        name>|Segment:<segment>|...
+    @return: A C{str} short title, or the title itself if it does not have
+        that form.
+    """
+    splitted = title.split('|')
+    try:
+        return splitted[1][26:] + '/' + splitted[3][8:]
+    except IndexError:
+        return title
+
+
+TitleAnnotation = namedtuple('TitleAnnotation', ['bird', 'continent',
+                                                 'shortTitle'])
+
+
+class TitleAnnotations(object):
+    """
+    An LRU cache of the annotations of titles. The same subject titles are
+    hit in the alignments of many records, so their bird colour, continent
+    colour and short title are only worked out once.
+
+    @param size: The C{int} maximum number of annotations to keep. When the
+        cache is full, the least recently used annotation is dropped.
+    @raise ValueError: If C{size} is less than one.
+    """
+    def __init__(self, size=100000):
+        if size < 1:
+            raise ValueError('Cache size must be at least 1 (got %r).' % size)
+        self._size = size
+        self._cache = OrderedDict()
+        self.table = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tableHits = 0
+
+    def annotate(self, title, colorBy='all'):
+        """
+        Gets the annotation of a title.
+
+        @param title: The title of a blastHit.
+        @param colorBy: How the bird coloring should be done, as for
+            _getBird.
+        @return: A C{TitleAnnotation} with the bird colour (as given by
+            _getBird), the continent colour (as given by _getCountry for the
+            short title) and the short title.
+        """
+        if self.table is not None:
+            annotation = self.table.annotate(title, colorBy)
+            if annotation is not None:
+                self.tableHits += 1
+                return annotation
+
+        key = (title, colorBy)
+        try:
+            annotation = self._cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            shortTitle = _shortTitle(title)
+            annotation = TitleAnnotation(_getBird(title, colorBy),
+                                         _getCountry(shortTitle), shortTitle)
+            if len(self._cache) >= self._size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
         else:
-            return NEITHER
+            self.hits += 1
+        self._cache[key] = annotation
+        return annotation
+
+    def annotateAll(self, titles, colorBy='all'):
+        """
+        Gets the annotations of many titles.
+
+        @param titles: An iterable of titles of blastHits.
+        @param colorBy: How the bird coloring should be done, as for
+            _getBird.
+        @return: A C{list} of C{TitleAnnotation}s.
+        """
+        return [self.annotate(title, colorBy) for title in titles]
+
+    def resize(self, size):
+        """
+        Changes the maximum number of annotations kept, dropping the least
+        recently used ones if there are too many.
+
+        @param size: The new C{int} maximum number of annotations.
+        @raise ValueError: If C{size} is less than one.
+        """
+        if size < 1:
+            raise ValueError('Cache size must be at least 1 (got %r).' % size)
+        self._size = size
+        while len(self._cache) > size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drops all annotations and resets the statistics.
+        """
+        self._cache.clear()
+        self.hits = self.misses = self.evictions = self.tableHits = 0
+
+    def stats(self):
+        """
+        Gets the statistics of the cache, to help choose its size.
+
+        @return: A C{dict} with the number of 'hits', 'misses' and
+            'evictions', the 'hitRate', the current 'length' and maximum
+            'size' of the cache, and the number of 'tableHits' of titles
+            found in the annotation table (see useTitleAnnotationTable),
+            which are not cached.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'tableHits': self.tableHits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hitRate': float(self.hits) / lookups if lookups else 0.0,
+            'length': len(self._cache),
+            'size': self._size,
+        }
+
+
+# The title annotations shared by the functions below.
+TITLEANNOTATIONS = TitleAnnotations()
+
+
+def _annotationRulesFingerprint():
+    """
+    Makes a fingerprint of the rules used to annotate titles, so that an
+    annotation table can be rebuilt when they change.
+
+    @return: A C{str} hex digest.
+    """
+    rules = (
+        sorted((colorBy, classifier.rules)
+               for colorBy, classifier in _BIRDCLASSIFIERS.iteritems()),
+        EURASIAREGEX, NORTHAMERICAREGEX, SOUTHAMERICAREGEX, AFRICAREGEX,
+        EURASIA, NORTHAMERICA, SOUTHAMERICA, AFRICA,
+        [(function.__code__.co_code, function.__code__.co_consts)
+         for function in (_getCountry, _shortTitle)],
+    )
+    return md5(repr(rules)).hexdigest()
+
+
+def _joinTitles(titles):
+    """
+    Joins titles into one array of UTF-8 encoded bytes, to store them
+    compactly.
+    """
+    joined = '\n'.join(title.encode('utf-8') if isinstance(title, unicode)
+                       else title for title in titles)
+    return np.frombuffer(joined, dtype=np.uint8) if joined else (
+        np.zeros(0, dtype=np.uint8))
+
+
+def _splitTitles(array):
+    """
+    Splits an array made by _joinTitles back into titles.
+    """
+    joined = array.tostring().decode('utf-8', 'replace')
+    return joined.split('\n') if joined else []
+
+
+def _codes(values):
+    """
+    Encodes values as small integer codes.
+
+    @param values: A C{list} of values, of which there must be fewer than
+        256 different ones.
+    @return: A C{numpy.ndarray} of C{uint8} codes and a C{list} of the JSON
+        encoded value of each code.
+    """
+    palette = sorted(set(values))
+    codeOf = dict((value, code) for code, value in enumerate(palette))
+    return (np.array([codeOf[value] for value in values], dtype=np.uint8),
+            [dumps(value) for value in palette])
+
+
+class TitleAnnotationTable(object):
+    """
+    The annotations of all titles of a reference database, as made by
+    makeTitleAnnotationTable. Each title has an ID (its position in the
+    database), and for each ID a host code per way of coloring, a continent
+    code and a short title.
+
+    @param tableFile: The C{str} name of the table file.
+    """
+    def __init__(self, tableFile):
+        with np.load(tableFile) as table:
+            self.fingerprint = str(table['fingerprint'])
+            self.titles = _splitTitles(table['titles'])
+            self.shortTitles = _splitTitles(table['shortTitles'])
+            self.colorBys = map(str, table['colorBys'])
+            self.birdCodes = dict(zip(self.colorBys, table['birdCodes']))
+            self.birdPalettes = dict(
+                (colorBy, map(loads, palette)) for colorBy, palette in
+                zip(self.colorBys, table['birdPalettes']))
+            self.continentCodes = table['continentCodes']
+            self.continentPalette = map(loads, table['continentPalette'])
+            self.source = (str(table['path']), int(table['size']),
+                           float(table['mtime']))
+        self._ids = dict((title, titleId)
+                         for titleId, title in enumerate(self.titles))
+
+    def __len__(self):
+        return len(self.titles)
+
+    def titleId(self, title):
+        """
+        Gets the ID of a title.
+
+        @param title: The title of a blastHit.
+        @return: The C{int} ID of the title, or C{None} if it is not in the
+            table.
+        """
+        return self._ids.get(title)
+
+    def annotate(self, title, colorBy='all'):
+        """
+        Gets the annotation of a title.
+
+        @param title: The title of a blastHit.
+        @param colorBy: How the bird coloring should be done, as for
+            _getBird.
+        @return: A C{TitleAnnotation}, or C{None} if the title or the way of
+            coloring is not in the table.
+        """
+        titleId = self._ids.get(title)
+        if titleId is None or colorBy not in self.birdCodes:
+            return None
+        return TitleAnnotation(
+            self.birdPalettes[colorBy][self.birdCodes[colorBy][titleId]],
+            self.continentPalette[self.continentCodes[titleId]],
+            self.shortTitles[titleId])
+
+
+def titleAnnotationTableFilename(fastaName):
+    """
+    Gets the name of the annotation table stored next to a reference
+    database.
+
+    @param fastaName: The C{str} name of a FASTA file.
+    @return: A C{str} file name.
+    """
+    return fastaName + '.titles.npz'
+
+
+def makeTitleAnnotationTable(fastaName, tableFile=None):
+    """
+    Annotates all titles of a reference database once, with the rules of
+    _getBird (for every way of coloring), _getCountry and the short titles
+    of distancePlot, and stores the annotations in a table file.
+
+    @param fastaName: The C{str} name of a FASTA file.
+    @param tableFile: The C{str} name of the table file to write. If
+        C{None}, the table is stored next to the FASTA file (see
+        titleAnnotationTableFilename).
+    @return: The C{TitleAnnotationTable} that was written.
+    """
+    tableFile = tableFile or titleAnnotationTableFilename(fastaName)
+    titles = [record.description
+              for record in SeqIO.parse(fastaName, 'fasta')]
+    shortTitles = [_shortTitle(title) for title in titles]
+    colorBys = sorted(_BIRDCLASSIFIERS)
+    birdCodes = []
+    birdPalettes = []
+    for colorBy in colorBys:
+        codes, palette = _codes(_getBirds(titles, colorBy))
+        birdCodes.append(codes)
+        birdPalettes.append(palette)
+    # Pad the palettes to the same length so they fit in one array.
+    paletteLength = max(len(palette) for palette in birdPalettes)
+    birdPalettes = [palette + [dumps(None)] * (paletteLength - len(palette))
+                    for palette in birdPalettes]
+    continentCodes, continentPalette = _codes(
+        [_getCountry(shortTitle) for shortTitle in shortTitles])
+    stat = os.stat(fastaName)
+
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partial table.
+    tmpFile = '%s.%d.tmp' % (tableFile, os.getpid())
+    with open(tmpFile, 'wb') as fp:
+        np.savez_compressed(
+            fp, fingerprint=_annotationRulesFingerprint(),
+            path=os.path.abspath(fastaName), size=stat.st_size,
+            mtime=stat.st_mtime, titles=_joinTitles(titles),
+            shortTitles=_joinTitles(shortTitles), colorBys=colorBys,
+            birdCodes=np.array(birdCodes, dtype=np.uint8).reshape(
+                len(colorBys), len(titles)),
+            birdPalettes=birdPalettes, continentCodes=continentCodes,
+            continentPalette=continentPalette)
+    os.rename(tmpFile, tableFile)
+
+    return TitleAnnotationTable(tableFile)
+
+
+def loadTitleAnnotationTable(fastaName, tableFile=None, rebuild=True):
+    """
+    Loads the annotation table of a reference database, making it if it is
+    missing or damaged, or if the database or the annotation rules have
+    changed since it was made.
+
+    @param fastaName: The C{str} name of a FASTA file.
+    @param tableFile: The C{str} name of the table file. If C{None}, the
+        table next to the FASTA file is used.
+    @param rebuild: If C{False}, never make the table.
+    @raise ValueError: If C{rebuild} is C{False} and there is no up to date
+        table.
+    @return: A C{TitleAnnotationTable}.
+    """
+    tableFile = tableFile or titleAnnotationTableFilename(fastaName)
+    stat = os.stat(fastaName)
+    try:
+        table = TitleAnnotationTable(tableFile)
+    except (IOError, BadZipfile, KeyError, ValueError, zlib.error):
+        # A missing, damaged or old format table is made again, like one
+        # made with other rules.
+        pass
+    else:
+        if (table.fingerprint == _annotationRulesFingerprint() and
+                table.source == (os.path.abspath(fastaName), stat.st_size,
+                                 stat.st_mtime)):
+            return table
+
+    if not rebuild:
+        raise ValueError('No up to date title annotation table %r for %r.' %
+                         (tableFile, fastaName))
+
+    return makeTitleAnnotationTable(fastaName, tableFile)
+
+
+def useTitleAnnotationTable(fastaName, tableFile=None, rebuild=True):
+    """
+    Makes the functions of this module take the annotations of the titles of
+    a reference database from its annotation table, instead of working them
+    out with regexes. Titles that are not in the table are still annotated
+    (and cached) as before.
+
+    @param fastaName: The C{str} name of a FASTA file, or C{None} to stop
+        using a table.
+    @param tableFile: The C{str} name of the table file, as for
+        loadTitleAnnotationTable.
+    @param rebuild: If C{False}, never make the table.
+    @raise ValueError: If C{rebuild} is C{False} and there is no up to date
+        table.
+    @return: The C{TitleAnnotationTable} in use, or C{None}.
+    """
+    if fastaName is None:
+        TITLEANNOTATIONS.table = None
+    else:
+        TITLEANNOTATIONS.table = loadTitleAnnotationTable(
+            fastaName, tableFile, rebuild)
+    return TITLEANNOTATIONS.table
 
 
 def computePercentId(alignment):
@@ -350,49 +792,135 @@ def computePercentId(alignment):
     return identity
 
 
+# The denominators computePercentIds can use.
+PERCENTID_DENOMINATORS = ('columns', 'ungapped', 'alignmentLength')
+
+_GAP = ord('-')
+
+
+def computePercentIds(alignments, denominator='columns'):
+    """
+    Calculates the percent sequence identity of many alignments at once,
+    comparing the bytes of all their sequences with numpy instead of one
+    character at a time. The alignments can come from one record or from
+    any number of records.
+
+    @param alignments: An iterable of C{Bio.Blast.Record.Blast.Alignment}
+        instances. The first HSP of each is used, as in computePercentId.
+    @param denominator: What the number of identical bases is divided by.
+        With 'columns', the number of columns of the alignment (the length
+        of the aligned query), which gives the same results as
+        computePercentId. With 'ungapped', the number of columns where
+        neither sequence has a gap, and columns with gaps are not counted
+        as identical. With 'alignmentLength', the length of the subject
+        (C{alignment.length}).
+    @raise ValueError: If C{denominator} is not known.
+
+    @return: A C{numpy.ndarray} of C{float} percent identities, with C{nan}
+        for alignments with a denominator of 0.
+    """
+    if denominator not in PERCENTID_DENOMINATORS:
+        raise ValueError('Unknown percent identity denominator %r.' %
+                         (denominator,))
+
+    alignments = list(alignments)
+    queries = []
+    subjects = []
+    for alignment in alignments:
+        hsp = alignment.hsps[0]
+        queries.append(hsp.query)
+        subjects.append(hsp.sbjct)
+
+    queryLengths = np.array(map(len, queries), dtype=int)
+    subjectLengths = np.array(map(len, subjects), dtype=int)
+    compared = np.minimum(queryLengths, subjectLengths)
+    if (compared != queryLengths).any() or (compared != subjectLengths).any():
+        # Like zip, only compare as far as the shorter sequence goes.
+        queries = [query[:length] for query, length in zip(queries, compared)]
+        subjects = [subject[:length]
+                    for subject, length in zip(subjects, compared)]
+
+    try:
+        queryBytes = np.frombuffer(str(''.join(queries)), dtype=np.uint8)
+        subjectBytes = np.frombuffer(str(''.join(subjects)), dtype=np.uint8)
+    except UnicodeEncodeError:
+        # Not ASCII, so bytes cannot stand for characters.
+        if denominator != 'columns':
+            raise ValueError('Only the columns denominator can be used for '
+                             'sequences that are not ASCII.')
+        return np.array(map(computePercentId, alignments), dtype=float)
+
+    # Lay the sequences out as the rows of two arrays. Rows of the shorter
+    # sequences are padded with bytes that never match, and the subject
+    # padding is a gap so that it is not counted as an ungapped column.
+    if len(compared) and (compared == compared[0]).all():
+        shape = (len(compared), compared[0])
+        queryBytes = queryBytes.reshape(shape)
+        subjectBytes = subjectBytes.reshape(shape)
+    else:
+        width = compared.max() if len(compared) else 0
+        inside = np.arange(width) < compared[:, np.newaxis]
+        paddedQuery = np.zeros(inside.shape, dtype=np.uint8)
+        paddedQuery[inside] = queryBytes
+        queryBytes = paddedQuery
+        paddedSubject = np.empty(inside.shape, dtype=np.uint8)
+        paddedSubject.fill(_GAP)
+        paddedSubject[inside] = subjectBytes
+        subjectBytes = paddedSubject
+
+    identical = queryBytes == subjectBytes
+    if denominator == 'ungapped':
+        ungapped = (queryBytes != _GAP) & (subjectBytes != _GAP)
+        identical &= ungapped
+
+    if denominator == 'columns':
+        lengths = queryLengths
+    elif denominator == 'ungapped':
+        lengths = ungapped.sum(axis=1)
+    else:
+        lengths = np.array([alignment.length for alignment in alignments],
+                           dtype=int)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        identity = identical.sum(axis=1) / lengths.astype(float) * 100
+    identity[lengths == 0] = np.nan
+    return identity
+
+
 def _records(blastFilename):
     """
-    Generate blast records from a json file.
+    Generate blast records from a json file, which may be compressed with
+    gzip, BGZF, bzip2 or xz.
     """
-    reader = conversion.JSONRecordsReader(blastFilename)
-    for record in reader.records():
-        yield record
+    return blastRecords.records(blastFilename)
 
 
 # functions for working with distance graphs
 
-def distancePlot(record, distance='bit', colorBy='all', continents=True,
-                 imageFile=False, createFigure=True, showFigure=False,
-                 readsAx=False):
+def _plotDistances(ax, record, distance, colorBy, continents, labels,
+                   tickLabels=True):
     """
-    Produces a rectangular panel of graphs that each show sorted distances for
-    a read. Read hits against a certain strain (see find, below) are
-    highlighted.
+    Draw the sorted distances of the hits of a read, for distancePlot.
 
+    @param ax: The matplotlib axes to draw on.
     @param record: A C{readAlingments} instance.
-    @param distance: The measure of distance read out from the blastFile,
-        either 'bit' of 'percentId'.
-    @param colorBy: How the coloring should be done. Either color
-        by all taxonomic groups ('all') or color by anseriformes
-        and charadriiformes ('anseriformes and charadriiformes').
+    @param distance: The measure of distance, either 'bit' or 'percentId'.
+    @param colorBy: How the dots should be colored, as for distancePlot.
     @param continents: if C{bool} True, color the backgound of each title by
         which continent the title is from.
-    @param imageFile: a C{string} filename where the figure should be saved to.
-    @param readsAx: If not None, use this as the subplot for displaying reads.
+    @param labels: if C{bool} True, give the axes a title and a y label.
+    @param tickLabels: if C{bool} True, label each hit with its short title.
 
-    @return: Returns the largest distance, and the number of distances that
-        were plotted.
+    @return: The largest distance, and the number of distances that were
+        plotted.
     """
     alignments = record.alignments
     title = str(record.query)
 
-    fig = plt.figure(figsize=(30, 10))
-    ax = readsAx or fig.add_subplot(111)
-
     if distance != 'bit':
-        for alignment in alignments:
-            distance = computePercentId(alignment)
-            alignment.hsps[0].bits = distance
+        identities = computePercentIds(alignments)
+        for alignment, identity in zip(alignments, identities.tolist()):
+            alignment.hsps[0].bits = identity
 
     sortedAlignments = sorted(alignments,
                               key=lambda k: k.hsps[0].bits,
@@ -406,45 +934,265 @@ def distancePlot(record, distance='bit', colorBy='all', continents=True,
         titles.append(alignment.title)
 
     x = np.arange(0, len(distances))
+    # Lines, bands and labels that span the height of the axes.
+    spanTransform = ax.get_xaxis_transform()
 
     # plot black line with distance
     ax.plot(x, distances, 'k', linewidth=0.5)
     ax.yaxis.grid(linewidth=0.1, color='k', linestyle='--')
-    for item in np.arange(0, len(distances), 10):
-        plt.axvline(item, linewidth=0.1, color='k', linestyle='--')
-    plt.title(title + '\n', fontsize=20)
-    plt.ylabel('Bit scores' if distance == 'bit' else '% id', fontsize=15)
-    # plot green and red dots denoting gulls and ducks
-    for i, alignment in enumerate(sortedAlignments):
-        title = alignment.title
-        y = distances[i]
-        bird = _getBird(title, colorBy=colorBy)
-        ax.plot([i], [y], markerfacecolor=bird, marker='o', markersize=3,
-                markeredgecolor=bird)
-    plt.xticks(np.arange(0, len(distances), 1.0), fontsize=4)
-    #if not readsAx:
-    titlesToPlot = []
-    for title in titles:
-        splitted = title.split('|')
-        titlesToPlot.append(splitted[1][26:] + '/' + splitted[3][8:])
-    ax.set_xticklabels(titlesToPlot, rotation=270, fontsize=4)
+    ax.vlines(np.arange(0, len(distances), 10), 0, 1,
+              transform=spanTransform, linewidth=0.1, color='k',
+              linestyle='--')
+    if labels:
+        ax.set_title(title + '\n', fontsize=20)
+        ax.set_ylabel('Bit scores' if distance == 'bit' else '% id',
+                      fontsize=15)
+    annotations = TITLEANNOTATIONS.annotateAll(titles, colorBy=colorBy)
+    # plot green and red dots denoting gulls and ducks, drawn over the line
+    # as the markers of a plot would be.
+    birds = [annotation.bird for annotation in annotations]
+    ax.scatter(x, distances, s=9, c=birds, edgecolors=birds, marker='o',
+               linewidths=plt.rcParams['lines.markeredgewidth'], zorder=2)
+    if tickLabels:
+        ax.set_xticks(x)
+        titlesToPlot = [annotation.shortTitle for annotation in annotations]
+        ax.set_xticklabels(titlesToPlot, rotation=270, fontsize=4)
 
     if continents:
-        for i, shortTitle in enumerate(titlesToPlot):
-            country = _getCountry(shortTitle)
-            ax.axvspan(i-0.5, i+0.5, color=country, linewidth=0.5)
+        colors = [annotation.continent for annotation in annotations]
+        bands = PolyCollection(
+            [[(i - 0.5, 0), (i - 0.5, 1), (i + 0.5, 1), (i + 0.5, 0)]
+             for i in x],
+            facecolors=colors, edgecolors=colors, linewidths=0.5,
+            transform=spanTransform, zorder=1)
+        ax.add_collection(bands)
+
+    # The collections would widen the data limits by the height of the
+    # axes and the size of the dots, so take the limits from the line and
+    # the ends of the bands.
+    ax.relim()
+    if continents and len(x):
+        ax.update_datalim([(-0.5, 0), (len(x) - 0.5, 0)], updatey=False)
+    ax.autoscale_view()
+
+    return distances[0], len(distances)
+
+
+def distancePlot(record, distance='bit', colorBy='all', continents=True,
+                 imageFile=False, createFigure=True, showFigure=False,
+                 readsAx=False):
+    """
+    Produces a rectangular panel of graphs that each show sorted distances for
+    a read. Read hits against a certain strain (see find, below) are
+    highlighted.
+
+    @param record: A C{readAlingments} instance.
+    @param distance: The measure of distance read out from the blastFile,
+        either 'bit' of 'percentId'.
+    @param colorBy: How the coloring should be done. Either color
+        by all taxonomic groups ('all') or color by anseriformes
+        and charadriiformes ('anseriformes and charadriiformes').
+    @param continents: if C{bool} True, color the backgound of each title by
+        which continent the title is from.
+    @param imageFile: a C{string} filename where the figure should be saved to.
+        Once saved, a figure made by this function is closed, unless it is
+        also shown.
+    @param readsAx: If not None, use this as the subplot for displaying reads.
+        No figure is made then, and the figure of C{readsAx} is left open.
+
+    @return: Returns the largest distance, and the number of distances that
+        were plotted.
+    """
+    if readsAx:
+        fig = readsAx.figure
+        ax = readsAx
+    else:
+        fig = plt.figure(figsize=(30, 10))
+        ax = fig.add_subplot(111)
+    result = _plotDistances(ax, record, distance, colorBy, continents,
+                            labels=not readsAx)
 
     if createFigure:
         if showFigure:
             plt.show()
         if imageFile:
             fig.savefig(imageFile, bbox_inches='tight')
+            if not (readsAx or showFigure):
+                plt.close(fig)
 
-    return distances[0], len(distances)
+    return result
+
+
+def _renderTile(args):
+    """
+    Draw the distance plot of a read with the headless Agg backend and save
+    it, for use with C{Pool.imap} by distancePanel. No pyplot figures are
+    made, so this is safe in worker processes whatever backend the parent
+    uses.
+
+    @param args: A C{tuple} of the C{dict} JSON blast record of the read,
+        the C{str} name of the file to save the plot to, and the distance,
+        colorBy and continents arguments of distancePlot.
+
+    @return: The largest distance, and the number of distances that were
+        plotted.
+    """
+    record, imageFile, distance, colorBy, continents = args
+    figure = Figure(figsize=(30, 10))
+    FigureCanvasAgg(figure)
+    try:
+        ax = figure.add_subplot(111)
+        result = _plotDistances(
+            ax, blastRecords.convertDictToBlastRecord(record), distance,
+            colorBy, continents, labels=True)
+        figure.savefig(imageFile, bbox_inches='tight')
+    finally:
+        # The figure and its canvas refer to each other, so free the
+        # artists now rather than when the garbage collector runs.
+        figure.clear()
+    return result
+
+
+def _initTileWorker():
+    """
+    Forget the fonts loaded before the worker process was forked. Their open
+    files are shared with the parent, so reading glyphs from them in several
+    processes at once fails.
+    """
+    getFont = getattr(font_manager, '_get_font', None)
+    if getFont is not None and hasattr(getFont, 'cache_clear'):
+        getFont.cache_clear()
+
+
+def _tileRecords(blastName, matrix):
+    """
+    Find the JSON blast records of the reads that have a place in a panel.
+
+    @param blastName: File with blast output.
+    @param matrix: A C{dict} of the (row, col) of each query in the panel.
+
+    @return: A generator of ((query, row, col), record) tuples, in the order
+        of the reads in the blast file.
+    """
+    for record in blastRecords.jsonRecords(blastName):
+        query = record['query']
+        try:
+            coordinates = matrix[query]
+            row = coordinates[0]
+            col = coordinates[1]
+        except KeyError:
+            # if that record is not present in matrix, leave it out.
+            continue
+        yield (query, row, col), record
+
+
+def _mapTiles(tasks, function, processes):
+    """
+    Call a function for each tile of a panel, in worker processes.
+
+    @param tasks: An iterable of (tile, args) tuples.
+    @param function: A top level function (so it can be pickled) that is
+        called with the C{args} of each task.
+    @param processes: The C{int} number of worker processes to use. If
+        C{None}, one process per CPU is used. If 1, the function is called
+        in this process.
+
+    @return: A generator of (tile, result) tuples, in the order of the tasks.
+    """
+    if processes == 1:
+        for tile, args in tasks:
+            yield tile, function(args)
+        return
+
+    pool = Pool(processes, _initTileWorker)
+    # Only give the workers a few tasks each at a time, so the records are
+    # not all read into memory before they are rendered.
+    window = 2 * (processes or cpu_count())
+    pending = deque()
+    try:
+        for tile, args in tasks:
+            pending.append((tile, pool.apply_async(function, (args,))))
+            if len(pending) >= window:
+                tile, result = pending.popleft()
+                yield tile, result.get()
+        while pending:
+            tile, result = pending.popleft()
+            yield tile, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _renderedTiles(blastName, matrix, outputDir, distance, colorBy,
+                   continents, processes):
+    """
+    Save the distance plots of the reads in C{matrix} to C{outputDir},
+    rendering them in worker processes, for distancePanel.
+
+    @param processes: The C{int} number of worker processes to use, as for
+        _mapTiles.
+
+    @return: A generator of (query, row, col, largest distance, number of
+        distances) tuples, in the order of the reads in the blast file.
+    """
+    tasks = (((query, row, col),
+              (record, '%s%d-%d.svg' % (outputDir, row, col), distance,
+               colorBy, continents))
+             for (query, row, col), record in _tileRecords(blastName,
+                                                           matrix))
+    for tile, result in _mapTiles(tasks, _renderTile, processes):
+        yield tile + result
+
+
+def _panelTiles(blastName, matrix, ax, distance, colorBy, continents):
+    """
+    Draw the distance plots of the reads in C{matrix} on the axes of a
+    panel, for distancePanel.
+
+    @return: A generator of (query, row, col, largest distance, number of
+        distances) tuples, in the order of the reads in the blast file.
+    """
+    for record in _records(blastName):
+        query = record.query
+        try:
+            coordinates = matrix[query]
+            row = coordinates[0]
+            col = coordinates[1]
+        except KeyError:
+            # if that record is not present in matrix, leave it out.
+            continue
+        localMaxDistance, numberOfReads = distancePlot(
+            record, colorBy=colorBy, continents=continents,
+            distance=distance, showFigure=False, createFigure=True,
+            imageFile=False, readsAx=ax[row][col])
+        yield query, row, col, localMaxDistance, numberOfReads
+
+
+def _tileTitle(query, numberOfReads):
+    """
+    Make the title of the distance plot of a read in a panel.
+
+    @param query: The C{str} query of the read.
+    @param numberOfReads: The C{int} number of distances that were plotted.
+
+    @return: A C{str} title with the segment, number of reads and subtype on
+        one line and the strain on the next.
+    """
+    try:
+        title = query.split('(')[1]
+        subtype = query.split('(')[2][:-2]
+        segment = query.split(' ')[0]
+    except IndexError:
+        # this is for one title which doesn't fit the usual format
+        segment = 'Segment 2'
+        subtype = 'H3N8'
+        title = query
+    return '%s, %d, %s \n %s' % (segment, numberOfReads, subtype, title)
 
 
 def distancePanel(blastName, matrix, distance='bit', colorBy='all',
-                  continents=True, outputDir=False):
+                  continents=True, outputDir=False, processes=1,
+                  panel=True):
     """
     Make a panel of distance plots generated with the distancePlot
     function above.
@@ -461,49 +1209,45 @@ def distancePanel(blastName, matrix, distance='bit', colorBy='all',
         which continent the title is from.
     @param outputDir: if not C{bool} false,a C{str} of where the
         individual panels should be written to.
+    @param processes: The C{int} number of worker processes that render the
+        individual panels when C{outputDir} is given. If C{None}, one
+        process per CPU is used. If 1, they are rendered in this process.
+    @param panel: if C{bool} False, only write the individual panels to
+        C{outputDir}, without making the panel figure. Each individual panel
+        is freed as soon as it is written, so memory use does not grow with
+        the number of reads.
+    @raise ValueError: If C{panel} is False and no C{outputDir} is given.
+
+    @return: The largest distance and the largest number of reads of the
+        individual panels.
     """
     cols = 8
     rows = 53
-    figure, ax = plt.subplots(rows, cols, squeeze=False)
     maxDistance = 0
     maxReads = 0
-    allRecords = _records(blastName)
-    count = 0
-    for record in allRecords:
-        query = record.query
-        print count, query
-        try:
-            coordinates = matrix[query]
-            row = coordinates[0]
-            col = coordinates[1]
-        except KeyError:
-            # if that record is not present in matrix, leave it out.
-            continue
-        if outputDir:
-            figureTitle = '%s%d-%d.svg' % (outputDir, row, col)
-            localMaxDistance, numberOfReads = distancePlot(
-                record, colorBy=colorBy, continents=continents,
-                distance=distance, showFigure=False, createFigure=False,
-                imageFile=figureTitle, readsAx=None)
-        else:
-            localMaxDistance, numberOfReads = distancePlot(
-                record, colorBy=colorBy, continents=continents,
-                distance=distance, showFigure=False, createFigure=True,
-                imageFile=False, readsAx=ax[row][col])
 
-        count += 1
-        try:
-            title = query.split('(')[1]
-            subtype = query.split('(')[2][:-2]
-            segment = query.split(' ')[0]
-        except IndexError:
-            # this is for one title which doesn't fit the usual format
-            segment = 'Segment 2'
-            subtype = 'H3N8'
-            title = query
-        ax[row][col].set_title('%s, %d, %s \n %s' % (
-                               segment, numberOfReads,
-                               subtype, title), fontsize=10)
+    if not panel:
+        if not outputDir:
+            raise ValueError('Without a panel, an output directory must be '
+                             'given.')
+        tiles = _renderedTiles(blastName, matrix, outputDir, distance,
+                               colorBy, continents, processes)
+        for _, _, _, localMaxDistance, numberOfReads in tiles:
+            maxDistance = max(maxDistance, localMaxDistance)
+            maxReads = max(maxReads, numberOfReads)
+        return maxDistance, maxReads
+
+    figure, ax = plt.subplots(rows, cols, squeeze=False)
+    if outputDir:
+        tiles = _renderedTiles(blastName, matrix, outputDir, distance,
+                               colorBy, continents, processes)
+    else:
+        tiles = _panelTiles(blastName, matrix, ax, distance, colorBy,
+                            continents)
+    for count, (query, row, col, localMaxDistance,
+                numberOfReads) in enumerate(tiles):
+        print count, query
+        ax[row][col].set_title(_tileTitle(query, numberOfReads), fontsize=10)
         if localMaxDistance > maxDistance:
             maxDistance = localMaxDistance
         if numberOfReads > maxReads:
@@ -533,22 +1277,276 @@ def distancePanel(blastName, matrix, distance='bit', colorBy='all',
     figure.set_size_inches(5 * cols, 3 * rows, forward=True)
     figure.show()
 
+    return maxDistance, maxReads
+
+
+def _canvasPixels(figure):
+    """
+    Draw a figure made with an Agg canvas and get its pixels.
+
+    @param figure: A C{matplotlib.figure.Figure} with a C{FigureCanvasAgg}.
+
+    @return: A C{numpy.ndarray} of C{uint8} RGB pixels, of shape (height,
+        width, 3).
+    """
+    canvas = figure.canvas
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    pixels = np.frombuffer(canvas.buffer_rgba(), dtype=np.uint8)
+    return pixels.reshape((height, width, 4))[:, :, :3].copy()
+
+
+# The axes that mosaic tiles are drawn on in this process, by tile size
+# and dpi. Making and clearing a figure for each tile takes longer than
+# drawing the tile.
+_TILEAXES = {}
+
+
+def _tileAxes(tileSize, dpi):
+    """
+    Get the axes to draw a mosaic tile on, for _rasterTile. The caller must
+    remove the lines and collections it adds.
+
+    @param tileSize: The (width, height) of the tile, in pixels.
+    @param dpi: The C{int} dots per inch of the tile.
+
+    @return: The matplotlib axes of a figure with an Agg canvas.
+    """
+    try:
+        return _TILEAXES[tileSize, dpi]
+    except KeyError:
+        width, height = tileSize
+        figure = Figure(figsize=(width / float(dpi), height / float(dpi)),
+                        dpi=dpi)
+        FigureCanvasAgg(figure)
+        ax = figure.add_axes([0.02, 0.04, 0.96, 0.7])
+        # Without ticks from the start, no tick artists are made at all.
+        ax.set_yticks([])
+        ax.set_xticks([])
+        _TILEAXES[tileSize, dpi] = ax
+        return ax
+
+
+def _rasterTile(args):
+    """
+    Draw the distance plot of a read as a tile of a mosaic, for use with
+    _mapTiles by distanceMosaic.
+
+    @param args: A C{tuple} of the C{dict} JSON blast record of the read, the
+        C{str} title of the tile, the (width, height) of the tile in pixels,
+        its C{int} dpi, the (largest distance, largest number of reads) that
+        all the tiles are scaled to, and the distance, colorBy and continents
+        arguments of distancePlot.
+
+    @return: A C{numpy.ndarray} of C{uint8} RGB pixels, of shape (height,
+        width, 3).
+    """
+    (record, title, tileSize, dpi, (maxDistance, maxReads), distance,
+     colorBy, continents) = args
+    ax = _tileAxes(tileSize, dpi)
+    try:
+        _plotDistances(ax, blastRecords.convertDictToBlastRecord(record),
+                       distance, colorBy, continents, labels=False,
+                       tickLabels=False)
+        ax.set_title(title, fontsize=10)
+        ax.set_ylim([0, maxDistance + 1])
+        ax.set_xlim([0, maxReads + 1])
+        return _canvasPixels(ax.figure)
+    finally:
+        for artist in ax.lines + ax.collections:
+            artist.remove()
+
+
+def _halve(image):
+    """
+    Halve the width and height of an image, averaging blocks of 2x2 pixels.
+    An odd last row or column is left out.
+
+    @param image: A C{numpy.ndarray} of C{uint8} RGB pixels.
+
+    @return: A C{numpy.ndarray} of C{uint8} RGB pixels.
+    """
+    height = image.shape[0] // 2
+    width = image.shape[1] // 2
+    blocks = image[:2 * height, :2 * width].reshape(
+        (height, 2, width, 2, image.shape[2]))
+    return ((blocks.sum(axis=(1, 3), dtype=np.uint16) + 2) // 4).astype(
+        np.uint8)
+
+
+def distanceMosaic(blastName, matrix, mosaicFile, distance='bit',
+                   colorBy='all', continents=True, processes=1,
+                   tileSize=(300, 180), dpi=60, pyramid=False):
+    """
+    Make the panel of distancePanel as one PNG image. Each distance plot is
+    drawn with the Agg backend on a tile of a fixed size, and the tiles are
+    copied into the image, so no big figure has to be laid out.
+
+    @param blastName: File with blast output
+    @param matrix: A matrix of strings corresponding to record.queries
+        at the position where the plot of a given record should be.
+    @param mosaicFile: The C{str} name of the PNG file to write.
+    @param distance: The measure of distance read out from the blastFile,
+        either 'bit' or 'percentId'.
+    @param colorBy: How the coloring should be done. Either color
+        by all taxonomic groups ('all') or color by anseriformes
+        and charadriiformes ('anseriformes and charadriiformes').
+    @param continents: if C{bool} True, color the backgound of each title by
+        which continent the title is from.
+    @param processes: The C{int} number of worker processes that draw the
+        tiles. If C{None}, one process per CPU is used. If 1, they are
+        drawn in this process.
+    @param tileSize: The (width, height) of each tile, in pixels.
+    @param dpi: The C{int} dots per inch of the tiles, which sets the size
+        of their text and lines.
+    @param pyramid: if C{bool} True, also write images of half the size of
+        the one before, named after C{mosaicFile} with -1, -2, ... before
+        the extension, until one fits in a tile.
+
+    @return: A C{list} of the C{str} names of the files written, largest
+        image first.
+    """
+    cols = 8
+    rows = 53
+    # A tuple, so workers can use it to look up their tile axes.
+    tileSize = tuple(tileSize)
+    width, height = tileSize
+
+    # All tiles are scaled to the largest distance and number of reads, as
+    # distancePanel does, so find those first. The records are kept (there
+    # are at most rows * cols of them) so the blast output is only read
+    # once, which also lets it come from a stream.
+    records = list(_tileRecords(blastName, matrix))
+    maxDistance = 0
+    maxReads = 0
+    for _, record in records:
+        alignments = blastRecords.convertDictToBlastRecord(record).alignments
+        if distance == 'bit':
+            distances = [alignment.hsps[0].bits for alignment in alignments]
+        else:
+            distances = computePercentIds(alignments)
+        # Alignments without a percent identity (see computePercentIds) do
+        # not count towards the scale.
+        distances = np.asarray(distances, dtype=float)
+        distances = distances[~np.isnan(distances)]
+        if len(distances):
+            maxDistance = max(maxDistance, distances.max())
+        maxReads = max(maxReads, len(alignments))
+
+    headerHeight = height // 2
+    mosaic = np.empty((headerHeight + rows * height, cols * width, 3),
+                      dtype=np.uint8)
+    mosaic.fill(255)
+
+    header = Figure(figsize=(cols * width / float(dpi),
+                             headerHeight / float(dpi)), dpi=dpi)
+    FigureCanvasAgg(header)
+    header.text(0.5, 0.5, 'X: 0 to %d, Y (%s): 0 to %d' % (
+        maxReads, ('Bit scores' if distance == 'bit' else '% id'),
+        maxDistance), fontsize=20, horizontalalignment='center',
+        verticalalignment='center')
+    pixels = _canvasPixels(header)[:headerHeight, :cols * width]
+    mosaic[:pixels.shape[0], :pixels.shape[1]] = pixels
+
+    tasks = (((query, row, col),
+              (record, _tileTitle(query, len(record['alignments'])),
+               tileSize, dpi, (maxDistance, maxReads), distance, colorBy,
+               continents))
+             for (query, row, col), record in records)
+    for (query, row, col), pixels in _mapTiles(tasks, _rasterTile,
+                                               processes):
+        pixels = pixels[:height, :width]
+        top = headerHeight + row * height
+        left = col * width
+        mosaic[top:top + pixels.shape[0],
+               left:left + pixels.shape[1]] = pixels
+
+    imsave(mosaicFile, mosaic)
+    filenames = [mosaicFile]
+
+    if pyramid:
+        root, extension = os.path.splitext(mosaicFile)
+        level = 0
+        while mosaic.shape[0] > height or mosaic.shape[1] > width:
+            level += 1
+            mosaic = _halve(mosaic)
+            filename = '%s-%d%s' % (root, level, extension)
+            imsave(filename, mosaic)
+            filenames.append(filename)
+
+    return filenames
+
 
 # ===================================================
 # THE CODE FROM DOWN HERE IS DEGRADED AND NOT TESTED!
 # ===================================================
 
-def makeListOfHitTitles(blastName):
+def _hits(records, bitScoreCutoff=50):
+    """
+    Finds the alignments that are hit.
+
+    @param records: An iterable of blast records.
+    @param bitScoreCutoff: Alignments with a best bit score below this are
+        left out.
+
+    @return: A generator of (query, alignment) tuples.
+    """
+    for record in records:
+        for alignment in record.alignments:
+            if alignment.hsps[0].bits >= bitScoreCutoff:
+                yield record.query, alignment
+
+
+def _hitDistances(records, bitScoreCutoff=50, distance='bit'):
+    """
+    Finds the distance between each query and the titles it hits.
+
+    @param records: An iterable of blast records.
+    @param bitScoreCutoff: Alignments with a best bit score below this are
+        left out.
+    @param distance: The measure of distance read out from the records,
+        either 'bit' or 'percentId'.
+
+    @return: A generator of (query, title, distance) tuples.
+    """
+    for record in records:
+        alignments = [alignment for alignment in record.alignments
+                      if alignment.hsps[0].bits >= bitScoreCutoff]
+        if distance == 'bit':
+            dists = [alignment.hsps[0].bits for alignment in alignments]
+        else:
+            dists = computePercentIds(alignments).tolist()
+        for alignment, dist in zip(alignments, dists):
+            yield record.query, alignment.title, dist
+
+
+def _hitDistancesChunk(records, bitScoreCutoff, distance):
+    """
+    Find the hit distances in the records of a chunk of a blast file, for
+    use with blastRecords.mapChunks.
+    """
+    return list(_hitDistances(
+        imap(blastRecords.convertDictToBlastRecord, records),
+        bitScoreCutoff, distance))
+
+
+def makeListOfHitTitles(blastName, bitScoreCutoff=50):
     """
     Makes a list of titles that are hit.
 
-    @param blastName: File with blast output.
+    @param blastName: File with blast output, '-' for standard input, an
+        open file or an iterator of lines.
+    @param bitScoreCutoff: Alignments with a best bit score below this are
+        left out.
 
     @return: A list of titles.
     """
-    blastRecords = blast.BlastRecords(blastName)
-    interesting = blastRecords.filterHits(withBitScoreBetterThan=50)
-    titlesList = interesting.titles.keys()
+    titlesList = []
+    seen = set()
+    for _, alignment in _hits(_records(blastName), bitScoreCutoff):
+        if alignment.title not in seen:
+            seen.add(alignment.title)
+            titlesList.append(alignment.title)
 
     return titlesList
 
@@ -568,8 +1566,7 @@ def heatMapFromPanel(blastName, matrix):
     rows = 53
     array = ([[0 for _ in range(cols)] for _ in range(rows)])
 
-    blastRecords = blast.BlastRecords(blastName)
-    records = blastRecords.records()
+    records = blast.BlastRecords(blastName).records()
 
     for record in records:
         query = record.query
@@ -583,15 +1580,15 @@ def heatMapFromPanel(blastName, matrix):
                 # if that record is not present in matrix, leave it out.
                 continue
             alignments = record.alignments
-            for alignment in alignments:
-                distance = computePercentId(alignment)
-                alignment.hsps[0].bits = distance
+            identities = computePercentIds(alignments)
+            for alignment, identity in zip(alignments, identities.tolist()):
+                alignment.hsps[0].bits = identity
             sortedAlignments = sorted(alignments,
                                       key=lambda k: k.hsps[0].bits,
                                       reverse=True)
 
             for i, alignment in enumerate(sortedAlignments):
-                titleType = _getBird(alignment.title)
+                titleType = TITLEANNOTATIONS.annotate(alignment.title).bird
                 if titleType != NEITHER:
                     if queryType != titleType:
                         array[row][col] = i
@@ -637,11 +1634,14 @@ def heatMapFromPanel(blastName, matrix):
 
 def makeDistanceMatrix(blastName, fastaName, titlesList=None,
                        masked=False, toFile=False, addTitles=False,
-                       missingValue=0.0, distance='bit'):
+                       missingValue=0.0, distance='bit', bitScoreCutoff=50,
+                       processes=1):
     """
-    Takes a blast output file, returns a distance matrix.
+    Takes a blast output file, returns a distance matrix. The blast output
+    is read only once, so it can come from a pipe.
 
-    @param blastName: File with blast output
+    @param blastName: File with blast output, '-' for standard input, an
+        open file or an iterator of lines.
     @param fastaName: A fastafile with the titles that were blasted,
         in the order that it should be in the matrix. Or a list of
         titles that were blasted, in the order that they should be
@@ -657,17 +1657,18 @@ def makeDistanceMatrix(blastName, fastaName, titlesList=None,
     @param missingValue: The value used in the matrix if no distance is given.
     @param distance: The measure of distance read out from the blastFile,
         either 'bit' or 'percentId'.
+    @param bitScoreCutoff: Alignments with a best bit score below this are
+        left out.
+    @param processes: The C{int} number of worker processes that parse
+        chunks of the blast file in parallel (see blastRecords.mapChunks).
+        If C{None}, one process per CPU is used. Only uncompressed files on
+        disk are split, others are always read in this process.
 
     @return: the distance matrix that was made, the titlesList, and a C{list}
         of sequence titles.
 
     NOTE: masked = True and missingValue != 0 does not work!
     """
-    if not titlesList:
-        titlesList = makeListOfHitTitles(blastName)
-    titlesDict = dict((title, index)
-                      for (index, title) in enumerate(titlesList))
-
     if type(fastaName) == list:
         fastaList = fastaName
     else:
@@ -675,6 +1676,38 @@ def makeDistanceMatrix(blastName, fastaName, titlesList=None,
                          in SeqIO.parse(fastaName, 'fasta'))
     fastaDict = {item: index for (index, item) in enumerate(fastaList)}
 
+    if processes != 1 and blastRecords.isPlainFile(blastName):
+        # The chunks are given in file order, so the titles are found in
+        # the same order as when reading the file in this process.
+        distances = (hit for chunk in blastRecords.mapChunks(
+            blastName, _hitDistancesChunk, (bitScoreCutoff, distance),
+            processes=processes) for hit in chunk)
+    else:
+        distances = _hitDistances(_records(blastName), bitScoreCutoff,
+                                  distance)
+
+    # Read the blast output only once, keeping just the distances, so the
+    # titles can be found without reading it a second time.
+    hits = []
+    hitTitles = []
+    seen = set()
+    for query, title, dist in distances:
+        if title not in seen:
+            seen.add(title)
+            hitTitles.append(title)
+        # get position of query in queryList
+        try:
+            queryIndex = fastaDict[query]
+        except KeyError:
+            # if query not present in fastaDict, continue
+            continue
+        hits.append((queryIndex, title, dist))
+
+    if not titlesList:
+        titlesList = hitTitles
+    titlesDict = dict((title, index)
+                      for (index, title) in enumerate(titlesList))
+
     if not masked:
         initMatrix = [[missingValue for _ in range(
                       len(titlesList))] for _ in range(len(fastaList))]
@@ -683,31 +1716,15 @@ def makeDistanceMatrix(blastName, fastaName, titlesList=None,
             [[missingValue for _ in range(
                 len(titlesList))] for _ in range(len(fastaList))])
 
-    BlastRecords = blast.BlastRecords(blastName)
-    records = BlastRecords.records(bitScoreCutoff=50)
-
-    for record in records:
-        query = record.query
-        # get position of query in queryList
+    for queryIndex, title, dist in hits:
+        # get position of title in titlesList
         try:
-            queryIndex = fastaDict[query]
-        except ValueError:
-            # if query not present in fastaDict, continue
+            subjectIndex = titlesDict[title]
+        except KeyError:
+            # if title not present in titlesDict, continue
             continue
-        for alignment in record.alignments:
-            title = alignment.title
-            if distance == 'bit':
-                dist = alignment.hsps[0].bits
-            else:
-                dist = computePercentId(alignment)
-            # get position of title in titlesList
-            try:
-                subjectIndex = titlesDict[title]
-            except ValueError:
-                # if query not present in titlesDict, continue
-                continue
-            # add distance to matrix
-            initMatrix[queryIndex][subjectIndex] = dist
+        # add distance to matrix
+        initMatrix[queryIndex][subjectIndex] = dist
 
     # mask values that are 0 (those that were not hit)
     if masked:
@@ -783,7 +1800,7 @@ def makeAffinityMatrix(matrix):
         distanceMatrix.append(item[1:])
 
     for title in sequenceTitles:
-        bird = _getBird(title)
+        bird = TITLEANNOTATIONS.annotate(title).bird
         if bird == 1:
             sequenceColors.append('red')
         elif bird == 2:
@@ -927,7 +1944,8 @@ def _annotateTitles(titlesList):
         and a number indicating whether the title is a GULL, DUCK
         or NEITHER.
     """
-    annotatedTitlesList = [(title, _getBird(title)) for title in titlesList]
+    annotatedTitlesList = [(title, TITLEANNOTATIONS.annotate(title).bird)
+                           for title in titlesList]
 
     return annotatedTitlesList
 
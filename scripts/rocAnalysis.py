@@ -4,116 +4,614 @@ Description of method can be found here: Akobeng, Understanding diagnostic
 tests 3: receiver operating characteristic curves, 2007
 
 Required: a set of files containing results from BLAST runs with different
-parameters, and different levels of sequence identity, (currently: 100, 99,
+parameters, and different levels of sequence identity, (e.g.: 100, 99,
 95, 90, 85, 80, 75, 70, 65, 60, 55, 50, 45, 40, 35, 30, 25, 20, 15, 10, 5, 0)
 where parameters are in the filename.
 The id of the sequences must be of the form xx|yy|sequence identity level.
+The levels and the number of reads at each level are found while counting.
 """
 
 from scipy import integrate
+from scipy.stats import norm, rankdata
+from collections import defaultdict
+from glob import glob
+from json import JSONDecoder, loads
+from multiprocessing import Pool, cpu_count
+from os.path import abspath, basename, splitext
+from random import Random
+from zipfile import BadZipfile
+import numpy as np
+import os
 import operator
-import copy
+import re
+import zlib
 
-from dark import conversion
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from scripts import blastRecords
+
+# The levels of sequence identity of the original simulation design.
+LEVELS = ['100', '99', '95', '90', '85', '80', '75', '70', '65', '60', '55',
+          '50', '45', '40', '35', '30', '25', '20', '15', '10', '5', '0']
+
+# Finds the level of sequence identity in the query of a line of JSON blast
+# output without decoding it. The sequences of the HSPs never contain '|'.
+QUERY_LEVEL_REGEX = re.compile(r'"query":\s*"[^"|]*\|[^"|]*\|([^"|]*)')
+
+# Finds the query of a line of JSON blast output, as a JSON string. Queries
+# contain '|', so the query sequences of the HSPs are never found.
+QUERY_REGEX = re.compile(r'"query":\s*("(?:[^"\\|]|\\.)*\|(?:[^"\\]|\\.)*")')
+
+# Finds the start of the alignments of a line of JSON blast output. A '"'
+# in a title or query is escaped, so they cannot be mistaken for the key.
+ALIGNMENTS_REGEX = re.compile(r'"alignments":\s*\[\s*')
+
+_DECODER = JSONDecoder()
+
+# The number of simulated reads at each level of sequence identity of the
+# original simulation design (see designTotals).
+READS_PER_LEVEL = 594
 
 
 def _records(blastFilename):
-    reader = conversion.JSONRecordsReader(blastFilename)
-    for record in reader.records():
-        yield record
+    """
+    Generate blast records from a json file, which may be compressed with
+    gzip, BGZF, bzip2 or xz.
+    """
+    return blastRecords.records(blastFilename)
+
+
+def _bestHits(blastFilename):
+    """
+    Reads the query and the bit score of the best hit of each record in a
+    JSON blast file. Unlike _records, no Bio.Blast objects are made for the
+    alignments and HSPs, so this is much faster and uses less memory.
+
+    @param blastFilename: the C{str} name of a file with JSON blast output,
+        which may be compressed, '-' for standard input, an open file or an
+        iterator of lines.
+    @raise ValueError: If the file is empty or a line cannot be converted
+        to JSON.
+    @return: A generator of (query, bits) tuples, where bits is the bit score
+        of the first HSP of the first alignment, or C{None} if the read has
+        no hits.
+    """
+    return blastRecords.jsonRecords(blastFilename, decode=_bestHitOfLine)
+
+
+def _bestHitOfLine(line):
+    """
+    Gets the query and the bit score of the best hit of a line of JSON blast
+    output, decoding only the query and the first alignment instead of the
+    whole record. The sequences of the other alignments are often most of
+    the line.
+
+    @param line: a C{str} line of JSON blast output, with a record.
+    @raise ValueError: If the line cannot be converted to JSON.
+    @return: a (query, bits) tuple, as yielded by _bestHits.
+    """
+    query = QUERY_REGEX.search(line)
+    alignments = ALIGNMENTS_REGEX.search(line)
+    if query is None or alignments is None:
+        # Not the usual layout, so decode everything.
+        return _bestHit(loads(line))
 
+    start = alignments.end()
+    if line.startswith(']', start):
+        bits = None
+    else:
+        alignment, _ = _DECODER.raw_decode(line, start)
+        bits = alignment['hsps'][0]['bits']
+    return loads(query.group(1)), bits
 
-def countHits(blastFile, cutoff):
+
+def _bestHit(record):
+    """
+    Gets the query and the bit score of the best hit of a JSON blast record.
+
+    @param record: a C{dict} decoded from a line of JSON blast output.
+    @return: a (query, bits) tuple, as yielded by _bestHits.
+    """
+    alignments = record['alignments']
+    if alignments:
+        return record['query'], alignments[0]['hsps'][0]['bits']
+    else:
+        return record['query'], None
+
+
+def _schemeTitle(blastFile):
+    """
+    Get the name of the scoring scheme from the name of a blast file.
+
+    @param blastFile: a file with blast output, named after the parameters
+        that were used to produce it, or a stream (see
+        blastRecords.blastName).
+    @return: A C{str} scoring scheme title. If the file name does not have
+        the expected layout, the base name of the file without its
+        extension is used.
+    """
+    blastFile = blastRecords.blastName(blastFile)
+    try:
+        t = blastFile.split('.')[2]
+        return t.split('/')[4]
+    except IndexError:
+        return splitext(basename(blastFile))[0]
+
+
+def _bestHitArrays(blastFile):
+    """
+    Reads the level of sequence identity and the bit score of the best hit
+    of each read in a blast file.
+
+    @param blastFile: the name of a file with blast output, '-' for
+        standard input, an open file or an iterator of lines (see
+        blastRecords.blastLines).
+    @return: a C{numpy.ndarray} of C{str} queries, a C{numpy.ndarray} of
+        C{str} levels of sequence identity and a C{numpy.ndarray} of
+        C{float} bit scores, with C{nan} for reads without hits.
+    """
+    queries = []
+    levels = []
+    scores = []
+    for query, bits in _bestHits(blastFile):
+        queries.append(query)
+        levels.append(query.split('|')[2])
+        scores.append(np.nan if bits is None else bits)
+
+    return (np.array(queries, dtype=str), np.array(levels, dtype=str),
+            np.array(scores, dtype=float))
+
+
+def _cacheFilename(blastFile):
+    """
+    Get the name of the best hit cache file for a blast file.
+
+    @param blastFile: a file with blast output.
+    @return: A C{str} file name next to the blast file.
+    """
+    return blastFile + '.hits.npz'
+
+
+def cachedBestHits(blastFile, cacheOnly=False, withQueries=False):
+    """
+    Gets the level of sequence identity and the bit score of the best hit of
+    each read in a blast file from a cache file stored next to it. The cache
+    is keyed by the path, size and modification time of the blast file, and
+    is (re)built if it is missing, stale or damaged.
+
+    @param blastFile: a file with blast output.
+    @param cacheOnly: if C{True}, never read the blast file or write the
+        cache, e.g. for read-only archives.
+    @param withQueries: if C{True}, also return the queries of the reads.
+    @raise ValueError: If C{cacheOnly} is C{True} and there is no up to date
+        cache file, or if C{blastFile} is not the name of a file.
+    @return: a C{numpy.ndarray} of C{str} levels of sequence identity and a
+        C{numpy.ndarray} of C{float} bit scores, with C{nan} for reads
+        without hits. If C{withQueries} is C{True}, a C{numpy.ndarray} of
+        the C{str} queries is returned first.
+    """
+    if not blastRecords.isFilename(blastFile):
+        raise ValueError('Only blast files on disk can be cached, not %r.' %
+                         blastRecords.blastName(blastFile))
+
+    cacheFile = _cacheFilename(blastFile)
+    stat = os.stat(blastFile)
+    path = abspath(blastFile)
+
+    try:
+        cache = np.load(cacheFile)
+    except (IOError, BadZipfile, ValueError):
+        # The cache is missing, truncated or not a cache at all.
+        pass
+    else:
+        try:
+            # Caches written before the queries were kept are stale.
+            if (cache['path'] == path and cache['size'] == stat.st_size and
+                    cache['mtime'] == stat.st_mtime and
+                    'queries' in cache.files):
+                queries, levels, scores = (cache['queries'], cache['levels'],
+                                           cache['scores'])
+                if withQueries:
+                    return queries, levels, scores
+                return levels, scores
+        except (IOError, BadZipfile, KeyError, ValueError, zlib.error):
+            # A damaged or old format cache is rebuilt like a stale one.
+            pass
+        finally:
+            cache.close()
+
+    if cacheOnly:
+        raise ValueError('No up to date best hit cache %r for %r.' %
+                         (cacheFile, blastFile))
+
+    queries, levels, scores = _bestHitArrays(blastFile)
+
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partial cache.
+    tmpFile = '%s.%d.tmp' % (cacheFile, os.getpid())
+    try:
+        with open(tmpFile, 'wb') as fp:
+            np.savez(fp, path=path, size=stat.st_size, mtime=stat.st_mtime,
+                     queries=queries, levels=levels, scores=scores)
+        os.rename(tmpFile, cacheFile)
+    except (IOError, OSError):
+        # The directory is not writable. Carry on without a cache.
+        pass
+
+    if withQueries:
+        return queries, levels, scores
+    return levels, scores
+
+
+def _count(bestHits, cutoff):
+    """
+    Counts the reads that hit and all reads at each level of sequence
+    identity.
+
+    @param bestHits: an iterable of (query, bits) tuples, as yielded by
+        _bestHits.
+    @param cutoff: a bit score cutoff, reads below that will not be considered.
+    @return: a C{dict} with the number of reads that hit at each level of
+        sequence identity and a C{dict} with the total number of reads.
+    """
+    readsPerLevel = defaultdict(int)
+    readsTotal = defaultdict(int)
+    for query, score in bestHits:
+        level = query.split('|')[2]
+        readsTotal[level] += 1
+        readsPerLevel[level] += int(score is not None and score > cutoff)
+    return dict(readsPerLevel), dict(readsTotal)
+
+
+def _countChunk(bestHits, cutoff):
+    """
+    Count the hits in the best hits of a chunk of a blast file, for use with
+    blastRecords.mapChunks and _bestHitOfLine.
+    """
+    return _count(bestHits, cutoff)
+
+
+def countHits(blastFile, cutoff, cache=False, cacheOnly=False,
+              withTotals=True, processes=1):
     """
     Counts the number of reads that hit in each file at each level of
     sequence identity.
 
-    @param blastFile: a file with blast output.
+    @param blastFile: the name of a file with blast output, '-' for
+        standard input, an open file or an iterator of lines (see
+        blastRecords.blastLines).
     @param cutoff: a bit score cutoff, reads below that will not be considered.
+    @param cache: if C{True}, read the best hits from a cache file next to
+        the blast file (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the cache.
+    @param withTotals: if C{True}, also return the total number of reads at
+        each level of sequence identity, as needed by calculateFrequencies.
+    @param processes: The C{int} number of worker processes that parse
+        chunks of the file in parallel (see blastRecords.mapChunks). If
+        C{None}, one process per CPU is used. Only uncompressed files on
+        disk are split, others are always read in this process.
     @return: the name of the blastFile and a dictionary, with the level of
         sequence identity as key and the number of reads with that sequence
-        identity as values.
-    """
-    readsPerLevel = {'100': 0, '99': 0, '95': 0, '90': 0, '85': 0, '80': 0,
-                     '75': 0, '70': 0, '65': 0, '60': 0, '55': 0, '50': 0,
-                     '45': 0, '40': 0, '35': 0, '30': 0, '25': 0, '20': 0,
-                     '15': 0, '10': 0, '5': 0, '0': 0}
-    t = blastFile.split('.')[2]
-    title = t.split('/')[4]
-    records = _records(blastFile)
-    for record in records:
-        query = record.query
-        level = query.split('|')[2]
-        try:
-            alignment = record.alignments[0]
-        except IndexError:
-            continue
-        score = alignment.hsps[0].bits
-        if score > cutoff:
-            readsPerLevel[level] += 1
+        identity as values. Every level of a read in the file is a key. If
+        C{withTotals} is C{True}, a dictionary with the total number of
+        reads at each level is returned as well.
+    """
+    title = _schemeTitle(blastFile)
+    if cache or cacheOnly:
+        _, scores, readsTotal = bestHitScores(
+            blastFile, cache=cache, cacheOnly=cacheOnly, withTotals=True)
+        readsPerLevel = countHitsAtCutoffs(scores, [cutoff])[cutoff]
+    elif processes != 1 and blastRecords.isPlainFile(blastFile):
+        readsPerLevel = defaultdict(int)
+        readsTotal = defaultdict(int)
+        for chunkHits, chunkTotal in blastRecords.mapChunks(
+                blastFile, _countChunk, (cutoff,), processes=processes,
+                ordered=False, decode=_bestHitOfLine):
+            for level, count in chunkHits.iteritems():
+                readsPerLevel[level] += count
+            for level, count in chunkTotal.iteritems():
+                readsTotal[level] += count
+        readsPerLevel = dict(readsPerLevel)
+        readsTotal = dict(readsTotal)
+    else:
+        readsPerLevel, readsTotal = _count(_bestHits(blastFile), cutoff)
 
-    return title, readsPerLevel
+    if withTotals:
+        return title, readsPerLevel, readsTotal
+    else:
+        return title, readsPerLevel
+
+
+def bestHitScores(blastFile, cache=False, cacheOnly=False, withTotals=False):
+    """
+    Reads a blast file once and collects the bit score of the best hit of
+    each read at each level of sequence identity, so that the number of
+    hits can be counted for any cutoff without reading the file again.
+
+    @param blastFile: the name of a file with blast output, '-' for
+        standard input, an open file or an iterator of lines (see
+        blastRecords.blastLines).
+    @param cache: if C{True}, read the best hits from a cache file next to
+        the blast file (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the cache.
+    @param withTotals: if C{True}, also return the total number of reads at
+        each level of sequence identity.
+    @return: the name of the blastFile and a dictionary, with the level of
+        sequence identity as key and a sorted C{numpy.ndarray} of the bit
+        scores of the reads with that sequence identity as values. Reads
+        without hits are left out, as in countHits. If C{withTotals} is
+        C{True}, a dictionary with the total number of reads at each level
+        is returned as well.
+    """
+    title = _schemeTitle(blastFile)
+    if cache or cacheOnly:
+        levels, scores = cachedBestHits(blastFile, cacheOnly=cacheOnly)
+    else:
+        _, levels, scores = _bestHitArrays(blastFile)
+
+    hit = ~np.isnan(scores)
+    scoresPerLevel = {}
+    readsTotal = {}
+    for level in np.unique(levels):
+        atLevel = levels == level
+        scoresPerLevel[str(level)] = np.sort(scores[hit & atLevel])
+        readsTotal[str(level)] = int(atLevel.sum())
+
+    if withTotals:
+        return title, scoresPerLevel, readsTotal
+    else:
+        return title, scoresPerLevel
+
+
+def countHitsAtCutoffs(scores, cutoffs):
+    """
+    Counts the number of reads that hit at each level of sequence identity
+    for a number of bit score cutoffs.
+
+    @param scores: a dictionary of sorted bit scores per level of sequence
+        identity, as returned by bestHitScores.
+    @param cutoffs: an iterable of bit score cutoffs, reads below a cutoff
+        will not be considered.
+    @return: a dictionary with the cutoffs as keys and dictionaries of the
+        same form as returned by countHits as values.
+    """
+    cutoffs = list(cutoffs)
+    result = dict((cutoff, {}) for cutoff in cutoffs)
+    for level, levelScores in scores.iteritems():
+        # The number of scores greater than each cutoff.
+        counts = len(levelScores) - np.searchsorted(levelScores, cutoffs,
+                                                    side='right')
+        for cutoff, count in zip(cutoffs, counts):
+            result[cutoff][level] = int(count)
+
+    return result
+
+
+def countHitsMultipleCutoffs(blastFile, cutoffs, cache=False,
+                             cacheOnly=False, withTotals=True):
+    """
+    Counts the number of reads that hit in a file at each level of
+    sequence identity for a number of bit score cutoffs, reading the file
+    only once.
+
+    @param blastFile: a file with blast output.
+    @param cutoffs: an iterable of bit score cutoffs.
+    @param cache: if C{True}, read the best hits from a cache file next to
+        the blast file (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the cache.
+    @param withTotals: if C{True}, also return the total number of reads at
+        each level of sequence identity, as needed by calculateFrequencies.
+    @return: the name of the blastFile and a dictionary with the cutoffs as
+        keys and dictionaries of the same form as returned by countHits as
+        values. If C{withTotals} is C{True}, a dictionary with the total
+        number of reads at each level is returned as well.
+    """
+    title, scores, readsTotal = bestHitScores(
+        blastFile, cache=cache, cacheOnly=cacheOnly, withTotals=True)
+    if withTotals:
+        return title, countHitsAtCutoffs(scores, cutoffs), readsTotal
+    else:
+        return title, countHitsAtCutoffs(scores, cutoffs)
 
 
 # after the above function has been called, all dictionaries must be added
-# into a large dictionary to be fed into calculateFrequencies
+# into a large dictionary to be fed into calculateFrequencies. sweep does
+# this for many files at once.
+
+def _countHitsStar(args):
+    """
+    Call countHits with a tuple of arguments, for use with C{Pool.map}.
+    """
+    return countHits(*args)
+
+
+def sweep(blastFiles, cutoff, processes=None, cache=False, cacheOnly=False,
+          withTotals=True):
+    """
+    Count the hits in many blast files (one per scoring scheme) in parallel.
+
+    @param blastFiles: Either a C{list} of files with blast output or a
+        C{str} glob pattern matching them.
+    @param cutoff: a bit score cutoff, reads below that will not be considered.
+    @param processes: The C{int} number of worker processes to use. If
+        C{None}, one process per CPU is used. If 1, the files are counted
+        in this process.
+    @param cache: if C{True}, read the best hits from cache files next to
+        the blast files (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the caches.
+    @param withTotals: if C{True}, also return the total number of reads at
+        each level of sequence identity for each scoring scheme, as needed
+        by calculateFrequencies.
+    @raise ValueError: If two files have the same scoring scheme title.
+    @return: A C{dict} with scoring schemes as keys and dictionaries of
+        the number of reads per level of sequence identity as values, as
+        expected by calculateFrequencies. If C{withTotals} is C{True}, a
+        C{dict} of the same form with the total number of reads per level
+        is returned as well.
+    """
+    if isinstance(blastFiles, basestring):
+        blastFiles = sorted(glob(blastFiles))
+
+    args = [(blastFile, cutoff, cache, cacheOnly, True)
+            for blastFile in blastFiles]
+
+    if processes == 1:
+        results = map(_countHitsStar, args)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_countHitsStar, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    hitDict = {}
+    totals = {}
+    for blastFile, (title, readsPerLevel, readsTotal) in zip(blastFiles,
+                                                             results):
+        if title in hitDict:
+            raise ValueError('Scoring scheme %r of %r was already found in '
+                             'another file.' % (title, blastFile))
+        hitDict[title] = readsPerLevel
+        totals[title] = readsTotal
+
+    if withTotals:
+        return hitDict, totals
+    else:
+        return hitDict
+
+
+def designTotals(hitDict, readsPerLevel=READS_PER_LEVEL, levels=LEVELS):
+    """
+    Makes the totals of a simulation design with the same number of reads
+    at each level of sequence identity, for hit counts that were made
+    without their totals.
+
+    @param hitDict: a dictionary of the form:
+        blastn4-545 {'60': 56, '65': 115, ...}
+    @param readsPerLevel: the C{int} number of reads at each level.
+    @param levels: the C{str} levels of the design. Any other levels in
+        C{hitDict} are added.
+    @return: a dictionary of the same form as C{hitDict} with the total
+        number of reads at each level for each scoring scheme, as returned
+        by sweep.
+    """
+    return dict(
+        (scoringScheme,
+         dict((level, readsPerLevel) for level in set(levels) | set(hits)))
+        for scoringScheme, hits in hitDict.iteritems())
+
+
+def frequencyArrays(hitDict, totals):
+    """
+    Calculates true negatives, true positives, false positives,
+    false negatives, specificity, false positive rate and true positive rate
+    for all scoring schemes at once.
+
+    @param hitDict: a dictionary of the form:
+        blastn4-545 {'60': 56, '65': 115, ...}
+    @param totals: a dictionary of the same form with the total number of
+        reads at each level of sequence identity for each scoring scheme, as
+        returned by sweep or countHits. Use designTotals for hit counts that
+        were made without their totals.
+    @raise ValueError: If C{hitDict} and C{totals} do not have the same
+        scoring schemes.
+
+    @return: a sorted C{list} of the scoring schemes, a C{list} of the levels
+        of sequence identity from highest to lowest, and a dictionary with
+        keys 'raw', 'totals', 'tps', 'tns', 'fps', 'fns', 'fprs', 'tprs' and
+        'spcs'. Each value is a 2-D C{numpy.ndarray} with one row per scoring
+        scheme (in the order of the list) and one column per level of
+        sequence identity. Levels missing for a scoring scheme count as 0.
+    """
+    missing = sorted(set(hitDict) - set(totals))
+    if missing:
+        raise ValueError('No read totals for scoring schemes %s.' %
+                         ', '.join(map(repr, missing)))
+    missing = sorted(set(totals) - set(hitDict))
+    if missing:
+        raise ValueError('No hit counts for scoring schemes %s.' %
+                         ', '.join(map(repr, missing)))
+
+    scoringSchemes = sorted(hitDict)
+    levels = set()
+    for scoringScheme in scoringSchemes:
+        levels.update(hitDict[scoringScheme])
+        levels.update(totals[scoringScheme])
+    levels = sorted(levels, key=float, reverse=True)
+
+    shape = (len(scoringSchemes), len(levels))
+    raw = np.array([[hitDict[scoringScheme].get(level, 0) for level in levels]
+                    for scoringScheme in scoringSchemes],
+                   dtype=int).reshape(shape)
+    readsTotal = np.array([[totals[scoringScheme].get(level, 0)
+                            for level in levels]
+                           for scoringScheme in scoringSchemes],
+                          dtype=int).reshape(shape)
+
+    arrays = _frequencyArrays(raw, readsTotal)
+    return scoringSchemes, levels, arrays
 
 
-def calculateFrequencies(hitDict):
+def _frequencyArrays(raw, readsTotal):
+    """
+    Calculates the frequencies for rows of hit counts.
+
+    @param raw: a 2-D C{numpy.ndarray} of the number of reads that hit, with
+        one row per scoring scheme and one column per level of sequence
+        identity, from highest to lowest.
+    @param readsTotal: a C{numpy.ndarray} of the same shape with the total
+        number of reads at each level.
+    @return: a dictionary of 2-D arrays, as described in frequencyArrays.
+    """
+    # The reads at and above each level are the positives, the reads below
+    # it the negatives.
+    positives = np.cumsum(readsTotal, axis=1)
+    negatives = readsTotal.sum(axis=1)[:, np.newaxis] - positives
+
+    tps = np.cumsum(raw, axis=1)
+    fps = raw.sum(axis=1)[:, np.newaxis] - tps
+    fns = positives - tps
+    tns = negatives - fps
+
+    # At the lowest level there are no negatives, the rates are then 0.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        allPositives = (tps + fns).astype(float)
+        tprs = np.where(allPositives > 0, tps / allPositives, 0.0)
+        allNegatives = (fps + tns).astype(float)
+        fprs = np.where(allNegatives > 0, fps / allNegatives, 0.0)
+        spcs = np.where(allNegatives > 0, tns / allNegatives, 0.0)
+
+    return {'fprs': fprs, 'tprs': tprs, 'spcs': spcs, 'tps': tps, 'tns': tns,
+            'fps': fps, 'fns': fns, 'raw': raw, 'totals': readsTotal}
+
+
+def calculateFrequencies(hitDict, totals):
     """
     Calculates true negatives, true positives, false positives,
     false negatives, specificity, false positive rate and true positive rate.
 
     @param readsPerLevel: a dictionary of the form:
         blastn4-545 {'60': 56, '65': 115, ...}
+    @param totals: a dictionary of the same form with the total number of
+        reads at each level of sequence identity (see frequencyArrays).
+    @raise ValueError: If C{hitDict} and C{totals} do not have the same
+        scoring schemes.
 
     @return: a dictionary containing the scoringScheme as keys,
-        and dictionaries for tn, tp, fp, fn, spec, fpr, tpr.
-    """
-    # transform the dict for each scoring scheme into a list
-    listDict = {}
-    for scoringScheme in hitDict:
-        l = []
-        for nr in [100, 99, 95, 90, 85, 80, 75, 70, 65, 60, 55, 50, 45, 40, 35,
-                   30, 25, 20, 15, 10, 5, 0]:
-            l.append(hitDict[scoringScheme][str(nr)])
-            listDict[scoringScheme] = l
-
-    # calculate frequencies
+        and dictionaries for tn, tp, fp, fn, spec, fpr, tpr, the raw
+        counts, the totals and the levels of sequence identity.
+    """
+    scoringSchemes, levels, arrays = frequencyArrays(hitDict, totals)
+
     frequencies = {}
+    for i, scoringScheme in enumerate(scoringSchemes):
+        frequencies[scoringScheme] = dict(
+            (key, array[i].tolist()) for key, array in arrays.iteritems())
+        frequencies[scoringScheme]['levels'] = list(levels)
 
-    for scoringScheme in listDict:
-        tps = []
-        tns = []
-        fps = []
-        fns = []
-        fprs = []
-        tprs = []
-        spcs = []
-        res = listDict[scoringScheme]
-        for i, level in enumerate(res):
-            tp = sum(res[:i+1])
-            fp = sum(res[i+1:])
-            fn = (594 * (i+1)) - tp
-            tn = 594 * (22 - (i+1)) - fp
-            tpr = float(tp)/float(tp+fn)
-            try:
-                fpr = float(fp)/float(fp+tn)
-                spc = float(tn)/float(fp+tn)
-            except ZeroDivisionError:
-                fpr = 0
-                spc = 0
-            fprs.append(fpr)
-            tprs.append(tpr)
-            spcs.append(spc)
-            tps.append(tp)
-            tns.append(tn)
-            fps.append(fp)
-            fns.append(fn)
-
-        frequencies[scoringScheme] = {'fprs': fprs, 'tprs': tprs, 'spcs': spcs,
-                                      'tps': tps, 'tns': tns, 'fps': fps,
-                                      'fns': fns, 'raw': res}
     return frequencies
 
 
@@ -141,11 +639,8 @@ def youdenIndex(frequencies):
         for i, l in enumerate(x):
             youden = x[i] + y[i] - 1
             youdens.append(youden)
-        youdenIndex = max(youdens)
-        cutoff = youdens.index(youdenIndex)
-        element = (y[youdens.index(youdenIndex)],
-                   frequencies[scoringScheme][
-                       'fprs'][youdens.index(youdenIndex)])
+        cutoff = youdens.index(max(youdens))
+        element = (y[cutoff], frequencies[scoringScheme]['fprs'][cutoff])
         cutoffs.append(cutoff)
         youdenCoords.append(element)
 
@@ -171,11 +666,8 @@ def f1Index(frequencies):
         for i, l in enumerate(x):
             f1 = (1-x[i])**2 + (1-y[i])**2
             f1s.append(f1)
-        f1Index = min(f1s)
-        cutoff = f1s.index(f1Index)
-        element = (y[f1s.index(f1Index)],
-                   frequencies[scoringScheme][
-                       'fprs'][f1s.index(f1Index)])
+        cutoff = f1s.index(min(f1s))
+        element = (y[cutoff], frequencies[scoringScheme]['fprs'][cutoff])
         cutoffs.append(cutoff)
         f1Coords.append(element)
 
@@ -191,18 +683,13 @@ def areaUnderCurve(frequencies):
     The closer the area to 0.5 the more rubbish is the test.
 
     @param frequencies: frequencies dictionary as returned from
-        calculateFrequencies.
+        calculateFrequencies. It is not changed.
     """
-    freqs = copy.copy(frequencies)
     integrated = {}
-    for scoringScheme in freqs:
-        x = freqs[scoringScheme]['fprs']
-        y = freqs[scoringScheme]['tprs']
-        # normalize curves
-        x.append(0.0)
-        y.append(0.0)
-        x.insert(0, 1.0)
-        y.insert(0, 1.0)
+    for scoringScheme in frequencies:
+        # normalize curves, without changing the lists in frequencies
+        x = [1.0] + list(frequencies[scoringScheme]['fprs']) + [0.0]
+        y = [1.0] + list(frequencies[scoringScheme]['tprs']) + [0.0]
         # integrate
         y_int = integrate.trapz(y, x)
         integrated[scoringScheme] = y_int * -1
@@ -225,3 +712,761 @@ def areaUnderCurveIndex(integrated):
         indexes[item[0]] = i
 
     return indexes
+
+
+# Vectorized versions of the measures above, for arrays with one row per
+# scoring scheme (or bootstrap replicate), as made by frequencyArrays.
+
+def _youdenCutoffs(spcs, tprs):
+    """
+    Finds the cutoff with the largest youden index in each row, like
+    youdenIndex.
+    """
+    return np.argmax(spcs + tprs - 1, axis=1)
+
+
+def _f1Cutoffs(spcs, tprs):
+    """
+    Finds the cutoff with the smallest F1 index in each row, like f1Index.
+    """
+    return np.argmin((1 - spcs) ** 2 + (1 - tprs) ** 2, axis=1)
+
+
+def _areasUnderCurves(fprs, tprs):
+    """
+    Calculates the area under the curve of each row, like areaUnderCurve.
+    """
+    rows = fprs.shape[0]
+    x = np.hstack([np.ones((rows, 1)), fprs, np.zeros((rows, 1))])
+    y = np.hstack([np.ones((rows, 1)), tprs, np.zeros((rows, 1))])
+    return -np.trapz(y, x, axis=1)
+
+
+def _frequencyRows(frequencies):
+    """
+    Stacks the false positive rates, true positive rates and specificities
+    of all scoring schemes into 2-D arrays, one row per scoring scheme.
+
+    @param frequencies: frequencies dictionary as returned from
+        calculateFrequencies.
+    @raise ValueError: If the scoring schemes have a different number of
+        levels of sequence identity.
+    @return: a tuple of the sorted scoring scheme names and a C{dict} with
+        keys 'fprs', 'tprs' and 'spcs'.
+    """
+    scoringSchemes = sorted(frequencies)
+    arrays = {}
+    for key in 'fprs', 'tprs', 'spcs':
+        rows = [frequencies[scoringScheme][key]
+                for scoringScheme in scoringSchemes]
+        if len(set(map(len, rows))) > 1:
+            raise ValueError('All scoring schemes must have the same number '
+                             'of levels of sequence identity.')
+        arrays[key] = np.array(rows, dtype=float).reshape(
+            len(scoringSchemes), -1)
+    return scoringSchemes, arrays
+
+
+def summarize(frequencies):
+    """
+    Calculates the area under the curve and the youden and F1 cutoffs of
+    all scoring schemes in one vectorized pass. The frequencies are not
+    changed, so this can be called any number of times.
+
+    @param frequencies: frequencies dictionary as returned from
+        calculateFrequencies.
+    @raise ValueError: If the scoring schemes have a different number of
+        levels of sequence identity.
+    @return: a C{numpy.recarray} with one record per scoring scheme, sorted
+        by scoring scheme, with fields 'scheme', 'auc', 'youdenCutoff',
+        'youdenTpr', 'youdenFpr', 'f1Cutoff', 'f1Tpr' and 'f1Fpr'. The
+        cutoffs and coordinates are those returned by youdenIndex and
+        f1Index.
+    """
+    names = ['scheme', 'auc', 'youdenCutoff', 'youdenTpr', 'youdenFpr',
+             'f1Cutoff', 'f1Tpr', 'f1Fpr']
+    if not frequencies:
+        # No reads yet, e.g. when following blast files that only have
+        # their parameters line.
+        return np.rec.fromarrays(
+            [np.array([], dtype=str), np.array([], dtype=float),
+             np.array([], dtype=int), np.array([], dtype=float),
+             np.array([], dtype=float), np.array([], dtype=int),
+             np.array([], dtype=float), np.array([], dtype=float)],
+            names=names)
+
+    scoringSchemes, arrays = _frequencyRows(frequencies)
+    rowIndices = np.arange(len(scoringSchemes))
+    youdens = _youdenCutoffs(arrays['spcs'], arrays['tprs'])
+    f1s = _f1Cutoffs(arrays['spcs'], arrays['tprs'])
+
+    return np.rec.fromarrays(
+        [np.array(scoringSchemes, dtype=str),
+         _areasUnderCurves(arrays['fprs'], arrays['tprs']),
+         youdens,
+         arrays['tprs'][rowIndices, youdens],
+         arrays['fprs'][rowIndices, youdens],
+         f1s,
+         arrays['tprs'][rowIndices, f1s],
+         arrays['fprs'][rowIndices, f1s]],
+        names=names)
+
+
+def plotRocCurves(frequencies, ax=None, youden=True, f1=True,
+                  imageFile=None, color='black', alpha=0.3, linewidth=0.5):
+    """
+    Draws the ROC curves of all scoring schemes as a single LineCollection,
+    so hundreds of schemes can be plotted without adding one artist per
+    curve. The youden and F1 cutoffs of all schemes are drawn with a single
+    scatter call.
+
+    When no axes are given, a new figure is made with the Agg canvas
+    directly, so this works in batch jobs without a display and without
+    going through pyplot.
+
+    @param frequencies: frequencies dictionary as returned from
+        calculateFrequencies.
+    @param ax: the matplotlib axes to draw on, or C{None} to make a new
+        figure.
+    @param youden: if C{True}, mark the youden cutoff of every scheme.
+    @param f1: if C{True}, mark the F1 cutoff of every scheme.
+    @param imageFile: if not C{None}, the name of a file to save the figure
+        to.
+    @param color: the color of the curves.
+    @param alpha: the transparency of the curves.
+    @param linewidth: the width of the curves.
+    @raise ValueError: If the scoring schemes have a different number of
+        levels of sequence identity.
+    @return: the matplotlib axes that were drawn on.
+    """
+    scoringSchemes, arrays = _frequencyRows(frequencies)
+    count = len(scoringSchemes)
+
+    if ax is None:
+        figure = Figure(figsize=(10, 10))
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot(111)
+
+    # Each curve runs from (1, 1) to (0, 0), as in areaUnderCurve.
+    fprs = np.hstack([np.ones((count, 1)), arrays['fprs'],
+                      np.zeros((count, 1))])
+    tprs = np.hstack([np.ones((count, 1)), arrays['tprs'],
+                      np.zeros((count, 1))])
+    ax.add_collection(LineCollection(np.dstack([fprs, tprs]), colors=color,
+                                     alpha=alpha, linewidths=linewidth))
+
+    summary = summarize(frequencies) if (youden or f1) else None
+    x = []
+    y = []
+    colors = []
+    if youden:
+        x.append(summary.youdenFpr)
+        y.append(summary.youdenTpr)
+        colors.extend(['red'] * count)
+    if f1:
+        x.append(summary.f1Fpr)
+        y.append(summary.f1Tpr)
+        colors.extend(['blue'] * count)
+    if colors:
+        ax.scatter(np.concatenate(x), np.concatenate(y), c=colors, s=12,
+                   zorder=3, edgecolors='none')
+
+    ax.plot([0, 1], [0, 1], color='grey', linestyle='--')
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.set_xlabel('False positive rate')
+    ax.set_ylabel('True positive rate')
+    ax.set_title('ROC curves of %d scoring schemes' % count)
+
+    if imageFile:
+        ax.figure.savefig(imageFile)
+
+    return ax
+
+
+def _bootstrapReplicates(args):
+    """
+    Calculates the area under the curve and the youden and F1 cutoffs for
+    bootstrap replicates of the hit counts of all scoring schemes.
+
+    @param args: a C{tuple} of the 2-D C{numpy.ndarray}s of hit counts and
+        of total reads per level (one row per scoring scheme), the C{int}
+        number of replicates, the C{int} random seed and the C{int} maximum
+        number of rows to work on at once.
+    @return: three C{numpy.ndarray}s of areas, youden cutoffs and F1 cutoffs,
+        each with one row per replicate and one column per scoring scheme.
+    """
+    raw, readsTotal, replicates, seed, batchRows = args
+    random = np.random.RandomState(seed)
+    schemes, levels = raw.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hitRate = np.where(readsTotal > 0, raw / readsTotal.astype(float), 0.0)
+
+    areas = []
+    youdens = []
+    f1s = []
+    batchSize = max(1, batchRows // max(1, schemes))
+    for start in xrange(0, replicates, batchSize):
+        size = min(batchSize, replicates - start)
+        # Resampling the reads at a level with replacement gives a
+        # binomial number of hits.
+        sampled = random.binomial(
+            np.tile(readsTotal, (size, 1)), np.tile(hitRate, (size, 1)))
+        arrays = _frequencyArrays(sampled, np.tile(readsTotal, (size, 1)))
+        shape = (size, schemes)
+        areas.append(_areasUnderCurves(arrays['fprs'],
+                                       arrays['tprs']).reshape(shape))
+        youdens.append(_youdenCutoffs(arrays['spcs'],
+                                      arrays['tprs']).reshape(shape))
+        f1s.append(_f1Cutoffs(arrays['spcs'], arrays['tprs']).reshape(shape))
+
+    return (np.vstack(areas).reshape(-1, schemes),
+            np.vstack(youdens).reshape(-1, schemes),
+            np.vstack(f1s).reshape(-1, schemes))
+
+
+def _interval(values, confidence):
+    """
+    Gets the percentile interval of each column of bootstrap values.
+
+    @param values: a 2-D C{numpy.ndarray} with one row per replicate.
+    @param confidence: the C{float} confidence level, e.g. 0.95.
+    @return: two C{numpy.ndarray}s with the lower and upper bound of each
+        column. The bounds are always values that occurred.
+    """
+    values = np.sort(values, axis=0)
+    last = values.shape[0] - 1
+    alpha = (1.0 - confidence) / 2.0
+    return (values[int(np.floor(alpha * last))],
+            values[int(np.ceil((1.0 - alpha) * last))])
+
+
+def bootstrap(hitDict, totals, replicates=1000, confidence=0.95,
+              processes=1, seed=None, batchRows=200000):
+    """
+    Calculates bootstrap confidence intervals for the area under the curve
+    and for the youden and F1 cutoffs of each scoring scheme. The reads at
+    each level of sequence identity are resampled with replacement, which is
+    done for all replicates and scoring schemes at once with NumPy.
+
+    @param hitDict: a dictionary of the form:
+        blastn4-545 {'60': 56, '65': 115, ...}
+    @param totals: the total number of reads at each level of sequence
+        identity for each scoring scheme (see frequencyArrays).
+    @param replicates: the C{int} number of bootstrap replicates.
+    @param confidence: the C{float} confidence level of the intervals.
+    @param processes: the C{int} number of worker processes to spread the
+        replicates over. If C{None}, one process per CPU is used.
+    @param seed: an C{int} random seed, or C{None}.
+    @param batchRows: the C{int} maximum number of replicate rows (one per
+        replicate and scoring scheme) to work on at once in each process.
+    @return: a dictionary containing the scoringScheme as keys, and
+        dictionaries with 'auc', 'youden' and 'f1' as keys and (lower, upper)
+        tuples as values. The cutoffs are indices into the levels, as
+        returned by youdenIndex and f1Index.
+    """
+    scoringSchemes, levels, arrays = frequencyArrays(hitDict, totals)
+    raw = arrays['raw']
+    readsTotal = arrays['totals']
+
+    random = np.random.RandomState(seed)
+    parts = 1 if processes == 1 else (processes or cpu_count())
+    parts = max(1, min(parts, replicates))
+    sizes = [replicates // parts + (i < replicates % parts)
+             for i in xrange(parts)]
+    args = [(raw, readsTotal, size, random.randint(2 ** 31), batchRows)
+            for size in sizes]
+
+    if parts == 1:
+        results = map(_bootstrapReplicates, args)
+    else:
+        pool = Pool(parts)
+        try:
+            results = pool.map(_bootstrapReplicates, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    intervals = {}
+    for name, index in ('auc', 0), ('youden', 1), ('f1', 2):
+        values = np.vstack([result[index] for result in results])
+        intervals[name] = _interval(values, confidence)
+
+    result = {}
+    for i, scoringScheme in enumerate(scoringSchemes):
+        result[scoringScheme] = dict(
+            (name, (lower[i].item(), upper[i].item()))
+            for name, (lower, upper) in intervals.iteritems())
+
+    return result
+
+
+# The functions below use the best hit bit score of every read rather than
+# the number of reads that hit at each level, so the ROC curve has a point
+# for every bit score threshold instead of one per level of sequence identity.
+
+def readScores(blastFile, cache=False, cacheOnly=False, withQueries=False):
+    """
+    Gets the level of sequence identity and the best hit bit score of each
+    read in a blast file.
+
+    @param blastFile: a file with blast output.
+    @param cache: if C{True}, read the best hits from a cache file next to
+        the blast file (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the cache.
+    @param withQueries: if C{True}, also return the queries of the reads.
+    @return: the name of the blastFile, a C{numpy.ndarray} of C{float}
+        levels of sequence identity and a C{numpy.ndarray} of C{float} bit
+        scores, with -inf for reads without hits (so they are never found).
+        If C{withQueries} is C{True}, a C{numpy.ndarray} of the C{str}
+        queries is returned as well.
+    """
+    title = _schemeTitle(blastFile)
+    if cache or cacheOnly:
+        queries, levels, scores = cachedBestHits(
+            blastFile, cacheOnly=cacheOnly, withQueries=True)
+    else:
+        queries, levels, scores = _bestHitArrays(blastFile)
+
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if withQueries:
+        return title, levels.astype(float), scores, queries
+    return title, levels.astype(float), scores
+
+
+def rocCurve(scores, labels):
+    """
+    Calculates the ROC curve over all score thresholds. A read is called
+    positive at a threshold if its score is at least the threshold. Sorting
+    the scores makes this O(n log n).
+
+    @param scores: an array of scores, one per read.
+    @param labels: an array of C{bool}, C{True} for the reads that should be
+        found (the true positives).
+    @raise ValueError: If there are no positive or no negative reads.
+    @return: C{numpy.ndarray}s of false positive rates, true positive rates
+        and the score thresholds, ordered from the highest threshold
+        (C{inf}, where nothing is called positive) to the lowest.
+    """
+    scores = np.asarray(scores, dtype=float)
+    labels = np.asarray(labels, dtype=bool)
+
+    if labels.all() or not labels.any():
+        raise ValueError('Both positive and negative reads are needed to '
+                         'calculate a ROC curve.')
+
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    sortedScores = scores[order]
+    sortedLabels = labels[order]
+    tps = np.cumsum(sortedLabels)
+    fps = np.cumsum(~sortedLabels)
+
+    # Only the last read of each run of equal scores gives a point.
+    last = np.r_[np.flatnonzero(sortedScores[1:] != sortedScores[:-1]),
+                 len(sortedScores) - 1]
+    tps = tps[last]
+    fps = fps[last]
+
+    fprs = np.r_[0.0, fps / float(fps[-1])]
+    tprs = np.r_[0.0, tps / float(tps[-1])]
+    thresholds = np.r_[np.inf, sortedScores[last]]
+
+    return fprs, tprs, thresholds
+
+
+def rocCurveArea(fprs, tprs):
+    """
+    Calculates the area under a ROC curve as returned by rocCurve. Because
+    rocCurve has a point for every score, this is the exact probability that
+    a positive read scores higher than a negative one (ties count half).
+
+    @param fprs: an array of false positive rates.
+    @param tprs: an array of true positive rates.
+    @return: the C{float} area under the curve.
+    """
+    return float(np.trapz(tprs, fprs))
+
+
+def rocCurves(blastFiles, minIdentity, cache=False, cacheOnly=False):
+    """
+    Calculates the ROC curve over all bit score thresholds for each scoring
+    scheme.
+
+    @param blastFiles: Either a C{list} of files with blast output or a
+        C{str} glob pattern matching them.
+    @param minIdentity: reads with at least this level of sequence identity
+        should be found, all others should not.
+    @param cache: if C{True}, read the best hits from cache files next to
+        the blast files (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the caches.
+    @return: a dictionary containing the scoringScheme as keys, and
+        dictionaries with 'fprs', 'tprs', 'thresholds' and 'auc' as values.
+    """
+    if isinstance(blastFiles, basestring):
+        blastFiles = sorted(glob(blastFiles))
+
+    curves = {}
+    for blastFile in blastFiles:
+        title, identities, scores = readScores(blastFile, cache=cache,
+                                               cacheOnly=cacheOnly)
+        fprs, tprs, thresholds = rocCurve(scores, identities >= minIdentity)
+        curves[title] = {'fprs': fprs, 'tprs': tprs, 'thresholds': thresholds,
+                         'auc': rocCurveArea(fprs, tprs)}
+
+    return curves
+
+
+def delongCovariance(scores, labels):
+    """
+    Calculates the area under the ROC curve of several scoring schemes on
+    the same reads, and the covariance of the areas, with the fast DeLong
+    algorithm (Sun and Xu, Fast implementation of DeLong's algorithm for
+    comparing the areas under correlated receiver operating characteristic
+    curves, 2014). This needs O(n log n) time per scoring scheme instead of
+    comparing every positive read with every negative one.
+
+    @param scores: a 2-D array of scores with one row per scoring scheme and
+        one column per read.
+    @param labels: an array of C{bool}, C{True} for the reads that should be
+        found.
+    @raise ValueError: If there are fewer than two positive or fewer than
+        two negative reads, as the variance of the areas is then unknown.
+    @return: a C{numpy.ndarray} of the area under each curve and a 2-D
+        C{numpy.ndarray} with their covariance matrix.
+    """
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    labels = np.asarray(labels, dtype=bool)
+    positives = scores[:, labels]
+    negatives = scores[:, ~labels]
+    m = positives.shape[1]
+    n = negatives.shape[1]
+    if m < 2 or n < 2:
+        raise ValueError('At least two positive and two negative reads are '
+                         'needed to compare ROC curves (got %d and %d).' %
+                         (m, n))
+
+    # Midranks within the positives, within the negatives and overall.
+    tx = np.vstack([rankdata(row) for row in positives])
+    ty = np.vstack([rankdata(row) for row in negatives])
+    tz = np.vstack([rankdata(row) for row in np.hstack([positives,
+                                                        negatives])])
+
+    areas = tz[:, :m].sum(axis=1) / m / n - (m + 1.0) / (2.0 * n)
+    # The structural components of each positive and each negative read.
+    v10 = (tz[:, :m] - tx) / n
+    v01 = 1.0 - (tz[:, m:] - ty) / m
+    covariance = (np.atleast_2d(np.cov(v10)) / m +
+                  np.atleast_2d(np.cov(v01)) / n)
+
+    return areas, covariance
+
+
+def delongTest(scores, labels):
+    """
+    Tests whether the areas under the ROC curves of each pair of scoring
+    schemes on the same reads differ, with DeLong's test.
+
+    @param scores: a 2-D array of scores with one row per scoring scheme and
+        one column per read.
+    @param labels: an array of C{bool}, C{True} for the reads that should be
+        found.
+    @raise ValueError: If there are fewer than two positive or fewer than
+        two negative reads (see delongCovariance).
+    @return: a C{numpy.ndarray} of the area under each curve and a 2-D
+        C{numpy.ndarray} of the two-sided p-values of all pairs of scoring
+        schemes.
+    """
+    areas, covariance = delongCovariance(scores, labels)
+    variances = np.diag(covariance)
+    difference = areas[:, np.newaxis] - areas[np.newaxis, :]
+    variance = (variances[:, np.newaxis] + variances[np.newaxis, :] -
+                2 * covariance)
+
+    # Without any variance, the areas are either identical or certainly
+    # different.
+    pValues = np.where(difference == 0, 1.0, 0.0)
+    hasVariance = variance > 0
+    pValues[hasVariance] = 2 * norm.sf(
+        np.abs(difference[hasVariance]) / np.sqrt(variance[hasVariance]))
+
+    return areas, pValues
+
+
+def compareSchemes(blastFiles, minIdentity, cache=False, cacheOnly=False):
+    """
+    Compares the areas under the ROC curves over all bit score thresholds
+    of all scoring schemes with DeLong's test. The blast files must contain
+    the same reads in the same order, as they do when the same reads are
+    blasted with different parameters.
+
+    @param blastFiles: Either a C{list} of files with blast output or a
+        C{str} glob pattern matching them.
+    @param minIdentity: reads with at least this level of sequence identity
+        should be found, all others should not.
+    @param cache: if C{True}, read the best hits from cache files next to
+        the blast files (see cachedBestHits).
+    @param cacheOnly: if C{True}, only read the best hits from the caches.
+    @raise ValueError: If the files do not have the same reads, or if there
+        are fewer than two reads that should be found or fewer than two that
+        should not.
+    @return: a sorted C{list} of the scoring schemes, a C{numpy.ndarray}
+        of the area under the curve of each and a 2-D C{numpy.ndarray} of
+        the p-values of all pairs, in the order of the list.
+    """
+    if isinstance(blastFiles, basestring):
+        blastFiles = sorted(glob(blastFiles))
+
+    schemeScores = {}
+    allIdentities = None
+    allQueries = None
+    for blastFile in blastFiles:
+        title, identities, scores, queries = readScores(
+            blastFile, cache=cache, cacheOnly=cacheOnly, withQueries=True)
+        if allQueries is None:
+            allIdentities = identities
+            allQueries = queries
+        elif not np.array_equal(queries, allQueries):
+            # The test needs the scores of each read in every file.
+            raise ValueError('The reads in %r are not the same reads, in '
+                             'the same order, as in the other files.' %
+                             blastFile)
+        schemeScores[title] = scores
+
+    scoringSchemes = sorted(schemeScores)
+    areas, pValues = delongTest(
+        np.vstack([schemeScores[scheme] for scheme in scoringSchemes]),
+        allIdentities >= minIdentity)
+
+    return scoringSchemes, areas, pValues
+
+
+class HitFollower(object):
+    """
+    Counts the hits in blast files that are still being written. Each call
+    to update only reads the records added since the previous call, so the
+    frequencies and areas under the curves can be watched as they converge.
+
+    @param cutoff: a bit score cutoff, reads below that will not be
+        considered.
+    """
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self._files = {}
+
+    def update(self, blastFiles):
+        """
+        Reads the complete records that were added to blast files since the
+        last update. A partly written last line is left for the next update.
+        A file that became shorter is assumed to have been rewritten and is
+        read again from its start.
+
+        @param blastFiles: Either a C{list} of files with blast output or a
+            C{str} glob pattern matching them, so that files of newly
+            started runs are picked up.
+        @raise ValueError: If two files have the same scoring scheme title.
+        @return: the C{int} number of new records that were read.
+        """
+        if isinstance(blastFiles, basestring):
+            blastFiles = sorted(glob(blastFiles))
+
+        count = 0
+        for blastFile in blastFiles:
+            state = self._files.get(blastFile)
+            if state is None or os.path.getsize(blastFile) < state['offset']:
+                title = _schemeTitle(blastFile)
+                for otherFile, otherState in self._files.iteritems():
+                    if otherState['title'] == title and otherFile != blastFile:
+                        raise ValueError(
+                            'Scoring scheme %r of %r was already found in '
+                            '%r.' % (title, blastFile, otherFile))
+                state = self._files[blastFile] = {
+                    'title': title,
+                    'offset': 0,
+                    'readsPerLevel': defaultdict(int),
+                    'readsTotal': defaultdict(int),
+                }
+            count += self._updateFile(blastFile, state)
+
+        return count
+
+    def _updateFile(self, blastFile, state):
+        """
+        Reads the complete records that were added to a blast file.
+
+        @param blastFile: a file with blast output.
+        @param state: the C{dict} with the offset and counts of the file.
+        @return: the C{int} number of new records that were read.
+        """
+        count = 0
+        with open(blastFile) as fp:
+            fp.seek(state['offset'])
+            while True:
+                line = fp.readline()
+                if not line.endswith('\n'):
+                    break
+                if state['offset'] and line.strip():
+                    query, score = _bestHitOfLine(line)
+                    level = query.split('|')[2]
+                    state['readsTotal'][level] += 1
+                    state['readsPerLevel'][level] += int(
+                        score is not None and score > self.cutoff)
+                    count += 1
+                # The first line holds the blast parameters.
+                state['offset'] += len(line)
+
+        return count
+
+    def hitDict(self):
+        """
+        Gets the number of reads that hit at each level so far.
+
+        @return: a C{dict} of hit counts as returned by sweep.
+        """
+        return dict((state['title'], dict(state['readsPerLevel']))
+                    for state in self._files.itervalues()
+                    if state['readsTotal'])
+
+    def totals(self):
+        """
+        Gets the total number of reads at each level so far.
+
+        @return: a C{dict} of totals as returned by sweep.
+        """
+        return dict((state['title'], dict(state['readsTotal']))
+                    for state in self._files.itervalues()
+                    if state['readsTotal'])
+
+    def frequencies(self):
+        """
+        Calculates the frequencies from the reads so far.
+
+        @return: a C{dict} as returned by calculateFrequencies.
+        """
+        return calculateFrequencies(self.hitDict(), self.totals())
+
+    def summary(self):
+        """
+        Calculates the area under the curve and the youden and F1 cutoffs
+        from the reads so far.
+
+        @return: a C{numpy.recarray} as returned by summarize.
+        """
+        return summarize(self.frequencies())
+
+
+# Quick estimates for early screening of scoring schemes, from a sample of
+# the reads at each level of sequence identity.
+
+def sampleBestHits(blastFile, readsPerLevel, seed=None):
+    """
+    Draws a random sample of reads at each level of sequence identity in a
+    single pass over a blast file, with one reservoir per level. Only the
+    lines of reads that are put into a reservoir are decoded.
+
+    @param blastFile: the name of a file with blast output, '-' for
+        standard input, an open file or an iterator of lines (see
+        blastRecords.blastLines).
+    @param readsPerLevel: the C{int} number of reads to sample at each level.
+    @param seed: an C{int} random seed, or C{None}.
+    @raise ValueError: If the file is empty.
+    @return: the name of the blastFile, a dictionary of the same form as
+        returned by bestHitScores for the sampled reads, and a dictionary
+        with the number of sampled reads at each level.
+    """
+    random = Random(seed)
+    reservoirs = defaultdict(list)
+    seen = defaultdict(int)
+
+    lines = blastRecords.blastLines(blastFile)
+    if next(lines, None) is None:
+        raise ValueError('JSON file %r was empty.' %
+                         blastRecords.blastName(blastFile))
+    for line in lines:
+        if not line.strip():
+            continue
+        match = QUERY_LEVEL_REGEX.search(line)
+        if match:
+            level = match.group(1)
+        else:
+            level = _bestHitOfLine(line)[0].split('|')[2]
+        seen[level] += 1
+        reservoir = reservoirs[level]
+        if len(reservoir) < readsPerLevel:
+            index = len(reservoir)
+            reservoir.append(None)
+        else:
+            index = random.randint(0, seen[level] - 1)
+            if index >= readsPerLevel:
+                continue
+        bits = _bestHitOfLine(line)[1]
+        reservoir[index] = np.nan if bits is None else bits
+
+    scores = {}
+    sampleTotals = {}
+    for level, reservoir in reservoirs.iteritems():
+        reservoir = np.array(reservoir, dtype=float)
+        scores[level] = np.sort(reservoir[~np.isnan(reservoir)])
+        sampleTotals[level] = len(reservoir)
+
+    return _schemeTitle(blastFile), scores, sampleTotals
+
+
+def overlappingIntervals(intervals, key='auc'):
+    """
+    Finds the pairs of scoring schemes whose confidence intervals overlap,
+    so that a sample cannot tell which of them is better.
+
+    @param intervals: a dictionary as returned by bootstrap.
+    @param key: the C{str} interval to compare, 'auc', 'youden' or 'f1'.
+    @return: a sorted C{list} of (scoringScheme, scoringScheme) tuples.
+    """
+    scoringSchemes = sorted(intervals)
+    lower = np.array([intervals[scheme][key][0] for scheme in scoringSchemes])
+    upper = np.array([intervals[scheme][key][1] for scheme in scoringSchemes])
+    overlap = ((lower[:, np.newaxis] <= upper[np.newaxis, :]) &
+               (lower[np.newaxis, :] <= upper[:, np.newaxis]))
+    return [(scoringSchemes[i], scoringSchemes[j])
+            for i, j in zip(*np.nonzero(np.triu(overlap, 1)))]
+
+
+def quickEstimate(blastFiles, cutoff, readsPerLevel=100, replicates=1000,
+                  confidence=0.95, seed=None):
+    """
+    Estimates the frequencies and the area under the curve of each scoring
+    scheme from a sample of the reads at each level, with bootstrap error
+    bars, and flags the schemes that need a full run to be told apart.
+
+    @param blastFiles: Either a C{list} of files with blast output or a
+        C{str} glob pattern matching them.
+    @param cutoff: a bit score cutoff, reads below that will not be considered.
+    @param readsPerLevel: the C{int} number of reads to sample at each level.
+    @param replicates: the C{int} number of bootstrap replicates.
+    @param confidence: the C{float} confidence level of the intervals.
+    @param seed: an C{int} random seed, or C{None}.
+    @raise ValueError: If two files have the same scoring scheme title.
+    @return: the frequencies dictionary of the sample, as returned by
+        calculateFrequencies, the confidence intervals as returned by
+        bootstrap, and the C{list} of pairs of scoring schemes whose area
+        under the curve intervals overlap.
+    """
+    if isinstance(blastFiles, basestring):
+        blastFiles = sorted(glob(blastFiles))
+
+    random = Random(seed)
+    hitDict = {}
+    totals = {}
+    for blastFile in blastFiles:
+        title, scores, sampleTotals = sampleBestHits(
+            blastFile, readsPerLevel, seed=random.randint(0, 2 ** 31))
+        if title in hitDict:
+            raise ValueError('Scoring scheme %r of %r was already found in '
+                             'another file.' % (title, blastFile))
+        hitDict[title] = countHitsAtCutoffs(scores, [cutoff])[cutoff]
+        totals[title] = sampleTotals
+
+    intervals = bootstrap(hitDict, totals, replicates=replicates,
+                          confidence=confidence,
+                          seed=random.randint(0, 2 ** 31))
+
+    return (calculateFrequencies(hitDict, totals), intervals,
+            overlappingIntervals(intervals))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+from json import loads
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from scripts import benchmarkRoc, rocAnalysis
+
+
+class TestSyntheticRecords(TestCase):
+    """
+    Tests for the synthetic blast record generator.
+    """
+    def testDeterministic(self):
+        """
+        The same arguments must give the same records.
+        """
+        first = list(benchmarkRoc.syntheticRecords(readsPerLevel=5, seed=3))
+        second = list(benchmarkRoc.syntheticRecords(readsPerLevel=5, seed=3))
+        self.assertEqual(first, second)
+
+    def testShape(self):
+        """
+        There must be the requested number of reads at each level, and reads
+        with hits must have the requested number of alignments.
+        """
+        records = list(benchmarkRoc.syntheticRecords(
+            readsPerLevel=4, levels=3, alignmentsPerRecord=2))
+        self.assertEqual(12, len(records))
+        self.assertEqual(['100', '50', '0'],
+                         sorted(set(record['query'].split('|')[2]
+                                    for record in records), key=float,
+                                reverse=True))
+        for record in records:
+            self.assertIn(len(record['alignments']), (0, 2))
+
+    def testFilesCanBeCounted(self):
+        """
+        The synthetic files must be readable by countHits.
+        """
+        directory = mkdtemp()
+        try:
+            filenames, total = benchmarkRoc.writeSyntheticSchemes(
+                directory, schemes=2, readsPerLevel=3, levels=2)
+            self.assertEqual([join(directory, 'scheme0.json'),
+                              join(directory, 'scheme1.json')], filenames)
+            self.assertEqual(12, total)
+            title, hits, totals = rocAnalysis.countHits(filenames[0], 0,
+                                                        withTotals=True)
+            self.assertEqual({'100': 3, '0': 3}, totals)
+        finally:
+            rmtree(directory)
+
+
+class TestBenchmark(TestCase):
+    """
+    Tests for the benchmark function.
+    """
+    def testStages(self):
+        """
+        Every stage must be timed.
+        """
+        results = benchmarkRoc.benchmark(readsPerLevel=3, levels=4,
+                                         schemes=2)
+        self.assertEqual(['areaUnderCurve', 'calculateFrequencies',
+                          'countHits', 'f1Index', 'youdenIndex'],
+                         sorted(results['stages']))
+        for stage in results['stages'].itervalues():
+            self.assertEqual(24, stage['records'])
+            self.assertTrue(stage['peakRssKb'] > 0)
+
+    def testOutput(self):
+        """
+        main must write the results as JSON.
+        """
+        directory = mkdtemp()
+        try:
+            output = join(directory, 'results.json')
+            benchmarkRoc.main(['--readsPerLevel', '2', '--levels', '2',
+                               '--schemes', '1', '--output', output])
+            with open(output) as fp:
+                results = loads(fp.read())
+            self.assertEqual(1, results['config']['schemes'])
+        finally:
+            rmtree(directory)
@@ -0,0 +1,312 @@
+from unittest import TestCase, skipIf
+from cStringIO import StringIO
+from json import dumps
+from mock import patch
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from Bio import bgzf
+import bz2
+import gzip
+
+from scripts import blastRecords
+
+
+def _blastData(count):
+    """
+    Make the contents of a JSON blast output file.
+
+    @param count: the C{int} number of reads.
+    @return: A C{str} with one line of parameters followed by one line per
+        read.
+    """
+    lines = [dumps({'application': 'BLASTN'})]
+    for index in xrange(count):
+        lines.append(dumps({
+            'query': 'read%d|sim|100' % index,
+            'alignments': [
+                {
+                    'length': 24,
+                    'title': 'gi|887699|gb|DQ37780 Squirrelpox virus',
+                    'hsps': [
+                        {
+                            'bits': float(index),
+                            'sbjct_end': 24,
+                            'expect': 3.29804,
+                            'sbjct': 'TACCCTGCGGCCCGCTACGGCTGG',
+                            'sbjct_start': 1,
+                            'query': 'TACCCTGCGGCCCGCTACGGCTGG',
+                            'frame': [1, 1],
+                            'query_end': 24,
+                            'query_start': 1
+                        }
+                    ]
+                }
+            ]
+        }))
+    return '\n'.join(lines) + '\n'
+
+
+class TestCompressedFiles(TestCase):
+    """
+    Tests for reading compressed blast files.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.data = _blastData(2000)
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def _write(self, name, opener):
+        filename = join(self.tempDir, name)
+        fp = opener(filename)
+        fp.write(self.data)
+        fp.close()
+        return filename
+
+    def _check(self, filename, kind):
+        with open(filename, 'rb') as fp:
+            self.assertEqual(kind, blastRecords.compression(fp))
+        records = list(blastRecords.records(filename))
+        self.assertEqual(2000, len(records))
+        self.assertEqual('read1999|sim|100', records[-1].query)
+        self.assertEqual(1999.0, records[-1].alignments[0].hsps[0].bits)
+
+    def testPlain(self):
+        """
+        An uncompressed file must be read.
+        """
+        self._check(self._write('file.json', lambda f: open(f, 'w')), None)
+
+    def testGzip(self):
+        """
+        A gzip compressed file must be read, whatever its name.
+        """
+        self._check(self._write('file.json', lambda f: gzip.open(f, 'wb')),
+                    'gzip')
+
+    def testBz2(self):
+        """
+        A bzip2 compressed file must be read.
+        """
+        self._check(self._write('file.json.bz2',
+                                lambda f: bz2.BZ2File(f, 'w')), 'bz2')
+
+    def testBz2Streams(self):
+        """
+        A bzip2 file with several streams, as written by pbzip2, must be
+        read to its end.
+        """
+        half = self.data.index('\n', len(self.data) // 2) + 1
+        filename = join(self.tempDir, 'file.json.bz2')
+        with open(filename, 'wb') as fp:
+            fp.write(bz2.compress(self.data[:half]))
+            fp.write(bz2.compress(self.data[half:]))
+        self._check(filename, 'bz2')
+
+    @skipIf(blastRecords.lzma is None, 'No lzma module.')
+    def testXz(self):
+        """
+        An xz compressed file must be read.
+        """
+        self._check(self._write('file.json.xz',
+                                lambda f: blastRecords.lzma.LZMAFile(f, 'w')),
+                    'xz')
+
+    def testXzWithoutLzma(self):
+        """
+        Reading an xz compressed file without the lzma module must raise
+        ValueError.
+        """
+        self.data = blastRecords.XZ_MAGIC + self.data
+        filename = self._write('file.json.xz', lambda f: open(f, 'wb'))
+        with patch.object(blastRecords, 'lzma', None):
+            self.assertRaises(ValueError, list,
+                              blastRecords.records(filename))
+
+    def testBgzf(self):
+        """
+        A BGZF file must be read.
+        """
+        self._check(self._write('file.json.gz',
+                                lambda f: bgzf.BgzfWriter(f, 'wb')), 'bgzf')
+
+    def testEmpty(self):
+        """
+        An empty compressed file must raise ValueError.
+        """
+        self.data = ''
+        filename = self._write('file.json.gz', lambda f: gzip.open(f, 'wb'))
+        self.assertRaises(ValueError, list, blastRecords.records(filename))
+
+
+class TestBgzfBlocks(TestCase):
+    """
+    Tests for random access to BGZF files.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.data = _blastData(2000)
+        self.filename = join(self.tempDir, 'file.json.gz')
+        fp = bgzf.BgzfWriter(self.filename, 'wb')
+        fp.write(self.data)
+        fp.close()
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def testBlocks(self):
+        """
+        The blocks must cover the file and decompress to its data.
+        """
+        blocks = blastRecords.bgzfBlocks(self.filename)
+        self.assertTrue(len(blocks) > 2)
+        for (offset, size), (nextOffset, _) in zip(blocks, blocks[1:]):
+            self.assertEqual(offset + size, nextOffset)
+        self.assertEqual(self.data,
+                         blastRecords.readBgzfBlocks(self.filename, blocks))
+
+    def testSomeBlocks(self):
+        """
+        Reading some blocks must give the matching part of the data.
+        """
+        blocks = blastRecords.bgzfBlocks(self.filename)
+        first = blastRecords.readBgzfBlocks(self.filename, blocks[:1])
+        rest = blastRecords.readBgzfBlocks(self.filename, blocks[1:])
+        self.assertEqual(self.data, first + rest)
+
+    def testNotBgzf(self):
+        """
+        Finding the blocks of a file that is not BGZF must raise ValueError.
+        """
+        filename = join(self.tempDir, 'file.json')
+        with open(filename, 'w') as fp:
+            fp.write(self.data)
+        self.assertRaises(ValueError, blastRecords.bgzfBlocks, filename)
+
+
+def _queries(records):
+    """
+    Get the queries of the records of a chunk, for use with mapChunks.
+    """
+    return [record['query'] for record in records]
+
+
+class TestChunks(TestCase):
+    """
+    Tests for parsing a blast file in chunks.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.data = _blastData(500)
+        self.filename = join(self.tempDir, 'file.json')
+        with open(self.filename, 'w') as fp:
+            fp.write(self.data)
+        self.queries = ['read%d|sim|100' % index for index in xrange(500)]
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def testRangesAreLines(self):
+        """
+        The chunk ranges must follow each other, start on line boundaries,
+        and cover everything after the parameters line.
+        """
+        ranges = blastRecords.chunkRanges(self.filename, 1000)
+        self.assertTrue(len(ranges) > 10)
+        self.assertEqual(self.data.index('\n') + 1, ranges[0][0])
+        self.assertEqual(len(self.data), ranges[-1][1])
+        for (start, end), (nextStart, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, nextStart)
+            self.assertEqual('\n', self.data[start - 1])
+
+    def testTinyChunks(self):
+        """
+        Chunks smaller than a line must still give every record once.
+        """
+        queries = []
+        for start, end in blastRecords.chunkRanges(self.filename, 1):
+            queries.extend(_queries(
+                blastRecords.chunkRecords(self.filename, start, end)))
+        self.assertEqual(self.queries, queries)
+
+    def testCompressed(self):
+        """
+        Splitting a compressed file must raise ValueError.
+        """
+        filename = join(self.tempDir, 'file.json.gz')
+        fp = gzip.open(filename, 'wb')
+        fp.write(self.data)
+        fp.close()
+        self.assertRaises(ValueError, blastRecords.chunkRanges, filename)
+
+    def testMapChunksInProcess(self):
+        """
+        mapChunks must give the partial results in file order.
+        """
+        results = blastRecords.mapChunks(self.filename, _queries,
+                                         processes=1, chunkSize=5000)
+        self.assertEqual(self.queries, sum(results, []))
+
+    def testMapChunksInPool(self):
+        """
+        mapChunks must give the same results using worker processes.
+        """
+        results = blastRecords.mapChunks(self.filename, _queries,
+                                         processes=2, chunkSize=5000)
+        self.assertEqual(self.queries, sum(results, []))
+
+    def testUnordered(self):
+        """
+        Unordered results must hold all the records.
+        """
+        records = blastRecords.parallelJsonRecords(
+            self.filename, processes=2, chunkSize=5000, ordered=False)
+        self.assertEqual(sorted(self.queries),
+                         sorted(record['query'] for record in records))
+
+
+class TestStreams(TestCase):
+    """
+    Tests for reading blast output from streams.
+    """
+    def setUp(self):
+        self.data = _blastData(10)
+
+    def testFileObject(self):
+        """
+        Records must be read from an open file.
+        """
+        records = list(blastRecords.records(StringIO(self.data)))
+        self.assertEqual(10, len(records))
+
+    def testLines(self):
+        """
+        Records must be read from an iterator of lines.
+        """
+        lines = iter(self.data.splitlines(True))
+        records = list(blastRecords.jsonRecords(lines))
+        self.assertEqual('read9|sim|100', records[-1]['query'])
+
+    def testStdin(self):
+        """
+        Records must be read from standard input if the name is '-'.
+        """
+        with patch('sys.stdin', StringIO(self.data)):
+            records = list(blastRecords.records('-'))
+        self.assertEqual(10, len(records))
+
+    def testEmptyStream(self):
+        """
+        An empty stream must raise ValueError.
+        """
+        self.assertRaises(ValueError, list, blastRecords.records(iter([])))
+
+    def testBlastName(self):
+        """
+        Streams must be named after their file, or after standard input.
+        """
+        self.assertEqual('<stdin>', blastRecords.blastName('-'))
+        self.assertEqual('x.json', blastRecords.blastName('x.json'))
+        self.assertEqual('<stream>', blastRecords.blastName(iter([])))
@@ -1,11 +1,65 @@
 from unittest import TestCase
 from json import dumps
 from mock import patch
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from random import Random
+from StringIO import StringIO
+from matplotlib.image import imread
+import matplotlib.pylab as plt
+import numpy as np
 
-from scripts import nicola
+from scripts import blastRecords, nicola
 from mocking import mockOpen
 
 
+# The order in which the regexes of each way of coloring have always been
+# tried by _getBird, one after another, with the colour of each.
+CASCADES = {
+    'all': [
+        (nicola.ANSERIFORMESREGEX, nicola.ANSERIFORMES),
+        (nicola.CHARADRIIFORMESREGEX, nicola.CHARADRIIFORMES),
+        (nicola.PELICANIFORMESREGEX, nicola.PELICANIFORMES),
+        (nicola.DOMESTICREGEX, nicola.DOMESTIC),
+        (nicola.COLUMBIFORMESREGEX, nicola.COLUMBIFORMES),
+        (nicola.PASSERIFORMESREGEX, nicola.PASSERIFORMES),
+        (nicola.PSITTATICIFORMESREGEX, nicola.PSITTATICIFORMES),
+        (nicola.RAPTORREGEX, nicola.RAPTOR),
+        (nicola.INDETERMINATEHOSTREGEX, nicola.INDETERMINATEHOST),
+        (None, nicola.NEITHER),
+    ],
+    'anseriformes and charadriiformes': [
+        (nicola.ANATINAEREGEX, nicola.ANATINAE),
+        (nicola.AYTHYAREGEX, nicola.AYTHYA),
+        (nicola.MERGINIREGEX, nicola.MERGINI),
+        (nicola.TADORNINIREGEX, nicola.TADORNINI),
+        (nicola.SWANREGEX, nicola.SWAN),
+        (nicola.GOOSEREGEX, nicola.GOOSE),
+        (nicola.GULLREGEX, nicola.GULL),
+        (nicola.TERNREGEX, nicola.TERN),
+        (nicola.WADERREGEX, nicola.WADER),
+        (nicola.AUKREGEX, nicola.AUK),
+        (nicola.DOMESTICREGEX, nicola.DOMESTIC),
+        (None, nicola.OTHER),
+    ],
+}
+
+
+def _cascadeBird(title, cascade):
+    """
+    Colours a title by searching it with one regex after another.
+
+    @param title: The C{str} title.
+    @param cascade: A C{list} of (regex, colour) pairs, the last with a
+        C{None} regex for the colour of titles no regex matches.
+    @return: The C{str} colour.
+    """
+    for regex, color in cascade:
+        if regex is None or regex.search(title):
+            return color
+
+
 class TestGetBird(TestCase):
     """
     Tests for the _getBird function.
@@ -32,6 +86,65 @@ class TestGetBird(TestCase):
         result = nicola._getBird(title, colorBy='all')
         self.assertEqual(result, nicola.CHARADRIIFORMES)
 
+    def test_getBirdPriority(self):
+        """
+        The first group in priority order must win, wherever its word is in
+        the title.
+        """
+        self.assertEqual(nicola.ANSERIFORMES,
+                         nicola._getBird('gull and duck', colorBy='all'))
+        self.assertEqual(nicola.ANSERIFORMES,
+                         nicola._getBird('duck and gull', colorBy='all'))
+
+    def test_getBirdOverlappingWords(self):
+        """
+        A word starting inside another word must be found.
+        """
+        title = 'A/GOOSANDER/Sweden/1/2002'
+        result = nicola._getBird(title, colorBy='anseriformes '
+                                                'and charadriiformes')
+        self.assertEqual(result, nicola.MERGINI)
+
+    def test_getBirdUnknownColorBy(self):
+        self.assertEqual(None, nicola._getBird('duck', colorBy='nothing'))
+
+    def test_getBirds(self):
+        """
+        _getBirds must give the colours _getBird gives.
+        """
+        titles = ['duck', 'gull', 'pigeon', 'nothing', 'duck', u'Eagle']
+        for colorBy in 'all', 'anseriformes and charadriiformes':
+            self.assertEqual(
+                [nicola._getBird(title, colorBy) for title in titles],
+                nicola._getBirds(titles, colorBy=colorBy))
+
+    def test_getBirdMatchesCascade(self):
+        """
+        _getBird and _getBirds must give the colour of the first group (in
+        the order the groups were always tried in) whose regex matches the
+        title, for the words of every group, for titles with the words of
+        two groups (in either order) and for titles with no group's words.
+        """
+        for colorBy, cascade in CASCADES.items():
+            words = [word for regex, _ in cascade[:-1]
+                     for word in regex.pattern.split('|')]
+            titles = (
+                ['A/%s/Sweden/1/2002(H5N1)' % word for word in words] +
+                [word.upper() for word in words] +
+                ['%s and %s' % (first, second)
+                 for first in words for second in words] +
+                ['', 'nothing', 'A/environment/Sweden/1/2002(H5N1)',
+                 u'A/Mongolia/1/2002', 'ducktern', 'gullduck'])
+            expected = [_cascadeBird(title, cascade) for title in titles]
+            # Every group, and no group, must have been tried.
+            self.assertEqual(set(color for _, color in cascade),
+                             set(expected))
+            self.assertEqual(
+                expected,
+                [nicola._getBird(title, colorBy) for title in titles])
+            self.assertEqual(expected,
+                             nicola._getBirds(titles, colorBy=colorBy))
+
 
 class TestColorByContinent(TestCase):
     """
@@ -48,6 +161,192 @@ class TestColorByContinent(TestCase):
         self.assertEqual(result, 'white')
 
 
+class TestTitleAnnotations(TestCase):
+    """
+    Tests for the TitleAnnotations cache.
+    """
+    TITLE = ('gb:CY035839|Organism:Influenza A virus '
+             '(A/mallard/Sweden/49/2002(H7N9))|Strain Name:A/mallard/Sweden/'
+             '49/2002|Segment:4|Subtype:H7N9|Host:Avian')
+
+    def testAnnotation(self):
+        """
+        The annotation must hold the bird, the continent and the short title.
+        """
+        annotation = nicola.TitleAnnotations().annotate(self.TITLE)
+        self.assertEqual(nicola.ANSERIFORMES, annotation.bird)
+        self.assertEqual(nicola.EURASIA, annotation.continent)
+        self.assertEqual(' (A/mallard/Sweden/49/2002(H7N9))/4',
+                         annotation.shortTitle)
+
+    def testShortTitleOfOddTitle(self):
+        """
+        A title without the usual fields must be its own short title.
+        """
+        annotation = nicola.TitleAnnotations().annotate('odd title')
+        self.assertEqual('odd title', annotation.shortTitle)
+
+    def testHitsAndMisses(self):
+        """
+        Titles must be cached per colorBy mode.
+        """
+        annotations = nicola.TitleAnnotations()
+        annotations.annotate(self.TITLE)
+        annotations.annotate(self.TITLE)
+        annotation = annotations.annotate(
+            self.TITLE, colorBy='anseriformes and charadriiformes')
+        self.assertEqual(nicola.ANATINAE, annotation.bird)
+        stats = annotations.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(2, stats['length'])
+
+    def testLeastRecentlyUsedIsDropped(self):
+        """
+        When the cache is full, the least recently used title is dropped.
+        """
+        annotations = nicola.TitleAnnotations(size=2)
+        annotations.annotate('a')
+        annotations.annotate('b')
+        annotations.annotate('a')
+        annotations.annotate('c')
+        annotations.annotate('a')
+        self.assertEqual(2, annotations.stats()['hits'])
+        annotations.annotate('b')
+        stats = annotations.stats()
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(2, stats['evictions'])
+
+    def testResize(self):
+        """
+        Making the cache smaller must drop annotations.
+        """
+        annotations = nicola.TitleAnnotations()
+        annotations.annotateAll(['a', 'b', 'c'])
+        annotations.resize(1)
+        stats = annotations.stats()
+        self.assertEqual(1, stats['length'])
+        self.assertEqual(2, stats['evictions'])
+
+    def testZeroSize(self):
+        """
+        A cache that could not hold any annotation must be rejected.
+        """
+        self.assertRaises(ValueError, nicola.TitleAnnotations, size=0)
+
+    def testResizeToZero(self):
+        """
+        Resizing the cache so it could not hold any annotation must be
+        rejected, and must leave the cache as it was.
+        """
+        annotations = nicola.TitleAnnotations()
+        annotations.annotateAll(['a', 'b'])
+        self.assertRaises(ValueError, annotations.resize, 0)
+        self.assertEqual(2, annotations.stats()['length'])
+
+
+class TestTitleAnnotationTable(TestCase):
+    """
+    Tests for the title annotation table of a reference database.
+    """
+    TITLES = [
+        'gb:CY035839|Organism:Influenza A virus (A/mallard/Sweden/49/2002'
+        '(H7N9))|Strain Name:A/mallard/Sweden/49/2002|Segment:4',
+        'gb:CY1|Organism:Influenza A virus (A/gull/Alaska/1/2008(H13N6))'
+        '|Strain Name:A/gull/Alaska/1/2008|Segment:4',
+        'gb:CY2|Organism:Influenza A virus (A/chicken/Chile/1/2002(H7N3))'
+        '|Strain Name:A/chicken/Chile/1/2002|Segment:6',
+        'an odd title',
+    ]
+
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.fastaName = join(self.tempDir, 'reference.fasta')
+        with open(self.fastaName, 'w') as fp:
+            for title in self.TITLES:
+                fp.write('>%s\nACGT\n' % title)
+
+    def tearDown(self):
+        nicola.useTitleAnnotationTable(None)
+        rmtree(self.tempDir)
+
+    def testTableMatchesRules(self):
+        """
+        The table must give the annotations the rules give.
+        """
+        table = nicola.makeTitleAnnotationTable(self.fastaName)
+        self.assertTrue(exists(self.fastaName + '.titles.npz'))
+        self.assertEqual(4, len(table))
+        self.assertEqual(1, table.titleId(self.TITLES[1]))
+        rules = nicola.TitleAnnotations()
+        for title in self.TITLES:
+            for colorBy in 'all', 'anseriformes and charadriiformes':
+                self.assertEqual(rules.annotate(title, colorBy),
+                                 table.annotate(title, colorBy))
+        self.assertEqual(None, table.annotate('not in the table'))
+
+    def testUseTable(self):
+        """
+        Once a table is in use, titles in it must be taken from it.
+        """
+        nicola.useTitleAnnotationTable(self.fastaName)
+        nicola.TITLEANNOTATIONS.clear()
+        nicola._annotateTitles(self.TITLES + ['not in the table'])
+        stats = nicola.TITLEANNOTATIONS.stats()
+        self.assertEqual(4, stats['tableHits'])
+        self.assertEqual(1, stats['misses'])
+
+    def testRulesChange(self):
+        """
+        The table must be out of date if the rules change.
+        """
+        nicola.makeTitleAnnotationTable(self.fastaName)
+        nicola.loadTitleAnnotationTable(self.fastaName, rebuild=False)
+        with patch('scripts.nicola.EURASIA', 'blue'):
+            self.assertRaises(ValueError, nicola.loadTitleAnnotationTable,
+                              self.fastaName, rebuild=False)
+            table = nicola.loadTitleAnnotationTable(self.fastaName)
+            self.assertEqual('blue', table.annotate(self.TITLES[0]).continent)
+
+    def testCorruptTable(self):
+        """
+        A table file that is not a table must be out of date.
+        """
+        with open(self.fastaName + '.titles.npz', 'wb') as fp:
+            fp.write('not a table')
+        self.assertRaises(ValueError, nicola.loadTitleAnnotationTable,
+                          self.fastaName, rebuild=False)
+        table = nicola.useTitleAnnotationTable(self.fastaName)
+        self.assertEqual(4, len(table))
+        nicola.loadTitleAnnotationTable(self.fastaName, rebuild=False)
+
+    def testTruncatedTable(self):
+        """
+        A truncated table file must be out of date.
+        """
+        tableFile = self.fastaName + '.titles.npz'
+        nicola.makeTitleAnnotationTable(self.fastaName)
+        with open(tableFile, 'rb') as fp:
+            data = fp.read()
+        with open(tableFile, 'wb') as fp:
+            fp.write(data[:len(data) // 2])
+        self.assertRaises(ValueError, nicola.loadTitleAnnotationTable,
+                          self.fastaName, rebuild=False)
+        table = nicola.loadTitleAnnotationTable(self.fastaName)
+        self.assertEqual(4, len(table))
+
+    def testOldFormatTable(self):
+        """
+        A table file without the expected arrays must be out of date.
+        """
+        with open(self.fastaName + '.titles.npz', 'wb') as fp:
+            np.savez(fp, fingerprint=nicola._annotationRulesFingerprint())
+        self.assertRaises(ValueError, nicola.loadTitleAnnotationTable,
+                          self.fastaName, rebuild=False)
+        table = nicola.loadTitleAnnotationTable(self.fastaName)
+        self.assertEqual(4, len(table))
+
+
 class TestComputePercentIdIdentity(TestCase):
     """
     Tests for the computePercentId function.
@@ -155,6 +454,109 @@ class TestComputePercentIdIdentity(TestCase):
             self.assertEqual(result, 95.83333333333334)
 
 
+def _alignment(query, sbjct, length=2885):
+    """
+    Make an alignment with one HSP.
+
+    @param query: the C{str} aligned query.
+    @param sbjct: the C{str} aligned subject.
+    @param length: the C{int} length of the subject.
+    @return: A C{Bio.Blast.Record.Alignment} instance.
+    """
+    record = blastRecords.convertDictToBlastRecord({
+        'query': 'H6E8I1T01BFUH9',
+        'alignments': [
+            {
+                'length': length,
+                'hsps': [
+                    {
+                        'bits': 20,
+                        'sbjct_end': 15400,
+                        'expect': 3.29804,
+                        'sbjct': sbjct,
+                        'sbjct_start': 15362,
+                        'query': query,
+                        'frame': [1, 1],
+                        'query_end': 68,
+                        'query_start': 28
+                    }
+                ],
+                'title': 'Merkel1'
+            }
+        ]
+    })
+    return record.alignments[0]
+
+
+class TestComputePercentIds(TestCase):
+    """
+    Tests for the computePercentIds function.
+    """
+    def testSameAsComputePercentId(self):
+        """
+        The identities must be exactly those of computePercentId, including
+        for sequences of different lengths.
+        """
+        random = Random(0)
+        alignments = []
+        for _ in xrange(200):
+            query = ''.join(random.choice('ACGT-')
+                            for _ in xrange(random.randint(1, 60)))
+            sbjct = ''.join(random.choice('ACGT-')
+                            for _ in xrange(random.randint(0, 60)))
+            alignments.append(_alignment(query, sbjct))
+        alignments.append(_alignment(u'TACCCTGCGGCCCGCTACGGCTGG',
+                                     u'TACCCTGCGGCCCGC-ACGGCTGG'))
+        self.assertEqual(map(nicola.computePercentId, alignments),
+                         nicola.computePercentIds(alignments).tolist())
+        self.assertEqual(95.83333333333334,
+                         nicola.computePercentIds(alignments)[-1])
+
+    def testLongerSubject(self):
+        """
+        A subject longer than its query must only be compared as far as the
+        query goes.
+        """
+        alignments = [_alignment('TACG', 'TACCGG'),
+                      _alignment('TACCGG', 'TACCGG')]
+        self.assertEqual([75.0, 100.0],
+                         nicola.computePercentIds(alignments).tolist())
+        self.assertEqual(75.0, nicola.computePercentId(alignments[0]))
+
+    def testNoAlignments(self):
+        """
+        No alignments must give no identities.
+        """
+        self.assertEqual([], nicola.computePercentIds([]).tolist())
+
+    def testUngapped(self):
+        """
+        With the ungapped denominator, columns with gaps must be left out.
+        """
+        alignments = [_alignment('TAC-GG', 'TTCAG-'),
+                      _alignment('--', '--')]
+        result = nicola.computePercentIds(alignments, denominator='ungapped')
+        self.assertEqual(75.0, result[0])
+        self.assertTrue(np.isnan(result[1]))
+
+    def testAlignmentLength(self):
+        """
+        With the alignmentLength denominator, the identical bases must be
+        divided by the length of the subject.
+        """
+        alignments = [_alignment('TACG', 'TACC', length=6)]
+        result = nicola.computePercentIds(alignments,
+                                          denominator='alignmentLength')
+        self.assertEqual(50.0, result[0])
+
+    def testUnknownDenominator(self):
+        """
+        An unknown denominator must raise ValueError.
+        """
+        self.assertRaises(ValueError, nicola.computePercentIds, [],
+                          denominator='read')
+
+
 class TestDistancePlot(TestCase):
     """
     Testing whether the distancePlot function returns the right thing
@@ -212,3 +614,334 @@ class TestDistancePlot(TestCase):
                 dist, distances = nicola.distancePlot(record)
                 self.assertEqual(dist, 20)
                 self.assertEqual(2, distances)
+
+    def testOneArtistPerKind(self):
+        """
+        The dots, grid lines and continent bands must each be drawn as one
+        collection, whatever the number of hits.
+        """
+        alignments = []
+        for index in xrange(25):
+            alignment = _alignment('TACCCTGCGG', 'TACCCTGCGG')
+            alignment.hsps[0].bits = 100 - index
+            alignment.title = ('gb:CY%d|Organism:Influenza A virus '
+                               '(A/mallard/Alberta/%d/1999(H5N1))|Strain '
+                               'Name:A/mallard/Alberta/1/1999|Segment:4'
+                               % (index, index))
+            alignments.append(alignment)
+        record = blastRecords.convertDictToBlastRecord({
+            'query': 'H6E8I1T01BFUH9', 'alignments': []})
+        record.alignments = alignments
+        figure = plt.figure()
+        try:
+            figures = plt.get_fignums()
+            ax = figure.add_subplot(111)
+            self.assertEqual((100, 25), nicola.distancePlot(record,
+                                                            readsAx=ax))
+            self.assertEqual(figures, plt.get_fignums())
+            self.assertEqual(1, len(ax.lines))
+            self.assertEqual(3, len(ax.collections))
+            self.assertEqual((-0.5, 24.5), tuple(ax.dataLim.intervalx))
+            self.assertEqual((76, 100), tuple(ax.dataLim.intervaly))
+        finally:
+            plt.close('all')
+
+    def testSavedFigureIsClosed(self):
+        """
+        Once the plot is saved, its figure must be closed.
+        """
+        tempDir = mkdtemp()
+        try:
+            record = blastRecords.convertDictToBlastRecord(
+                _panelRecord('read0', 3))
+            imageFile = join(tempDir, 'plot.png')
+            figures = plt.get_fignums()
+            nicola.distancePlot(record, imageFile=imageFile)
+            self.assertTrue(exists(imageFile))
+            self.assertEqual(figures, plt.get_fignums())
+        finally:
+            rmtree(tempDir)
+
+
+def _panelRecord(query, hits):
+    """
+    Make a JSON blast record of a read with hits on IRD titles.
+
+    @param query: the C{str} query.
+    @param hits: the C{int} number of hits.
+    @return: A C{dict} record.
+    """
+    alignments = []
+    for index in xrange(hits):
+        alignments.append({
+            'length': 10,
+            'title': ('gb:CY%d|Organism:Influenza A virus (A/mallard/'
+                      'Alberta/%d/1999(H5N1))|Strain Name:A/mallard/'
+                      'Alberta/1/1999|Segment:4' % (index, index)),
+            'hsps': [
+                {
+                    'bits': 50.0 + index,
+                    'expect': 1e-10,
+                    'frame': [1, 1],
+                    'query': 'TACCCTGCGG',
+                    'query_start': 1,
+                    'query_end': 10,
+                    'sbjct': 'TACCCTGCGG',
+                    'sbjct_start': 1,
+                    'sbjct_end': 10,
+                }
+            ]
+        })
+    return {'query': query, 'alignments': alignments}
+
+
+class TestRenderedTiles(TestCase):
+    """
+    Tests for rendering the tiles of a distance panel to files.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.blastFile = join(self.tempDir, 'file.json')
+        with open(self.blastFile, 'w') as fp:
+            fp.write(dumps({'application': 'BLASTN'}) + '\n')
+            for index in xrange(4):
+                fp.write(dumps(_panelRecord('read%d' % index, index + 1)) +
+                         '\n')
+        self.matrix = {'read0': (0, 1), 'read2': (3, 0), 'read3': (1, 1)}
+        self.outputDir = self.tempDir + '/'
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def _check(self, processes):
+        tiles = list(nicola._renderedTiles(
+            self.blastFile, self.matrix, self.outputDir, 'bit', 'all', True,
+            processes))
+        self.assertEqual([('read0', 0, 1, 50.0, 1),
+                          ('read2', 3, 0, 52.0, 3),
+                          ('read3', 1, 1, 53.0, 4)], tiles)
+        for name in '0-1.svg', '3-0.svg', '1-1.svg':
+            self.assertTrue(exists(join(self.tempDir, name)))
+        self.assertFalse(exists(join(self.tempDir, '0-0.svg')))
+
+    def testInProcess(self):
+        """
+        Rendering in this process must save the tiles of the reads in the
+        matrix and give their largest distances and numbers of hits.
+        """
+        self._check(1)
+
+    def testInPool(self):
+        """
+        Rendering in worker processes must give the same results, also
+        after fonts were loaded in this process.
+        """
+        self._check(1)
+        self._check(2)
+
+    def testTilesOnly(self):
+        """
+        Without a panel, the tiles must be written without making any
+        pyplot figures, and the largest distance and number of reads must
+        be returned, without printing anything.
+        """
+        figures = plt.get_fignums()
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            result = nicola.distancePanel(self.blastFile, self.matrix,
+                                          outputDir=self.outputDir,
+                                          panel=False)
+        self.assertEqual('', stdout.getvalue())
+        self.assertEqual((53.0, 4), result)
+        self.assertTrue(exists(join(self.tempDir, '1-1.svg')))
+        self.assertEqual(figures, plt.get_fignums())
+
+    def testTilesOnlyNeedOutputDir(self):
+        """
+        Without a panel, not giving an output directory must raise
+        ValueError.
+        """
+        self.assertRaises(ValueError, nicola.distancePanel, self.blastFile,
+                          self.matrix, panel=False)
+
+
+class TestHalve(TestCase):
+    """
+    Tests for halving images for mosaic pyramids.
+    """
+    def testAverage(self):
+        """
+        Each pixel must be the rounded average of a block of 2x2 pixels.
+        """
+        image = np.array([[[0], [255]], [[2], [1]]], dtype=np.uint8)
+        self.assertEqual([[[65]]], nicola._halve(image).tolist())
+
+    def testOdd(self):
+        """
+        An odd last row or column must be left out.
+        """
+        image = np.zeros((5, 7, 3), dtype=np.uint8)
+        self.assertEqual((2, 3, 3), nicola._halve(image).shape)
+
+
+class TestDistanceMosaic(TestCase):
+    """
+    Tests for making a distance panel as one image.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.blastFile = join(self.tempDir, 'file.json')
+        with open(self.blastFile, 'w') as fp:
+            fp.write(dumps({'application': 'BLASTN'}) + '\n')
+            for index in xrange(4):
+                fp.write(dumps(_panelRecord('read%d' % index, index + 1)) +
+                         '\n')
+        self.matrix = {'read0': (0, 1), 'read2': (3, 0), 'read3': (1, 1)}
+        self.mosaicFile = join(self.tempDir, 'mosaic.png')
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def _mosaic(self, **kwargs):
+        return nicola.distanceMosaic(self.blastFile, self.matrix,
+                                     self.mosaicFile, tileSize=(100, 60),
+                                     dpi=20, **kwargs)
+
+    def testTiles(self):
+        """
+        The image must have a header and a tile of a fixed size for each
+        place in the panel, and only the tiles of reads in the matrix may be
+        drawn on.
+        """
+        self.assertEqual([self.mosaicFile], self._mosaic())
+        image = imread(self.mosaicFile)
+        self.assertEqual((30 + 53 * 60, 8 * 100), image.shape[:2])
+
+        def tile(row, col):
+            return image[30 + row * 60:30 + (row + 1) * 60,
+                         col * 100:(col + 1) * 100, :3]
+
+        self.assertTrue((tile(0, 0) == 1.0).all())
+        self.assertFalse((tile(0, 1) == 1.0).all())
+        self.assertFalse((tile(3, 0) == 1.0).all())
+        self.assertTrue((tile(52, 7) == 1.0).all())
+
+    def testInPool(self):
+        """
+        Drawing the tiles in worker processes must give the same image.
+        """
+        self._mosaic()
+        expected = imread(self.mosaicFile)
+        self._mosaic(processes=2)
+        self.assertTrue((expected == imread(self.mosaicFile)).all())
+
+    def testPyramid(self):
+        """
+        Each level of the pyramid must be half the size of the one before,
+        down to the size of a tile.
+        """
+        filenames = self._mosaic(pyramid=True)
+        self.assertEqual(
+            [self.mosaicFile] + [join(self.tempDir, 'mosaic-%d.png' % level)
+                                 for level in xrange(1, 7)],
+            filenames)
+        self.assertEqual((3210 // 64, 800 // 64),
+                         imread(filenames[-1]).shape[:2])
+
+    def testFromLines(self):
+        """
+        The image must be made from an iterator of lines, reading it once.
+        """
+        self._mosaic()
+        expected = imread(self.mosaicFile)
+        with open(self.blastFile) as fp:
+            lines = iter(fp.readlines())
+        nicola.distanceMosaic(lines, self.matrix, self.mosaicFile,
+                              tileSize=(100, 60), dpi=20)
+        self.assertTrue((expected == imread(self.mosaicFile)).all())
+
+    def testPercentIdWithoutIdentity(self):
+        """
+        Alignments without a percent identity must not stop the tiles being
+        scaled to the largest one.
+        """
+        record = _panelRecord('read0', 2)
+        for hsp in record['alignments'][0]['hsps']:
+            hsp['query'] = hsp['sbjct'] = ''
+        with open(self.blastFile, 'w') as fp:
+            fp.write(dumps({'application': 'BLASTN'}) + '\n')
+            fp.write(dumps(record) + '\n')
+        with patch.object(nicola.Figure, 'text') as text:
+            self._mosaic(distance='percentId')
+        self.assertEqual('X: 0 to 2, Y (% id): 0 to 100',
+                         text.call_args[0][2])
+
+
+class TestMakeDistanceMatrix(TestCase):
+    """
+    Tests for the makeDistanceMatrix function.
+    """
+    def testFromLines(self):
+        """
+        The matrix must be made from an iterator of lines, reading it once.
+        """
+        hsp = {'bits': 60, 'expect': 1e-20, 'frame': [1, 1],
+               'query': 'ACGT', 'query_start': 1, 'query_end': 4,
+               'sbjct': 'ACGT', 'sbjct_start': 1, 'sbjct_end': 4}
+        lowHsp = dict(hsp, bits=20)
+        lines = [dumps({'application': 'BLASTN'})]
+        lines.append(dumps({'query': 'q1', 'alignments': [
+            {'length': 4, 'title': 't1', 'hsps': [hsp]},
+            {'length': 4, 'title': 't2', 'hsps': [lowHsp]}]}))
+        lines.append(dumps({'query': 'q2', 'alignments': [
+            {'length': 4, 'title': 't2', 'hsps': [hsp]}]}))
+        matrix, titles, fastaList = nicola.makeDistanceMatrix(
+            iter(lines), ['q1', 'q2'])
+        self.assertEqual(['t1', 't2'], titles)
+        self.assertEqual([[60, 0.0], [0.0, 60]], matrix)
+
+    def testInChunks(self):
+        """
+        Parsing chunks of the file in worker processes must give the same
+        matrix and titles as reading it in this process, when the chunks do
+        not end where the lines do.
+        """
+        random = Random(7)
+        queries = ['q%d' % index for index in xrange(12)]
+        tempDir = mkdtemp()
+        try:
+            blastFile = join(tempDir, 'file.json')
+            with open(blastFile, 'w') as fp:
+                fp.write(dumps({'application': 'BLASTN'}) + '\n')
+                for query in queries:
+                    alignments = []
+                    for title in random.sample(['t%d' % index
+                                                for index in xrange(8)], 4):
+                        hsp = {'bits': random.choice([20, 55, 60, 75.5]),
+                               'expect': 1e-20, 'frame': [1, 1],
+                               'query': 'ACGT', 'query_start': 1,
+                               'query_end': 4, 'sbjct': 'ACGA',
+                               'sbjct_start': 1, 'sbjct_end': 4}
+                        alignments.append({'length': 4, 'title': title,
+                                           'hsps': [hsp]})
+                    fp.write(dumps({'query': query,
+                                    'alignments': alignments}) + '\n')
+
+            # Chunks much shorter than a line, so the chunk boundaries are
+            # inside lines and must be moved to their ends.
+            chunkRanges = blastRecords.chunkRanges
+            ranges = []
+
+            def smallChunkRanges(filename, chunkSize):
+                ranges.extend(chunkRanges(filename, chunkSize=100))
+                return ranges
+
+            expected = nicola.makeDistanceMatrix(blastFile, queries)
+            with patch('scripts.blastRecords.chunkRanges',
+                       side_effect=smallChunkRanges):
+                result = nicola.makeDistanceMatrix(blastFile, queries,
+                                                   processes=2)
+        finally:
+            rmtree(tempDir)
+
+        self.assertEqual(len(queries), len(ranges))
+        self.assertEqual(expected, result)
@@ -1,6 +1,67 @@
 from unittest import TestCase
+from collections import OrderedDict
+from json import dumps, loads
+from mock import patch
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
+import numpy as np
 
-from dark import rocAnalysis
+from scripts import rocAnalysis
+from mocking import mockOpen
+
+
+def _blastData(records):
+    """
+    Make the contents of a JSON blast output file.
+
+    @param records: A C{list} of (query, bits) tuples. If bits is C{None}
+        the query has no alignments.
+    @return: A C{str} with one line of parameters followed by one line per
+        record.
+    """
+    lines = [dumps({'application': 'BLASTN'})]
+    for query, bits in records:
+        alignments = []
+        if bits is not None:
+            alignments.append({
+                'length': 24,
+                'hsps': [
+                    {
+                        'bits': bits,
+                        'sbjct_end': 24,
+                        'expect': 3.29804,
+                        'sbjct': 'TACCCTGCGGCCCGCTACGGCTGG',
+                        'sbjct_start': 1,
+                        'query': 'TACCCTGCGGCCCGCTACGGCTGG',
+                        'frame': [1, 1],
+                        'query_end': 24,
+                        'query_start': 1
+                    }
+                ],
+                'title': 'subject'
+            })
+        lines.append(dumps({'query': query, 'alignments': alignments}))
+    return '\n'.join(lines) + '\n'
+
+
+def _mockOpener(records):
+    """
+    Make a mock for open that returns a new handle on the contents of a
+    JSON blast output file each time it is called.
+
+    @param records: A C{list} of (query, bits) tuples, as for _blastData.
+    """
+    data = _blastData(records)
+    mockOpener = mockOpen()
+    mockOpener.side_effect = lambda *args, **kwargs: mockOpen(
+        read_data=data)()
+    return mockOpener
+
+
+RECORDS = [('r1|sim|100', 60), ('r2|sim|100', 20), ('r3|sim|95', 55),
+           ('r4|sim|95', None), ('r5|sim|0', 45), ('r6|sim|0', 10)]
 
 
 class TestCalculateFrequencies(TestCase):
@@ -18,7 +79,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'raw': [594, 594, 594, 594, 592,
                                              560, 454, 328, 115, 56,
                                              23, 0, 0, 0, 0, 0, 0,
@@ -38,7 +100,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'fprs': [0.3134519801186468,
                                               0.2791245791245791,
                                               0.24118376749955697,
@@ -67,7 +130,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'tprs': [1.0, 1.0, 1.0, 1.0,
                                               0.9993265993265993,
                                               0.98989898989899,
@@ -101,7 +165,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'spcs': [0.6865480198813532,
                                               0.7208754208754209,
                                               0.758816232500443,
@@ -130,7 +195,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'tps': [594, 1188, 1782, 2376,
                                              2968, 3528, 3982, 4310,
                                              4425, 4481, 4504, 4504,
@@ -152,7 +218,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'tns': [8564, 8564, 8564, 8564, 8562,
                                              8528, 8388, 8122, 7643, 7105,
                                              6534, 5940, 5346, 4752, 4158,
@@ -172,7 +239,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'fps': [3910, 3316, 2722, 2128,
                                              1536, 976, 522, 194, 79,
                                              23, 0, 0, 0, 0, 0, 0, 0,
@@ -192,7 +260,8 @@ class TestCalculateFrequencies(TestCase):
                                   '90': 594, '100': 594, '95': 594,
                                   '10': 0, '15': 0, '55': 23, '30': 0,
                                   '50': 0, '35': 0}}
-        outDict = rocAnalysis.calculateFrequencies(inDict)
+        outDict = rocAnalysis.calculateFrequencies(
+            inDict, rocAnalysis.designTotals(inDict))
         outResult = {'blastn4-545': {'fns': [0, 0, 0, 0, 2, 36, 176, 442,
                                              921, 1459, 2030, 2624, 3218,
                                              3812, 4406, 5000, 5594, 6188,
@@ -202,6 +271,78 @@ class TestCalculateFrequencies(TestCase):
                          outResult['blastn4-545']['fns'])
 
 
+class TestFrequencyArrays(TestCase):
+    """
+    Tests for the frequencyArrays function.
+    """
+    def testFrequencyArrays(self):
+        """
+        frequencyArrays must return one row per scoring scheme, in sorted
+        order, that matches the output of calculateFrequencies.
+        """
+        hitDict = {
+            'b': dict((level, 594) for level in rocAnalysis.LEVELS),
+            'a': dict((level, i) for i, level in
+                      enumerate(rocAnalysis.LEVELS)),
+        }
+        totals = rocAnalysis.designTotals(hitDict)
+        schemes, levels, arrays = rocAnalysis.frequencyArrays(hitDict, totals)
+        self.assertEqual(['a', 'b'], schemes)
+        self.assertEqual(rocAnalysis.LEVELS, levels)
+        self.assertEqual((2, 22), arrays['tprs'].shape)
+        frequencies = rocAnalysis.calculateFrequencies(hitDict, totals)
+        for i, scheme in enumerate(schemes):
+            for key, array in arrays.items():
+                self.assertEqual(frequencies[scheme][key], list(array[i]))
+
+    def testFrequencyArraysWithTotals(self):
+        """
+        frequencyArrays must use the given levels and totals, and count
+        levels missing from a scoring scheme as 0.
+        """
+        hitDict = {'a': {'100': 8, '97.5': 3, '50': 1},
+                   'b': {'100': 10}}
+        totals = {'a': {'100': 10, '97.5': 5, '50': 20},
+                  'b': {'100': 10, '97.5': 5, '50': 20}}
+        schemes, levels, arrays = rocAnalysis.frequencyArrays(hitDict,
+                                                              totals)
+        self.assertEqual(['100', '97.5', '50'], levels)
+        self.assertEqual([[8, 3, 1], [10, 0, 0]], arrays['raw'].tolist())
+        self.assertEqual([8, 11, 12], arrays['tps'][0].tolist())
+        self.assertEqual([4, 1, 0], arrays['fps'][0].tolist())
+        self.assertEqual([2, 4, 23], arrays['fns'][0].tolist())
+        self.assertEqual([21, 19, 0], arrays['tns'][0].tolist())
+        self.assertEqual([0.8, 11.0 / 15, 12.0 / 35],
+                         arrays['tprs'][0].tolist())
+        self.assertEqual([4.0 / 25, 1.0 / 20, 0.0],
+                         arrays['fprs'][0].tolist())
+
+    def testMissingTotals(self):
+        """
+        A scoring scheme without totals, or totals without hit counts, must
+        raise ValueError naming the scoring scheme.
+        """
+        hitDict = {'a': {'100': 8}, 'b': {'100': 9}}
+        with self.assertRaisesRegexp(ValueError, "schemes 'b'"):
+            rocAnalysis.calculateFrequencies(hitDict, {'a': {'100': 10}})
+        with self.assertRaisesRegexp(ValueError, "schemes 'c'"):
+            rocAnalysis.calculateFrequencies(
+                hitDict, rocAnalysis.designTotals(dict(hitDict, c={})))
+
+    def testDesignTotals(self):
+        """
+        designTotals must give the same number of reads at each level of
+        the design, and at any other level with hits.
+        """
+        totals = rocAnalysis.designTotals({'a': {'100': 8, '97.5': 1}},
+                                          readsPerLevel=10,
+                                          levels=['100', '50'])
+        self.assertEqual({'a': {'100': 10, '97.5': 10, '50': 10}}, totals)
+        totals = rocAnalysis.designTotals({'a': {}})
+        self.assertEqual(
+            dict((level, 594) for level in rocAnalysis.LEVELS), totals['a'])
+
+
 class TestYoudenIndex(TestCase):
     """
     Tests for the youden index calculation.
@@ -490,3 +631,752 @@ class TestAreaUnderCurve(TestCase):
         sortedIndict = rocAnalysis.areaUnderCurveIndex(inDict)
         resultSorted = {'blastn1-545': 1, 'blastn4-545': 0}
         self.assertEqual(sortedIndict, resultSorted)
+
+
+class TestSweep(TestCase):
+    """
+    Tests for the sweep function.
+    """
+    def testSchemeTitleFallback(self):
+        """
+        If a file name does not have the expected layout, its base name
+        without extension must be used as the scoring scheme title.
+        """
+        self.assertEqual('blastn4-545',
+                         rocAnalysis._schemeTitle('/tmp/blastn4-545.json'))
+
+    def testSweepSerial(self):
+        """
+        sweep with one process must give the same counts as countHits.
+        """
+        mockOpener = _mockOpener(RECORDS)
+        with patch('__builtin__.open', mockOpener, create=True):
+            hitDict, totals = rocAnalysis.sweep(['blastn4-545.json'], 50,
+                                                processes=1)
+        with patch('__builtin__.open', mockOpener, create=True):
+            title, readsPerLevel, readsTotal = rocAnalysis.countHits(
+                'blastn4-545.json', 50)
+        self.assertEqual({'blastn4-545': readsPerLevel}, hitDict)
+        self.assertEqual({'blastn4-545': readsTotal}, totals)
+        self.assertEqual(1, readsPerLevel['100'])
+        self.assertEqual(1, readsPerLevel['95'])
+        self.assertEqual(0, readsPerLevel['0'])
+
+    def testSweepWithTotals(self):
+        """
+        sweep must return the total number of reads at each level found
+        in the blast files, including reads without hits, unless asked not
+        to.
+        """
+        mockOpener = _mockOpener(RECORDS)
+        with patch('__builtin__.open', mockOpener, create=True):
+            hitDict, totals = rocAnalysis.sweep(['blastn4-545.json'], 50,
+                                                processes=1)
+        self.assertEqual({'blastn4-545': {'100': 1, '95': 1, '0': 0}},
+                         hitDict)
+        self.assertEqual({'blastn4-545': {'100': 2, '95': 2, '0': 2}},
+                         totals)
+        with patch('__builtin__.open', mockOpener, create=True):
+            self.assertEqual(hitDict, rocAnalysis.sweep(
+                ['blastn4-545.json'], 50, processes=1, withTotals=False))
+
+    def testSweepDuplicateScheme(self):
+        """
+        sweep must raise ValueError if two files have the same scoring
+        scheme title.
+        """
+        mockOpener = _mockOpener(RECORDS)
+        with patch('__builtin__.open', mockOpener, create=True):
+            self.assertRaises(ValueError, rocAnalysis.sweep,
+                              ['a/blastn4-545.json', 'b/blastn4-545.json'],
+                              50, processes=1)
+
+
+class TestBestHits(TestCase):
+    """
+    Tests for the _bestHits reader.
+    """
+    def testBestHitsMatchRecords(self):
+        """
+        _bestHits must give the same query and best hit bit score as the
+        full records from _records.
+        """
+        with patch('__builtin__.open', _mockOpener(RECORDS), create=True):
+            bestHits = list(rocAnalysis._bestHits('file.json'))
+            records = list(rocAnalysis._records('file.json'))
+        self.assertEqual(RECORDS, bestHits)
+        self.assertEqual(
+            [(record.query, record.alignments[0].hsps[0].bits
+              if record.alignments else None) for record in records],
+            bestHits)
+
+    def testEmptyFile(self):
+        """
+        _bestHits must raise ValueError on an empty file.
+        """
+        with patch('__builtin__.open', mockOpen(read_data=''), create=True):
+            self.assertRaises(ValueError, list,
+                              rocAnalysis._bestHits('file.json'))
+
+    def testSeveralAlignments(self):
+        """
+        Decoding only the query and the first alignment must give the same
+        best hits as decoding the whole line, whatever the order of the keys
+        and whatever is in the titles and the query.
+        """
+        def alignment(title, bits, sequence):
+            hsp = {'bits': bits, 'expect': 1e-10, 'frame': [1, 1],
+                   'query': sequence, 'query_start': 1, 'query_end': 4,
+                   'sbjct': sequence, 'sbjct_start': 1, 'sbjct_end': 4}
+            return {'length': 4, 'title': title, 'hsps': [hsp, hsp]}
+
+        alignments = [
+            alignment('first "alignments": [] "query": "a|b|c"', 80.5,
+                      'ACGT'),
+            alignment('second', 70, 'AC-T'),
+            alignment('third', 60, 'ACGA'),
+        ]
+        records = [
+            ('r1|sim|100', alignments),
+            ('r2 "x" \\|sim|\u00e9', alignments[1:]),
+            ('r3|sim|0', []),
+            ('no level', alignments),
+        ]
+        for query, recordAlignments in records:
+            for record in (
+                    OrderedDict([('query', query),
+                                 ('alignments', recordAlignments)]),
+                    OrderedDict([('alignments', recordAlignments),
+                                 ('query', query)])):
+                for line in dumps(record), dumps(record, indent=0).replace(
+                        '\n', ''):
+                    self.assertEqual(rocAnalysis._bestHit(loads(line)),
+                                     rocAnalysis._bestHitOfLine(line))
+
+    def testBadLine(self):
+        """
+        A first alignment that cannot be converted to JSON must raise
+        ValueError.
+        """
+        self.assertRaises(ValueError, rocAnalysis._bestHitOfLine,
+                          '{"query": "r1|sim|100", "alignments": [{"hsps"')
+
+
+class TestCountHitsMultipleCutoffs(TestCase):
+    """
+    Tests for counting hits at several cutoffs in a single pass.
+    """
+    def testBestHitScores(self):
+        """
+        bestHitScores must return the sorted scores of the reads with hits
+        at each level.
+        """
+        with patch('__builtin__.open', _mockOpener(RECORDS), create=True):
+            title, scores = rocAnalysis.bestHitScores('blastn4-545.json')
+        self.assertEqual('blastn4-545', title)
+        self.assertEqual([20.0, 60.0], list(scores['100']))
+        self.assertEqual([55.0], list(scores['95']))
+        self.assertEqual([10.0, 45.0], list(scores['0']))
+        self.assertFalse('50' in scores)
+
+    def testMatchesCountHits(self):
+        """
+        countHitsMultipleCutoffs must give the same result as calling
+        countHits once per cutoff, including cutoffs equal to a score.
+        """
+        cutoffs = [0, 10, 20, 44.9, 45, 55, 60, 100]
+        with patch('__builtin__.open', _mockOpener(RECORDS), create=True):
+            title, result, totals = rocAnalysis.countHitsMultipleCutoffs(
+                'blastn4-545.json', cutoffs)
+            for cutoff in cutoffs:
+                self.assertEqual(
+                    (title, result[cutoff], totals),
+                    rocAnalysis.countHits('blastn4-545.json', cutoff))
+
+
+class TestStreams(TestCase):
+    """
+    Tests for counting hits in blast output that is not in a file.
+    """
+    def testCountHitsFromLines(self):
+        """
+        countHits must count the hits in an iterator of lines.
+        """
+        lines = iter(_blastData(RECORDS).splitlines(True))
+        title, hits, totals = rocAnalysis.countHits(lines, 50)
+        self.assertEqual('<stream>', title)
+        self.assertEqual({'100': 1, '95': 1, '0': 0}, hits)
+        self.assertEqual({'100': 2, '95': 2, '0': 2}, totals)
+
+    def testCacheNeedsFile(self):
+        """
+        Asking for a cache of a stream must raise ValueError.
+        """
+        lines = iter(_blastData(RECORDS).splitlines(True))
+        self.assertRaises(ValueError, rocAnalysis.countHits, lines, 50,
+                          cache=True)
+
+
+class TestCachedBestHits(TestCase):
+    """
+    Tests for the best hit cache.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.blastFile = join(self.tempDir, 'blastn4-545.json')
+        with open(self.blastFile, 'w') as fp:
+            fp.write(_blastData(RECORDS))
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def testCacheIsWritten(self):
+        """
+        Counting with a cache must write a cache file next to the blast
+        file and give the same counts as countHits without a cache.
+        """
+        expected = rocAnalysis.countHits(self.blastFile, 50)
+        result = rocAnalysis.countHits(self.blastFile, 50, cache=True)
+        self.assertTrue(exists(self.blastFile + '.hits.npz'))
+        self.assertEqual(expected, result)
+        result = rocAnalysis.countHits(self.blastFile, 50, cacheOnly=True)
+        self.assertEqual(expected, result)
+
+    def testCountHitsInChunks(self):
+        """
+        Counting with worker processes must give the same counts.
+        """
+        expected = rocAnalysis.countHits(self.blastFile, 50, withTotals=True)
+        result = rocAnalysis.countHits(self.blastFile, 50, withTotals=True,
+                                       processes=2)
+        self.assertEqual(expected, result)
+
+    def testStaleCacheIsRebuilt(self):
+        """
+        If the blast file changes, the cache must be rebuilt.
+        """
+        rocAnalysis.cachedBestHits(self.blastFile)
+        with open(self.blastFile, 'w') as fp:
+            fp.write(_blastData(RECORDS + [('r7|sim|50', 70)]))
+        stat = os.stat(self.blastFile)
+        os.utime(self.blastFile, (stat.st_atime, stat.st_mtime + 10))
+        self.assertRaises(ValueError, rocAnalysis.cachedBestHits,
+                          self.blastFile, cacheOnly=True)
+        levels, scores = rocAnalysis.cachedBestHits(self.blastFile)
+        self.assertEqual(7, len(levels))
+        self.assertEqual(70.0, scores[-1])
+
+    def testCacheOnlyWithoutCache(self):
+        """
+        With cacheOnly, a missing cache must raise ValueError.
+        """
+        self.assertRaises(ValueError, rocAnalysis.countHits, self.blastFile,
+                          50, cacheOnly=True)
+
+    def testCorruptCacheIsRebuilt(self):
+        """
+        A cache file that is not a cache must be rebuilt, and must raise
+        ValueError with cacheOnly.
+        """
+        with open(self.blastFile + '.hits.npz', 'wb') as fp:
+            fp.write('not a cache')
+        self.assertRaises(ValueError, rocAnalysis.cachedBestHits,
+                          self.blastFile, cacheOnly=True)
+        levels, scores = rocAnalysis.cachedBestHits(self.blastFile)
+        self.assertEqual(6, len(levels))
+        levels, scores = rocAnalysis.cachedBestHits(self.blastFile,
+                                                    cacheOnly=True)
+        self.assertEqual(6, len(levels))
+
+    def testTruncatedCacheIsRebuilt(self):
+        """
+        A truncated cache file must be rebuilt.
+        """
+        rocAnalysis.cachedBestHits(self.blastFile)
+        cacheFile = self.blastFile + '.hits.npz'
+        with open(cacheFile, 'rb') as fp:
+            data = fp.read()
+        with open(cacheFile, 'wb') as fp:
+            fp.write(data[:len(data) // 2])
+        levels, scores = rocAnalysis.cachedBestHits(self.blastFile)
+        self.assertEqual(6, len(levels))
+        self.assertEqual(60.0, scores[0])
+
+    def testOldFormatCacheIsRebuilt(self):
+        """
+        A cache file without the expected arrays must be rebuilt.
+        """
+        with open(self.blastFile + '.hits.npz', 'wb') as fp:
+            np.savez(fp, levels=np.array(['100']))
+        levels, scores = rocAnalysis.cachedBestHits(self.blastFile)
+        self.assertEqual(6, len(levels))
+
+
+class TestRocCurve(TestCase):
+    """
+    Tests for ROC curves over all score thresholds.
+    """
+    def testReadScores(self):
+        """
+        readScores must return the level and the best hit bit score of each
+        read, with -inf for reads without hits.
+        """
+        with patch('__builtin__.open', _mockOpener(RECORDS), create=True):
+            title, identities, scores = rocAnalysis.readScores('a.json')
+        self.assertEqual([100, 100, 95, 95, 0, 0], identities.tolist())
+        self.assertEqual([60, 20, 55, -float('inf'), 45, 10], scores.tolist())
+
+    def testRocCurveWithTies(self):
+        """
+        rocCurve must give one point per distinct score, starting at (0, 0)
+        and ending at (1, 1).
+        """
+        fprs, tprs, thresholds = rocAnalysis.rocCurve(
+            [5, 4, 4, 3, 1], [True, True, False, False, True])
+        self.assertEqual([0.0, 0.0, 0.5, 1.0, 1.0], fprs.tolist())
+        self.assertEqual([0.0, 1.0 / 3, 2.0 / 3, 2.0 / 3, 1.0], tprs.tolist())
+        self.assertEqual([float('inf'), 5, 4, 3, 1], thresholds.tolist())
+
+    def testRocCurveAreaIsPairwiseProbability(self):
+        """
+        The area under the curve must be the probability that a positive
+        read scores higher than a negative one, counting ties as half.
+        """
+        scores = [5, 4, 4, 3, 1, -float('inf'), -float('inf')]
+        labels = [True, True, False, False, True, True, False]
+        fprs, tprs, thresholds = rocAnalysis.rocCurve(scores, labels)
+        # The positives 5, 4, 1 and -inf beat 3, 2.5, 1 and 0.5 of the
+        # three negatives 4, 3 and -inf.
+        self.assertAlmostEqual((3 + 2.5 + 1 + 0.5) / 12.0,
+                               rocAnalysis.rocCurveArea(fprs, tprs))
+
+    def testRocCurveOneClass(self):
+        """
+        rocCurve must raise ValueError if all reads are positive.
+        """
+        self.assertRaises(ValueError, rocAnalysis.rocCurve, [1, 2],
+                          [True, True])
+
+    def testRocCurveNoReads(self):
+        """
+        rocCurve must raise ValueError if there are no reads.
+        """
+        self.assertRaises(ValueError, rocAnalysis.rocCurve, [], [])
+
+
+HITDICT = {'blastn4-545': {'60': 56, '65': 115, '80': 560, '85': 592,
+                           '25': 0, '20': 0, '45': 0, '40': 0, '0': 0,
+                           '5': 0, '99': 594, '75': 454, '70': 328,
+                           '90': 594, '100': 594, '95': 594, '10': 0,
+                           '15': 0, '55': 23, '30': 0, '50': 0, '35': 0},
+           'blastn1-545': {'60': 200, '65': 300, '80': 500, '85': 500,
+                           '25': 100, '20': 20, '45': 0, '40': 0, '0': 0,
+                           '5': 0, '99': 550, '75': 454, '70': 328,
+                           '90': 520, '100': 580, '95': 594, '10': 0,
+                           '15': 0, '55': 23, '30': 0, '50': 0, '35': 0}}
+
+HITTOTALS = rocAnalysis.designTotals(HITDICT)
+
+
+class TestBootstrap(TestCase):
+    """
+    Tests for the bootstrap function.
+    """
+    def testVectorizedMeasures(self):
+        """
+        The vectorized measures must agree with youdenIndex, f1Index and
+        areaUnderCurve.
+        """
+        schemes, levels, arrays = rocAnalysis.frequencyArrays(HITDICT,
+                                                              HITTOTALS)
+        frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+        youdens = rocAnalysis._youdenCutoffs(arrays['spcs'], arrays['tprs'])
+        f1s = rocAnalysis._f1Cutoffs(arrays['spcs'], arrays['tprs'])
+        areas = rocAnalysis._areasUnderCurves(arrays['fprs'], arrays['tprs'])
+        for i, scheme in enumerate(schemes):
+            single = {scheme: frequencies[scheme]}
+            self.assertEqual([youdens[i]],
+                             rocAnalysis.youdenIndex(single)[1])
+            self.assertEqual([f1s[i]], rocAnalysis.f1Index(single)[1])
+            self.assertAlmostEqual(
+                rocAnalysis.areaUnderCurve(single)[scheme], areas[i])
+
+    def testDeterministicCounts(self):
+        """
+        If every level has either no hits or all reads hit, every bootstrap
+        replicate is the same, so the intervals must be a single point.
+        """
+        hitDict = {'a': dict((level, 594 if i < 7 else 0)
+                             for i, level in enumerate(rocAnalysis.LEVELS))}
+        totals = rocAnalysis.designTotals(hitDict)
+        result = rocAnalysis.bootstrap(hitDict, totals, replicates=50, seed=1)
+        area = rocAnalysis.areaUnderCurve(
+            rocAnalysis.calculateFrequencies(hitDict, totals))['a']
+        self.assertAlmostEqual(area, result['a']['auc'][0])
+        self.assertAlmostEqual(area, result['a']['auc'][1])
+        self.assertEqual((6, 6), result['a']['youden'])
+        self.assertEqual((6, 6), result['a']['f1'])
+
+    def testIntervalsContainEstimate(self):
+        """
+        The intervals must contain the point estimates, and be the same for
+        the same seed.
+        """
+        result = rocAnalysis.bootstrap(HITDICT, HITTOTALS, replicates=200,
+                                       seed=3, batchRows=50)
+        again = rocAnalysis.bootstrap(HITDICT, HITTOTALS, replicates=200,
+                                      seed=3)
+        self.assertEqual(result, again)
+        areas = rocAnalysis.areaUnderCurve(
+            rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS))
+        for scheme, area in areas.items():
+            lower, upper = result[scheme]['auc']
+            self.assertTrue(lower <= area <= upper)
+            self.assertTrue(lower < upper)
+
+
+class TestDelong(TestCase):
+    """
+    Tests for comparing areas under ROC curves with DeLong's test.
+    """
+    SCORES = [[5, 4, 4, 3, 1, 0, 2, 7],
+              [5, 1, 4, 3, 6, 0, 2, 2],
+              [1, 2, 3, 4, 5, 6, 7, 8]]
+    LABELS = [True, True, False, False, True, True, False, True]
+
+    def testAreas(self):
+        """
+        The areas must be the same as from rocCurve.
+        """
+        areas, covariance = rocAnalysis.delongCovariance(self.SCORES,
+                                                         self.LABELS)
+        for row, area in zip(self.SCORES, areas):
+            fprs, tprs, _ = rocAnalysis.rocCurve(row, self.LABELS)
+            self.assertAlmostEqual(rocAnalysis.rocCurveArea(fprs, tprs), area)
+
+    def testCovarianceMatchesDefinition(self):
+        """
+        The covariance must be the same as from DeLong's quadratic
+        definition.
+        """
+        areas, covariance = rocAnalysis.delongCovariance(self.SCORES,
+                                                         self.LABELS)
+        labels = self.LABELS
+
+        def psi(x, y):
+            return 1.0 if x > y else (0.5 if x == y else 0.0)
+
+        v10 = []
+        v01 = []
+        for row in self.SCORES:
+            xs = [s for s, label in zip(row, labels) if label]
+            ys = [s for s, label in zip(row, labels) if not label]
+            v10.append([sum(psi(x, y) for y in ys) / len(ys) for x in xs])
+            v01.append([sum(psi(x, y) for x in xs) / len(xs) for y in ys])
+
+        def cov(a, b):
+            meanA = sum(a) / len(a)
+            meanB = sum(b) / len(b)
+            return (sum((x - meanA) * (y - meanB) for x, y in zip(a, b)) /
+                    (len(a) - 1))
+
+        for i in range(3):
+            for j in range(3):
+                expected = (cov(v10[i], v10[j]) / len(v10[i]) +
+                            cov(v01[i], v01[j]) / len(v01[i]))
+                self.assertAlmostEqual(expected, covariance[i][j])
+
+    def testPValues(self):
+        """
+        The p-values must be symmetric, 1 on the diagonal and between 0
+        and 1.
+        """
+        areas, pValues = rocAnalysis.delongTest(self.SCORES, self.LABELS)
+        self.assertEqual([1.0, 1.0, 1.0], list(pValues.diagonal()))
+        self.assertTrue((pValues == pValues.T).all())
+        self.assertTrue(((pValues >= 0) & (pValues <= 1)).all())
+
+    def testSinglePositive(self):
+        """
+        With only one positive read the variance of the areas is unknown,
+        so ValueError must be raised rather than p-values of 0.
+        """
+        labels = [True, False, False, False, False, False, False, False]
+        self.assertRaises(ValueError, rocAnalysis.delongCovariance,
+                          self.SCORES, labels)
+        self.assertRaises(ValueError, rocAnalysis.delongTest, self.SCORES,
+                          labels)
+
+    def testSingleNegative(self):
+        """
+        With only one negative read, ValueError must be raised.
+        """
+        labels = [True, True, True, True, True, True, False, True]
+        self.assertRaises(ValueError, rocAnalysis.delongTest, self.SCORES,
+                          labels)
+
+
+class TestCompareSchemes(TestCase):
+    """
+    Tests for comparing scoring schemes with DeLong's test.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def _write(self, name, records):
+        filename = join(self.tempDir, name)
+        with open(filename, 'w') as fp:
+            fp.write(_blastData(records))
+        return filename
+
+    def testSameReads(self):
+        """
+        Files with the same reads must be compared.
+        """
+        other = [(query, None if bits is None else bits + 1)
+                 for query, bits in RECORDS]
+        files = [self._write('a.json', RECORDS), self._write('b.json', other)]
+        schemes, areas, pValues = rocAnalysis.compareSchemes(files, 95)
+        self.assertEqual(['a', 'b'], schemes)
+        self.assertEqual((2, 2), pValues.shape)
+
+    def testOtherOrder(self):
+        """
+        Files with the same reads in a different order must raise
+        ValueError, even if their levels of sequence identity line up.
+        """
+        other = [RECORDS[1], RECORDS[0]] + RECORDS[2:]
+        files = [self._write('a.json', RECORDS), self._write('b.json', other)]
+        self.assertRaises(ValueError, rocAnalysis.compareSchemes, files, 95)
+
+    def testOtherReads(self):
+        """
+        Files with different reads at the same levels must raise
+        ValueError.
+        """
+        other = [('x' + query, bits) for query, bits in RECORDS]
+        files = [self._write('a.json', RECORDS), self._write('b.json', other)]
+        self.assertRaises(ValueError, rocAnalysis.compareSchemes, files, 95,
+                          cache=True)
+
+
+class TestSummarize(TestCase):
+    """
+    Tests for the summarize function.
+    """
+    def testAreaUnderCurveDoesNotChangeFrequencies(self):
+        """
+        areaUnderCurve must not change the frequencies, so calling it twice
+        must give the same result.
+        """
+        frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+        fprs = list(frequencies['blastn4-545']['fprs'])
+        first = rocAnalysis.areaUnderCurve(frequencies)
+        self.assertEqual(fprs, frequencies['blastn4-545']['fprs'])
+        self.assertEqual(first, rocAnalysis.areaUnderCurve(frequencies))
+
+    def testSummarize(self):
+        """
+        summarize must agree with areaUnderCurve, youdenIndex and f1Index.
+        """
+        frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+        summary = rocAnalysis.summarize(frequencies)
+        self.assertEqual(['blastn1-545', 'blastn4-545'], list(summary.scheme))
+        areas = rocAnalysis.areaUnderCurve(frequencies)
+        for record in summary:
+            single = {record.scheme: frequencies[record.scheme]}
+            youdenCoords, youdenCutoffs = rocAnalysis.youdenIndex(single)
+            f1Coords, f1Cutoffs = rocAnalysis.f1Index(single)
+            self.assertAlmostEqual(areas[record.scheme], record.auc)
+            self.assertEqual(youdenCutoffs, [record.youdenCutoff])
+            self.assertEqual(youdenCoords,
+                             [(record.youdenTpr, record.youdenFpr)])
+            self.assertEqual(f1Cutoffs, [record.f1Cutoff])
+            self.assertEqual(f1Coords, [(record.f1Tpr, record.f1Fpr)])
+
+
+class TestPlotRocCurves(TestCase):
+    """
+    Tests for the plotRocCurves function.
+    """
+    def testOneCollectionAndOneScatter(self):
+        """
+        All curves must be in one LineCollection and all markers in one
+        scatter.
+        """
+        frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+        ax = rocAnalysis.plotRocCurves(frequencies)
+        self.assertEqual(2, len(ax.collections))
+        lines, markers = ax.collections
+        self.assertEqual(2, len(lines.get_segments()))
+        self.assertEqual(4, len(markers.get_offsets()))
+
+    def testNoMarkers(self):
+        """
+        If no markers are wanted, only the LineCollection must be added.
+        """
+        frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+        ax = rocAnalysis.plotRocCurves(frequencies, youden=False, f1=False)
+        self.assertEqual(1, len(ax.collections))
+
+    def testSaveImage(self):
+        """
+        The figure must be saved if an image file is given.
+        """
+        dirname = mkdtemp()
+        try:
+            imageFile = join(dirname, 'roc.png')
+            frequencies = rocAnalysis.calculateFrequencies(HITDICT, HITTOTALS)
+            rocAnalysis.plotRocCurves(frequencies, imageFile=imageFile)
+            self.assertTrue(exists(imageFile))
+        finally:
+            rmtree(dirname)
+
+
+class TestHitFollower(TestCase):
+    """
+    Tests for the HitFollower class.
+    """
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.blastFile = join(self.tempDir, 'blastn4-545.json')
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def testOnlyParameters(self):
+        """
+        A file with only its parameters line must give no records and an
+        empty summary.
+        """
+        data = _blastData(RECORDS)
+        with open(self.blastFile, 'w') as fp:
+            fp.write(data[:data.index('\n') + 1])
+        follower = rocAnalysis.HitFollower(50)
+        self.assertEqual(0, follower.update([self.blastFile]))
+        self.assertEqual({}, follower.hitDict())
+        summary = follower.summary()
+        self.assertEqual(0, len(summary))
+        self.assertEqual(('scheme', 'auc', 'youdenCutoff', 'youdenTpr',
+                          'youdenFpr', 'f1Cutoff', 'f1Tpr', 'f1Fpr'),
+                         summary.dtype.names)
+
+    def testIncrementalUpdates(self):
+        """
+        Each update must only read the complete records added since the
+        last one, and the counts must end up the same as from countHits.
+        """
+        data = _blastData(RECORDS)
+        lines = data.split('\n')
+        follower = rocAnalysis.HitFollower(50)
+
+        # The parameters, two records and half of the third.
+        partial = '\n'.join(lines[:3]) + '\n' + lines[3][:10]
+        with open(self.blastFile, 'w') as fp:
+            fp.write(partial)
+        self.assertEqual(2, follower.update([self.blastFile]))
+        self.assertEqual({'blastn4-545': {'100': 1}}, follower.hitDict())
+        self.assertEqual({'blastn4-545': {'100': 2}}, follower.totals())
+
+        with open(self.blastFile, 'w') as fp:
+            fp.write(data)
+        self.assertEqual(4, follower.update(join(self.tempDir, '*.json')))
+        self.assertEqual(0, follower.update([self.blastFile]))
+
+        title, readsPerLevel, readsTotal = rocAnalysis.countHits(
+            self.blastFile, 50, withTotals=True)
+        self.assertEqual({title: readsPerLevel}, follower.hitDict())
+        self.assertEqual({title: readsTotal}, follower.totals())
+        self.assertEqual(
+            rocAnalysis.calculateFrequencies({title: readsPerLevel},
+                                             {title: readsTotal}),
+            follower.frequencies())
+        self.assertEqual(['blastn4-545'], list(follower.summary().scheme))
+
+    def testRewrittenFile(self):
+        """
+        If a file gets shorter, it must be counted again from its start.
+        """
+        follower = rocAnalysis.HitFollower(50)
+        with open(self.blastFile, 'w') as fp:
+            fp.write(_blastData(RECORDS))
+        follower.update([self.blastFile])
+        with open(self.blastFile, 'w') as fp:
+            fp.write(_blastData(RECORDS[:1]))
+        self.assertEqual(1, follower.update([self.blastFile]))
+        self.assertEqual({'blastn4-545': {'100': 1}}, follower.hitDict())
+
+
+class TestQuickEstimate(TestCase):
+    """
+    Tests for estimates from a sample of the reads.
+    """
+    def testQueryLevelRegex(self):
+        """
+        QUERY_LEVEL_REGEX must find the level of the query of a record, and
+        not be confused by the query sequences of the HSPs.
+        """
+        for line in _blastData(RECORDS).split('\n')[1:-1]:
+            match = rocAnalysis.QUERY_LEVEL_REGEX.search(line)
+            level = rocAnalysis._bestHit(loads(line))[0].split('|')[2]
+            self.assertEqual(level, match.group(1))
+
+    def testLargeSampleIsEverything(self):
+        """
+        If the sample is at least as big as the number of reads at each
+        level, it must contain all of them.
+        """
+        mockOpener = _mockOpener(RECORDS)
+        with patch('__builtin__.open', mockOpener, create=True):
+            title, scores, totals = rocAnalysis.sampleBestHits('a.json', 10)
+            expected = rocAnalysis.bestHitScores('a.json', withTotals=True)
+        self.assertEqual(expected[2], totals)
+        self.assertEqual(sorted(expected[1]), sorted(scores))
+        for level in scores:
+            self.assertEqual(list(expected[1][level]), list(scores[level]))
+
+    def testSampleSize(self):
+        """
+        At most the requested number of reads must be sampled per level.
+        """
+        records = [('r%d|sim|%d' % (i, i % 2), i) for i in range(100)]
+        with patch('__builtin__.open', _mockOpener(records), create=True):
+            title, scores, totals = rocAnalysis.sampleBestHits(
+                'a.json', 5, seed=1)
+        self.assertEqual({'0': 5, '1': 5}, totals)
+        self.assertTrue(all(score % 2 == 0 for score in scores['0']))
+
+    def testOverlappingIntervals(self):
+        """
+        overlappingIntervals must find the pairs of schemes whose intervals
+        overlap.
+        """
+        intervals = {'a': {'auc': (0.5, 0.6)},
+                     'b': {'auc': (0.55, 0.7)},
+                     'c': {'auc': (0.8, 0.9)},
+                     'd': {'auc': (0.7, 0.8)}}
+        self.assertEqual([('a', 'b'), ('b', 'd'), ('c', 'd')],
+                         rocAnalysis.overlappingIntervals(intervals))
+
+    def testQuickEstimate(self):
+        """
+        quickEstimate must return frequencies and intervals for each
+        scoring scheme.
+        """
+        tempDir = mkdtemp()
+        try:
+            for name in 'blastn1-1', 'blastn2-2':
+                with open(join(tempDir, name + '.json'), 'w') as fp:
+                    fp.write(_blastData(RECORDS))
+            frequencies, intervals, overlaps = rocAnalysis.quickEstimate(
+                join(tempDir, '*.json'), 50, readsPerLevel=1, replicates=20,
+                seed=1)
+        finally:
+            rmtree(tempDir)
+        self.assertEqual(['blastn1-1', 'blastn2-2'], sorted(frequencies))
+        self.assertEqual(['blastn1-1', 'blastn2-2'], sorted(intervals))
+        for scheme in frequencies:
+            self.assertEqual([1, 1, 1], frequencies[scheme]['totals'])